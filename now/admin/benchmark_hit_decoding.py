@@ -0,0 +1,87 @@
+"""
+Microbenchmark of turning the hits of a search response into matches, as done by the
+NOWElasticIndexer: deserializing every hit on its own, deserializing all hits of a
+response in a thread pool, and building lightweight matches from `field_values`.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from timeit import timeit
+
+import numpy as np
+from docarray import Document, dataclass
+from docarray.typing import Text
+
+from now.executor.indexer.elastic.es_converter import (
+    DEFAULT_SERIALIZATION_FORMAT,
+    convert_es_results_to_matches,
+    convert_es_to_da,
+    get_field_values,
+    serialize_doc,
+)
+
+num_hits = 100
+repetitions = 20
+
+
+@dataclass
+class MMDoc:
+    title: Text
+    description: Text
+
+
+def generate_hits(blob_size):
+    rng = np.random.default_rng(42)
+    hits = []
+    for i in range(num_hits):
+        doc = Document(MMDoc(title=f'title {i}', description='a description ' * 20))
+        doc.tags['price'] = float(i)
+        # e.g. a thumbnail which is stored with the document
+        doc.chunks[0].blob = rng.bytes(blob_size)
+        hits.append(
+            {
+                '_id': doc.id,
+                '_score': float(i),
+                '_source': {
+                    'serialized_doc': serialize_doc(doc),
+                    'serialization_format': DEFAULT_SERIALIZATION_FORMAT,
+                    'field_values': get_field_values(doc),
+                    'tags': doc.tags,
+                },
+            }
+        )
+    return hits
+
+
+def to_matches(hits, **kwargs):
+    return convert_es_results_to_matches(
+        query_doc=Document(),
+        es_results=hits,
+        get_score_breakdown=False,
+        metric='cosine',
+        semantic_scores=[],
+        parallel_decode_min_bytes=0,
+        **kwargs,
+    )
+
+
+def per_hit(hits):
+    return [convert_es_to_da(hit, get_score_breakdown=False)[0] for hit in hits]
+
+
+def benchmark(blob_size, pool):
+    hits = generate_hits(blob_size)
+    candidates = {
+        'per hit': lambda: per_hit(hits),
+        'sequential': lambda: to_matches(hits),
+        'thread pool': lambda: to_matches(hits, pool=pool),
+        'lightweight': lambda: to_matches(hits, lightweight=True),
+    }
+    print(f'{num_hits} hits with {blob_size} byte blobs:')
+    for name, candidate in candidates.items():
+        seconds = timeit(candidate, number=repetitions) / repetitions
+        print(f'  {name:<12} {seconds * 1000:8.2f} ms')
+
+
+if __name__ == '__main__':
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        for blob_size in [0, 10_000, 100_000]:
+            benchmark(blob_size, pool)
@@ -0,0 +1,61 @@
+"""
+Compares recall and memory of float32 and byte-quantized vectors, as stored by the
+NOWElasticIndexer with `vector_element_type='float'` and `vector_element_type='byte'`.
+Scores are computed exactly with numpy, so the recall only reflects the quantization
+and not the approximation of the HNSW graph.
+"""
+import numpy as np
+
+from now.executor.indexer.elastic.es_converter import quantize_embedding
+
+num_docs = 100_000
+num_queries = 100
+num_clusters = 1_000
+limit = 60
+# number of HNSW graph neighbours per vector, Elasticsearch's default of `m`
+hnsw_m = 16
+
+
+def generate_vectors(dim, rng):
+    """Clustered vectors, which are closer to real embeddings than uniform noise."""
+    centers = rng.normal(size=(num_clusters, dim)).astype(np.float32)
+    docs = centers[rng.integers(num_clusters, size=num_docs)]
+    docs += 0.3 * rng.normal(size=docs.shape).astype(np.float32)
+    queries = centers[rng.integers(num_clusters, size=num_queries)]
+    queries += 0.3 * rng.normal(size=queries.shape).astype(np.float32)
+    return docs, queries
+
+
+def top_k_cosine(docs, queries):
+    docs = docs.astype(np.float32)
+    queries = queries.astype(np.float32)
+    docs /= np.linalg.norm(docs, axis=1, keepdims=True)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    scores = queries @ docs.T
+    top_k = np.argpartition(-scores, limit, axis=1)[:, :limit]
+    return [set(row) for row in top_k]
+
+
+def memory_in_mb(dim, bytes_per_element):
+    vectors = num_docs * dim * bytes_per_element
+    graph = num_docs * hnsw_m * 2 * 4
+    return (vectors + graph) / 2**20
+
+
+def benchmark(dim, rng):
+    docs, queries = generate_vectors(dim, rng)
+    expected = top_k_cosine(docs, queries)
+    quantized_docs = np.stack([quantize_embedding(d) for d in docs])
+    quantized_queries = np.stack([quantize_embedding(q) for q in queries])
+    actual = top_k_cosine(quantized_docs, quantized_queries)
+    recall = np.mean([len(e & a) / limit for e, a in zip(expected, actual)])
+    print(f'dim {dim}:')
+    print(f'  float memory: {memory_in_mb(dim, 4):.1f} MB')
+    print(f'  byte memory:  {memory_in_mb(dim, 1):.1f} MB')
+    print(f'  byte recall@{limit}: {recall:.4f}')
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(42)
+    for dim in [512, 768]:
+        benchmark(dim, rng)
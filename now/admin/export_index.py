@@ -0,0 +1,62 @@
+"""
+Exports all documents of the index of a deployed flow into a file, e.g. to back up an
+index or to diff two indexes. The documents are listed page by page with the cursor of
+the `/list` endpoint, so neither the indexer nor this script holds the whole index in
+memory. Every line of the export holds one document, encoded as base64.
+"""
+import sys
+from typing import Dict, Iterator, Optional
+
+from docarray import Document
+from jina import Client
+
+
+def export_index(
+    client: Client,
+    path: str,
+    page_size: int = 1000,
+    parameters: Optional[Dict] = None,
+) -> int:
+    """
+    Write all documents of the index to `path`.
+
+    :param client: client of the flow
+    :param path: path of the export file
+    :param page_size: number of documents per `/list` request
+    :param parameters: additional parameters of the requests, e.g. the jwt
+    :return: number of exported documents
+    """
+    num_docs = 0
+    cursor = ''
+    with open(path, 'w') as f:
+        while cursor is not None:
+            response = client.post(
+                on='/list',
+                parameters={
+                    **(parameters or {}),
+                    'limit': page_size,
+                    'cursor': cursor,
+                },
+                return_results=True,
+            )
+            page = response[0]
+            for doc in page.matches:
+                f.write(doc.to_base64(protocol='protobuf', compress='zlib') + '\n')
+            num_docs += len(page.matches)
+            cursor = page.tags['cursor']
+    return num_docs
+
+
+def load_export(path: str) -> Iterator[Document]:
+    """Iterate over the documents of a file written by `export_index`."""
+    with open(path, 'r') as f:
+        for line in f:
+            yield Document.from_base64(
+                line.strip(), protocol='protobuf', compress='zlib'
+            )
+
+
+if __name__ == '__main__':
+    host, path = sys.argv[1], sys.argv[2]
+    exported = export_index(Client(host=host), path)
+    print(f'Exported {exported} documents to {path}')
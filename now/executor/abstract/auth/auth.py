@@ -1,3 +1,4 @@
+import inspect
 import json
 import os
 from functools import lru_cache
@@ -18,19 +19,35 @@ class SecurityLevel:
 
 
 def secure_request(level: int, on: str = None):
-    """decorator to check the authorization of the incoming request"""
+    """decorator to check the authorization of the incoming request. Async request
+    handlers stay coroutine functions, so that Jina awaits them in its event loop."""
 
     def decorator(func):
-        @requests(on=on)
-        def wrapper(*args, **kwargs):
-            _check_user(
-                kwargs,
-                level,
-                args[0].user_emails,
-                args[0].admin_emails,
-                args[0].api_keys,
-            )
-            return func(*args, **kwargs)
+        if inspect.iscoroutinefunction(func):
+
+            @requests(on=on)
+            async def wrapper(*args, **kwargs):
+                _check_user(
+                    kwargs,
+                    level,
+                    args[0].user_emails,
+                    args[0].admin_emails,
+                    args[0].api_keys,
+                )
+                return await func(*args, **kwargs)
+
+        else:
+
+            @requests(on=on)
+            def wrapper(*args, **kwargs):
+                _check_user(
+                    kwargs,
+                    level,
+                    args[0].user_emails,
+                    args[0].admin_emails,
+                    args[0].api_keys,
+                )
+                return func(*args, **kwargs)
 
         return wrapper
 
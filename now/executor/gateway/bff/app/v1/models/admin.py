@@ -1,4 +1,4 @@
-from typing import List
+from typing import Any, Dict, List, Tuple
 
 from pydantic import Field
 
@@ -17,3 +17,12 @@ class UpdateApiKeysRequestModel(BaseRequestModel):
         default=...,
         description='List of api keys which allow to access the flow in an automated way',
     )
+
+
+class UpdateTagsRequestModel(BaseRequestModel):
+    data: List[Tuple[str, Dict[str, Any]]] = Field(
+        default=...,
+        description='List of tuples where each tuple contains the id of an indexed document '
+        'and the tags which are merged into its tags.',
+        example=[('123', {'price': 10})],
+    )
@@ -59,6 +59,13 @@ class SearchRequestModel(BaseRequestModel):
         description='If true, the score breakdown is returned in the response tags.',
         example=True,
     )
+    search_mode: Optional[str] = Field(
+        default=None,
+        description='Either `exact` to score all documents, `approximate` to use kNN search or '
+        '`rescore` to rescore kNN candidates with the exact scores. '
+        'If not set, the default search mode of the indexer is used.',
+        example='approximate',
+    )
 
 
 class SearchResponseModel(BaseModel):
@@ -1,9 +1,10 @@
-from docarray import Document
+from docarray import Document, DocumentArray
 from fastapi import APIRouter, HTTPException
 
 from now.executor.gateway.bff.app.v1.models.admin import (
     UpdateApiKeysRequestModel,
     UpdateEmailsRequestModel,
+    UpdateTagsRequestModel,
 )
 from now.executor.gateway.bff.app.v1.models.shared import BaseRequestModel
 from now.executor.gateway.bff.app.v1.routers.helper import jina_client_post
@@ -43,6 +44,23 @@ async def update_api_keys(data: UpdateApiKeysRequestModel):
     )
 
 
+@router.post(
+    "/updateTags",
+    summary='update the tags of indexed documents',
+)
+async def update_tags(data: UpdateTagsRequestModel):
+    """
+    Update the tags of indexed documents, e.g. to sync prices from a catalogue. Tags
+    don't need to be encoded, so the documents are sent to the indexer directly.
+    """
+    await jina_client_post(
+        request_model=data,
+        docs=DocumentArray([Document(id=id, tags=tags) for id, tags in data.data]),
+        endpoint='/update',
+        target_executor=r'\Aindexer\Z',
+    )
+
+
 @router.post(
     "/getStatus",
     summary='Get status of the flow during runtime',
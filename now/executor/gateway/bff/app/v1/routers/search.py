@@ -153,6 +153,7 @@ async def search(
                 list(semantic_score) for semantic_score in data.semantic_scores
             ],
             'get_score_breakdown': data.get_score_breakdown,
+            'search_mode': data.search_mode,
         },
         request_model=data,
     )
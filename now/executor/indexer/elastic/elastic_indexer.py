@@ -1,14 +1,25 @@
+import asyncio
+import base64
+import hashlib
+import json
+import math
 import os
+import re
 import subprocess
+import threading
 import traceback
+import uuid
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from time import sleep
-from typing import Any, Dict, List, Mapping, Optional, Tuple, Union
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple, Union
 
 import boto3
+import numpy as np
 from docarray import Document, DocumentArray
-from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+from elasticsearch import AsyncElasticsearch, Elasticsearch, NotFoundError
+from elasticsearch.helpers import parallel_bulk, scan, streaming_bulk
 
 from now.constants import DatasetTypes
 from now.executor.abstract.auth import (
@@ -17,20 +28,79 @@ from now.executor.abstract.auth import (
     secure_request,
 )
 from now.executor.indexer.elastic.es_converter import (
+    DEFAULT_SERIALIZATION_FORMAT,
+    SERIALIZATION_FORMATS,
+    VECTOR_ELEMENT_TYPES,
     convert_doc_map_to_es,
     convert_es_results_to_matches,
     convert_es_to_da,
+    deserialize_doc,
+    get_es_text_fields,
+    get_field_values,
+    quantize_embedding,
+    serialize_doc,
 )
 from now.executor.indexer.elastic.es_query_building import (
+    DEFAULT_NUM_CANDIDATES,
+    DEFAULT_RESCORE_WINDOW_SIZE,
+    SEARCH_MODES,
+    SEMANTIC_SCORE_SCRIPT,
+    SEMANTIC_SCORE_SCRIPT_ID,
+    build_es_knn_queries,
     build_es_queries,
+    build_es_rescore_queries,
+    compile_filter,
     generate_semantic_scores,
-    process_filter,
+    get_pinned_query,
+    get_score_breakdown_script_fields,
 )
+from now.executor.indexer.elastic.search_cache import (
+    SearchResultCache,
+    get_search_cache_key,
+)
+from now.executor.indexer.elastic.tag_index import TagValueIndex
+from now.now_dataclasses import UserInput
+
+REFRESH_POLICIES = ['immediate', 'interval', 'wait_for']
+# maximum number of values per tag aggregated for a subset of the documents
+MAX_TAG_BUCKETS = 10_000
+# maximum number of documents curated for each filter of `/curate`
+MAX_CURATED_IDS_PER_FILTER = 100
+POOLING_STRATEGIES = ['mean', 'max', 'first']
+# maximum number of ids fetched with one mget request
+MAX_IDS_PER_MGET = 10_000
+EXPIRED_CURSOR_MESSAGE = (
+    'The cursor expired, start listing with a new cursor or increase `keep_alive`.'
+)
+# time in seconds between two checks whether a reindex or delete task is done
+TASK_POLL_INTERVAL = 5
+# limits for the default number of shards: the vectors of a shard should fit into the
+# page cache of a node, and scoring all documents of a shard with a script should
+# take about as long as with the other shards
+MAX_VECTOR_BYTES_PER_SHARD = 10 * 2**30
+MAX_DOCS_PER_SHARD = 2_000_000
+# id of the document in the curated index which holds the generation of the search
+# caches of all replicas, see `invalidate_search_cache`
+SEARCH_CACHE_GENERATION_ID = 'search-cache-generation'
+# snapshots and restores are waited for, which takes longer than other requests
+SNAPSHOT_REQUEST_TIMEOUT = 3600
 
 FieldEmbedding = namedtuple(
     'FieldEmbedding',
     ['encoder', 'embedding_size', 'fields'],
 )
+# state of a search request between building the queries and converting the hits
+PreparedSearch = namedtuple(
+    'PreparedSearch',
+    [
+        'es_queries',
+        'uncached_queries',
+        'es_bodies',
+        'semantic_scores',
+        'cache_generation',
+        'routing',
+    ],
+)
 
 Executor = get_auth_executor_class()
 
@@ -49,13 +119,43 @@ class NOWElasticIndexer(Executor):
         dim: int = None,
         metric: str = 'cosine',
         limit: int = 10,
-        max_values_per_tag: int = 10,
+        max_values_per_tag: int = 1000,
         es_mapping: Dict = None,
         hosts: Union[
             str, List[Union[str, Mapping[str, Union[str, int]]]], None
         ] = 'http://localhost:9200',
         es_config: Optional[Dict[str, Any]] = None,
         index_name: str = 'now-index',
+        max_queries_per_msearch: int = 100,
+        search_mode: str = 'exact',
+        num_candidates: Union[int, Dict[str, int]] = DEFAULT_NUM_CANDIDATES,
+        rescore_window_size: int = DEFAULT_RESCORE_WINDOW_SIZE,
+        use_stored_script: bool = False,
+        search_cache_max_entries: int = 1000,
+        search_cache_max_bytes: int = 2**26,
+        search_cache_ttl: float = 600,
+        search_cache_sync_interval: float = 1,
+        serialization_format: str = DEFAULT_SERIALIZATION_FORMAT,
+        vector_element_type: str = 'float',
+        bulk_thread_count: int = 4,
+        bulk_chunk_size: int = 500,
+        bulk_max_chunk_bytes: int = 100 * 2**20,
+        refresh_policy: str = 'immediate',
+        refresh_interval: Optional[str] = None,
+        backfill_threshold: int = 10_000,
+        tag_reconciliation_interval: float = 600,
+        curation_sync_interval: float = 60,
+        decode_thread_count: int = 1,
+        parallel_decode_min_bytes: int = 2**20,
+        pooling: str = 'mean',
+        max_concurrency: int = 10,
+        fast_reindex: bool = True,
+        max_old_index_versions: int = 0,
+        number_of_shards: Optional[int] = None,
+        number_of_replicas: Optional[int] = None,
+        expected_num_docs: Optional[int] = None,
+        routing_tag: Optional[str] = None,
+        snapshot_path: Optional[str] = None,
         *args,
         **kwargs,
     ):
@@ -65,12 +165,106 @@ class NOWElasticIndexer(Executor):
         :param dim: Dimensionality of vectors to index.
         :param metric: Distance metric type. Can be 'euclidean', 'inner_product', or 'cosine'
         :param limit: Number of results to get for each query document in search
-        :param max_values_per_tag: Maximum number of values per tag
+        :param max_values_per_tag: Maximum number of values per tag which are kept in
+            memory and returned by `/tags`. Tags with more values are marked as overflowed.
         :param es_mapping: Mapping for new index. If none is specified, this will be
             generated from `document_mappings` and `metric`.
         :param hosts: host configuration of the Elasticsearch node or cluster
         :param es_config: Elasticsearch cluster configuration object
-        :param index_name: ElasticSearch Index name used for the storage
+        :param index_name: Name of the alias which points to the current version of the
+            index. Versions are stored in the indices `{index_name}-v{version}`, so that
+            the index can be rebuilt with `/reindex` while it is searched.
+        :param max_queries_per_msearch: Maximum number of queries sent to Elasticsearch
+            in a single `_msearch` request. Query documents of one search request
+            are batched into as few `_msearch` requests as possible.
+        :param search_mode: Default search mode, can be overwritten per request. Either
+            'exact', which scores every matching document with a script,
+            'approximate', which uses the HNSW graphs of the vector fields (kNN search),
+            or 'rescore', which rescores kNN candidates with the exact script.
+        :param num_candidates: Number of candidates considered per shard in approximate
+            search. Either a single value or a dictionary mapping
+            `{document_field}-{encoder}` to a value.
+        :param rescore_window_size: Number of kNN candidates per shard which are
+            rescored with the exact script in 'rescore' search mode.
+        :param use_stored_script: Whether to score documents with a stored script that
+            is registered at startup and compiled once, instead of an inline script
+            that is compiled for every distinct combination of semantic scores. The
+            stored script computes the similarities in a Painless loop rather than
+            with the native `cosineSimilarity`/`l2norm` functions, so it is slower per
+            scored document and only pays off when script compilations are the limit.
+        :param search_cache_max_entries: Maximum number of queries whose matches are
+            cached. Set to 0 to disable the search result cache.
+        :param search_cache_max_bytes: Maximum size of all cached matches in bytes.
+        :param search_cache_ttl: Time in seconds after which cached matches expire.
+        :param search_cache_sync_interval: Time in seconds between the checks whether
+            another replica wrote to the index, after which the cached matches are
+            dropped. Set to 0 to disable the checks, e.g. with a single replica. With
+            several replicas, the cache can then serve matches which are outdated by
+            writes to another replica for up to `search_cache_ttl`.
+        :param serialization_format: Format in which documents are stored in the index,
+            one of `SERIALIZATION_FORMATS`. Documents stored in another format can still
+            be read, and are converted by the `/migrate_serialization` endpoint.
+        :param vector_element_type: Element type of the vector fields, 'float' or 'byte'.
+            'byte' stores scalar-quantized vectors, which need a quarter of the memory,
+            and is only supported with the 'cosine' metric.
+        :param bulk_thread_count: Number of threads sending bulk requests in parallel
+            while indexing. With 1, bulk requests are streamed from a single thread.
+        :param bulk_chunk_size: Maximum number of documents per bulk request.
+        :param bulk_max_chunk_bytes: Maximum size of a bulk request in bytes.
+        :param refresh_policy: When writes become visible to searches, can be overwritten
+            per request. Either 'immediate', which refreshes the index after every write,
+            'interval', which leaves refreshes to Elasticsearch's `refresh_interval`, or
+            'wait_for', which lets every write wait for the next scheduled refresh.
+        :param refresh_interval: `refresh_interval` of the index, e.g. '30s'. If None, the
+            default of Elasticsearch is used.
+        :param backfill_threshold: Minimum number of documents in an index request for
+            which periodic refreshes are disabled until the request is done, if the
+            refresh policy is 'interval'.
+        :param tag_reconciliation_interval: Time in seconds between the reconciliations
+            of the tag values, which are tracked incrementally, with an aggregation over
+            the index. Set to 0 to disable the periodic reconciliation.
+        :param curation_sync_interval: Time in seconds between the reloads of the curated
+            results from the curated index, so that replicas pick up the results curated
+            by another replica. Replicas also pick up new versions of the index then,
+            e.g. from `/restore` or `/reindex` on another replica, by reloading the tags
+            and invalidating their search cache. Set to 0 to only load them at startup.
+        :param decode_thread_count: Number of threads which deserialize the documents of
+            large search responses in parallel. With 1, documents are deserialized in the
+            thread of the request. Base64 decoding and protobuf parsing hold the GIL, so
+            more threads rarely pay off, see `now/admin/benchmark_hit_decoding.py`.
+        :param pooling: How the embeddings of the sentences of a text field, or the frames
+            of a video, are pooled into the embedding of the field. Either 'mean', 'max'
+            or 'first'.
+        :param parallel_decode_min_bytes: Minimum size of the stored documents of a
+            search response in bytes, for which they are deserialized in parallel.
+        :param max_concurrency: Number of connections per Elasticsearch node of the
+            async client, which serves `/search`, `/list` and `/tags`. This is the
+            number of requests to Elasticsearch one indexer has in flight at a time,
+            further requests wait for a free connection.
+        :param fast_reindex: Whether to build new versions of the index in `/reindex`
+            without replicas and refreshes, which are enabled once the documents are
+            copied.
+        :param max_old_index_versions: Number of versions of the index which are kept
+            after `/reindex` swapped to a new version, e.g. to roll back. Older
+            versions are deleted.
+        :param number_of_shards: Number of primary shards of new indices. Searches are
+            parallelized across shards. If None, it is derived from `expected_num_docs`
+            and the dimensions of the vectors, or left to Elasticsearch. Existing
+            indices are resharded with `/reindex`.
+        :param number_of_replicas: Number of replicas of every shard of new indices. If
+            None, the default of Elasticsearch is used.
+        :param expected_num_docs: Expected number of documents, from which the default
+            number of shards is derived.
+        :param routing_tag: Tag whose value routes a document to a shard, e.g. the id
+            of a tenant. Searches and deletes whose filter requires the tag to equal
+            one or several values then only hit the shards of these values. The tag
+            should hold a single string per document, as other documents aren't routed
+            and routed searches miss them. Its value can't be changed with `/update`,
+            documents indexed again with another value move to the new shard.
+        :param snapshot_path: Directory of the filesystem repository of `/snapshot` and
+            `/restore`, which has to be listed in `path.repo` of Elasticsearch. Defaults
+            to the `snapshots` directory in the workspace, which is listed if the
+            indexer starts Elasticsearch.
         """
 
         super().__init__(*args, **kwargs)
@@ -79,8 +273,85 @@ class NOWElasticIndexer(Executor):
         self.max_values_per_tag = max_values_per_tag
         self.hosts = hosts
         self.index_name = index_name
+        self.max_queries_per_msearch = max_queries_per_msearch
+        if search_mode not in SEARCH_MODES:
+            raise ValueError(
+                f'Invalid search mode {search_mode}, must be one of {SEARCH_MODES}'
+            )
+        self.search_mode = search_mode
+        self.num_candidates = num_candidates
+        self.rescore_window_size = rescore_window_size
+        self.use_stored_script = use_stored_script
+        if serialization_format not in SERIALIZATION_FORMATS:
+            raise ValueError(
+                f'Invalid serialization format {serialization_format}, must be one of {SERIALIZATION_FORMATS}'
+            )
+        self.serialization_format = serialization_format
+        if vector_element_type not in VECTOR_ELEMENT_TYPES:
+            raise ValueError(
+                f'Invalid vector element type {vector_element_type}, must be one of {VECTOR_ELEMENT_TYPES}'
+            )
+        if vector_element_type == 'byte' and metric != 'cosine':
+            raise ValueError(
+                f'Vector element type byte is only supported with cosine metric, not {metric}'
+            )
+        self.vector_element_type = vector_element_type
+        self.bulk_thread_count = bulk_thread_count
+        self.bulk_chunk_size = bulk_chunk_size
+        self.bulk_max_chunk_bytes = bulk_max_chunk_bytes
+        if refresh_policy not in REFRESH_POLICIES:
+            raise ValueError(
+                f'Invalid refresh policy {refresh_policy}, must be one of {REFRESH_POLICIES}'
+            )
+        self.refresh_policy = refresh_policy
+        self.refresh_interval = refresh_interval
+        self.backfill_threshold = backfill_threshold
+        self._backfills = 0
+        self._backfill_lock = threading.Lock()
+        self.search_cache = SearchResultCache(
+            max_entries=search_cache_max_entries,
+            max_bytes=search_cache_max_bytes,
+            ttl=search_cache_ttl,
+        )
+        self.search_cache_sync_interval = search_cache_sync_interval
+        # generation of the search caches of all replicas this one is at
+        self._search_cache_generation = None
+        self.curated_index_name = f'{index_name}-curated'
+        self.build_alias = f'{index_name}-build'
+        self.fast_reindex = fast_reindex
+        self.max_old_index_versions = max_old_index_versions
+        self.number_of_shards = number_of_shards
+        self.number_of_replicas = number_of_replicas
+        self.expected_num_docs = expected_num_docs
+        self.routing_tag = routing_tag
+        # physical index and one routing value per shard of it, see `_get_shard_routings`
+        self._shard_routings: Tuple[Optional[str], List[str]] = (None, [])
+        self.snapshot_path = snapshot_path or (
+            os.path.join(self.workspace, 'snapshots') if self.workspace else None
+        )
+        self.snapshot_repository = f'{index_name}-snapshots'
         self.query_to_curated_ids = {}
-        self.doc_id_tags = {}
+        self._curation_lock = threading.Lock()
+        self.tag_index = TagValueIndex(
+            filter_fields=self.user_input.filter_fields or [],
+            max_values_per_tag=max_values_per_tag,
+        )
+        self.tag_reconciliation_interval = tag_reconciliation_interval
+        self.curation_sync_interval = curation_sync_interval
+        self._stop_periodic_tasks = threading.Event()
+        # ids of the background delete tasks, during which searches aren't cached
+        self._pending_delete_tasks = set()
+        self.decode_pool = (
+            ThreadPoolExecutor(max_workers=decode_thread_count)
+            if decode_thread_count > 1
+            else None
+        )
+        self.parallel_decode_min_bytes = parallel_decode_min_bytes
+        if pooling not in POOLING_STRATEGIES:
+            raise ValueError(
+                f'Invalid pooling {pooling}, must be one of {POOLING_STRATEGIES}'
+            )
+        self.pooling = pooling
         self.document_mappings = [FieldEmbedding(*dm) for dm in document_mappings]
         self.encoder_to_fields = {
             document_mapping.encoder: document_mapping.fields
@@ -90,17 +361,136 @@ class NOWElasticIndexer(Executor):
         self.es_mapping = es_mapping or self.generate_es_mapping()
         self.setup_elastic_server()
         self.es = Elasticsearch(hosts=self.hosts, **self.es_config, ssl_show_warn=False)
+        # used by the async request handlers, each concurrent request holds one
+        # connection while it waits for Elasticsearch
+        self.async_es = AsyncElasticsearch(
+            hosts=self.hosts,
+            **self.es_config,
+            ssl_show_warn=False,
+            connections_per_node=max_concurrency,
+        )
         wait_until_cluster_is_up(self.es, self.hosts)
 
         if not self.es.indices.exists(index=self.index_name):
-            self.es.indices.create(index=self.index_name, mappings=self.es_mapping)
+            self.es.indices.put_alias(
+                index=self._create_index_version(), name=self.index_name
+            )
+        else:
+            try:
+                # indices created before these fields existed need their mapping
+                self.es.indices.put_mapping(
+                    index=self.index_name,
+                    properties={
+                        'serialization_format': {'type': 'keyword'},
+                        'field_values': {'type': 'object', 'enabled': False},
+                    },
+                )
+            except Exception:
+                self.logger.info(traceback.format_exc())
+        if not self.es.indices.exists(index=self.curated_index_name):
+            # replicas starting at the same time might create it concurrently
+            self.es.options(ignore_status=400).indices.create(
+                index=self.curated_index_name,
+                mappings={
+                    'properties': {
+                        'query': {'type': 'keyword'},
+                        'ids': {'type': 'keyword', 'index': False},
+                        'generation': {'type': 'keyword', 'index': False},
+                    }
+                },
+            )
+        if self.use_stored_script:
+            self.es.put_script(
+                id=SEMANTIC_SCORE_SCRIPT_ID, script=SEMANTIC_SCORE_SCRIPT
+            )
+        self._index_version = self._get_current_indices()
+        self.update_tags()
+        self.sync_curated_ids()
+        self.sync_search_cache()
+        if self.tag_reconciliation_interval:
+            threading.Thread(
+                target=self._reconcile_tags_periodically, daemon=True
+            ).start()
+        if self.curation_sync_interval:
+            threading.Thread(
+                target=self._sync_curated_ids_periodically, daemon=True
+            ).start()
+        if self.search_cache.enabled and self.search_cache_sync_interval:
+            threading.Thread(
+                target=self._sync_search_cache_periodically, daemon=True
+            ).start()
+
+    def _get_index_settings(self) -> Dict:
+        settings = {}
+        number_of_shards = self.number_of_shards
+        if number_of_shards is None and self.expected_num_docs:
+            number_of_shards = get_default_number_of_shards(
+                self.expected_num_docs,
+                self.document_mappings,
+                self.vector_element_type,
+            )
+        if number_of_shards is not None:
+            settings['number_of_shards'] = number_of_shards
+        if self.number_of_replicas is not None:
+            settings['number_of_replicas'] = self.number_of_replicas
+        if self.refresh_interval is not None:
+            settings['refresh_interval'] = self.refresh_interval
+        return settings
+
+    def _get_index_versions(self) -> Dict[int, str]:
+        """Get the indices which store a version of the index by their version."""
+        versions = {}
+        for index in self.es.indices.get(index=f'{self.index_name}-v*'):
+            match = re.fullmatch(rf'{re.escape(self.index_name)}-v(\d+)', index)
+            if match:
+                versions[int(match.group(1))] = index
+        return versions
+
+    def _get_next_index_version(self) -> str:
+        """Get the name of the index for the next version."""
+        return f'{self.index_name}-v{max(self._get_index_versions(), default=0) + 1}'
+
+    def _create_index_version(self, settings: Optional[Dict] = None) -> str:
+        """Create an index for the next version with the mapping and settings of the
+        indexer. The alias isn't changed.
+
+        :param settings: settings which override the ones of the indexer
+        :return: name of the created index
+        """
+        index = self._get_next_index_version()
+        # replicas starting at the same time might create it concurrently
+        self.es.options(ignore_status=400).indices.create(
+            index=index,
+            mappings=self.es_mapping,
+            settings={**self._get_index_settings(), **(settings or {})},
+        )
+        return index
+
+    def _get_build_index(self) -> Optional[str]:
+        """Get the index into which `/reindex` copies the documents, or None if the
+        index isn't rebuilt. The state is kept in Elasticsearch, so that all replicas
+        see it."""
+        if not self.es.indices.exists_alias(name=self.build_alias):
+            return None
+        return next(iter(self.es.indices.get_alias(name=self.build_alias)), None)
+
+    def _check_no_build(self):
+        if self._get_build_index():
+            raise ValueError(
+                'The index is being rebuilt, documents can be updated and deleted once the reindex is done.'
+            )
 
     def setup_elastic_server(self):
         try:
             if "K8S_NAMESPACE_NAME" in os.environ:
+                workspace = f'/data/{os.environ["K8S_NAMESPACE_NAME"]}'
+                self.snapshot_path = self.snapshot_path or os.path.join(
+                    workspace, 'snapshots'
+                )
                 self.configure_elastic(
-                    f'/data/{os.environ["K8S_NAMESPACE_NAME"]}',
+                    workspace,
                     '/usr/share/elasticsearch/config/elasticsearch.yml',
+                    self.snapshot_path,
                 )
                 subprocess.Popen(['./start-elastic-search-cluster.sh'])
                 self.logger.info('elastic server started')
@@ -110,13 +500,15 @@ class NOWElasticIndexer(Executor):
             )
 
     @staticmethod
-    def configure_elastic(workspace, destination_path):
+    def configure_elastic(workspace, destination_path, snapshot_path=None):
         config_path = os.path.join(os.path.dirname(__file__), 'elasticsearch.yml')
+        snapshot_path = snapshot_path or os.path.join(workspace, 'snapshots')
         with open(config_path, 'r') as config_file_handler, open(
             destination_path, 'w'
         ) as destination_file_handler:
             for line in config_file_handler.readlines():
                 line = line.replace("{workspace}", workspace)
+                line = line.replace("{snapshot_path}", snapshot_path)
                 destination_file_handler.write(line)
 
     def generate_es_mapping(self) -> Dict:
@@ -125,6 +517,9 @@ class NOWElasticIndexer(Executor):
             'properties': {
                 'id': {'type': 'keyword'},
                 'bm25_text': {'type': 'text', 'analyzer': 'standard'},
+                'serialized_doc': {'type': 'binary', 'doc_values': False},
+                'serialization_format': {'type': 'keyword'},
+                'field_values': {'type': 'object', 'enabled': False},
             }
         }
 
@@ -147,6 +542,10 @@ class NOWElasticIndexer(Executor):
                         }
                     }
                 }
+                if self.vector_element_type == 'byte':
+                    es_mapping['properties'][f'{field}-{encoder}']['properties'][
+                        'embedding'
+                    ]['element_type'] = 'byte'
         return es_mapping
 
     def _handle_no_docs_map(self, docs: DocumentArray):
@@ -168,27 +567,312 @@ class NOWElasticIndexer(Executor):
 
         :param docs_map: map of encoder to DocumentArray
         :param parameters: dictionary with options for indexing.
+            Keys accepted:
+                - 'refresh_policy' (str): 'immediate', 'interval' or 'wait_for'. Defaults
+                    to the `refresh_policy` of the indexer. 'immediate' and 'wait_for'
+                    make the documents searchable once the request returns.
         :param docs: DocumentArray to index
-        :return: empty `DocumentArray`.
+        :return: empty `DocumentArray`, or a `DocumentArray` with a single `Document`
+            holding the documents which failed to be indexed in its tags.
         """
         if docs_map is None:
             docs_map = self._handle_no_docs_map(docs)
             if len(docs_map) == 0:
                 return DocumentArray()
-        aggregate_embeddings(docs_map)
-        es_docs = convert_doc_map_to_es(
-            docs_map, self.index_name, self.encoder_to_fields
+        aggregate_embeddings(docs_map, self.pooling)
+        refresh_policy = self._get_refresh_policy(parameters)
+        written_tags = {doc.id: doc.tags for docs in docs_map.values() for doc in docs}
+        num_docs = max(len(docs) for docs in docs_map.values())
+        # documents are created rather than overwritten, so that only the documents
+        # which already exist are rejected and have to be read before overwriting them
+        success, errors = self._write(
+            self._get_index_actions(docs_map, op_type='create'),
+            refresh_policy,
+            num_docs,
         )
-        success, _ = bulk(self.es, es_docs)
-        self.es.indices.refresh(index=self.index_name)
+        overwritten_ids = {
+            error['id'] for error in errors if is_version_conflict(error['error'])
+        }
+        # the tag values of overwritten documents are released once they are replaced
+        overwritten_tags = {}
+        if overwritten_ids:
+            errors = [error for error in errors if error['id'] not in overwritten_ids]
+            overwritten_tags = self._get_overwritten_tags(
+                {
+                    doc_id: get_routing(written_tags[doc_id], self.routing_tag)
+                    for doc_id in overwritten_ids
+                }
+            )
+            overwrite_success, overwrite_errors = self._write(
+                self._get_index_actions(
+                    {
+                        encoder: DocumentArray(
+                            [doc for doc in docs if doc.id in overwritten_ids]
+                        )
+                        for encoder, docs in docs_map.items()
+                    },
+                    op_type='index',
+                ),
+                refresh_policy,
+                len(overwritten_ids),
+            )
+            success += overwrite_success
+            errors += overwrite_errors
+        stale_tags = {}
+        if self.routing_tag:
+            # old copies are only deleted once the document is written
+            failed_ids = {error['id'] for error in errors}
+            stale_tags, stale_errors = self._delete_stale_copies(
+                {
+                    doc_id: tags
+                    for doc_id, tags in written_tags.items()
+                    if doc_id not in failed_ids
+                },
+                refresh_policy,
+            )
+            errors += stale_errors
+        self._refresh_after_write(refresh_policy)
+        self.invalidate_search_cache()
         if success:
             self.logger.info(
                 f'Inserted {success} documents into Elasticsearch index {self.index_name}'
             )
-        self.update_tags()
+        failed_ids = {error['id'] for error in errors}
+        for doc_id, tags in written_tags.items():
+            if doc_id not in failed_ids:
+                for old_tags in [overwritten_tags, stale_tags]:
+                    if doc_id in old_tags:
+                        self.tag_index.remove(old_tags[doc_id])
+                self.tag_index.add(tags)
+        if errors:
+            self.logger.info(
+                f'Failed to insert {len(errors)} documents into Elasticsearch index {self.index_name}'
+            )
+            return DocumentArray(
+                [Document(text='index_errors', tags={'index_errors': errors})]
+            )
         return DocumentArray([])
 
-    @secure_request(on='/search', level=SecurityLevel.USER)
+    def _get_index_actions(
+        self, docs_map: Dict[str, DocumentArray], op_type: str
+    ) -> Iterator[Dict]:
+        """Convert the documents into bulk actions of the given type, routed by their
+        `routing_tag`."""
+        for es_doc in convert_doc_map_to_es(
+            docs_map,
+            self.index_name,
+            self.encoder_to_fields,
+            serialization_format=self.serialization_format,
+            vector_element_type=self.vector_element_type,
+        ):
+            routing = get_routing(es_doc.get('tags', {}), self.routing_tag)
+            yield {
+                **es_doc,
+                '_op_type': op_type,
+                **({'_routing': routing} if routing else {}),
+            }
+
+    def _write(
+        self, actions: Iterable[Dict], refresh_policy: str, num_docs: int
+    ) -> Tuple[int, List[Dict]]:
+        """Send bulk actions of `/index` to Elasticsearch, as a backfill if there are at
+        least `backfill_threshold` documents and refreshes are left to the interval.
+        While the index is rebuilt, the actions are applied to the new version, too.
+
+        :param actions: iterable of bulk actions, consumed lazily
+        :param refresh_policy: refresh policy of the request
+        :param num_docs: number of documents which are written
+        :return: number of successful actions and list of errors, see `_bulk`
+        """
+        build_index = self._get_build_index()
+        if build_index:
+            # documents are written to the new version as well, the copy doesn't
+            # overwrite them as it only creates documents
+            actions = (
+                action
+                for es_doc in actions
+                for action in [
+                    es_doc,
+                    {
+                        **es_doc,
+                        '_index': build_index,
+                        **(
+                            {'_op_type': 'index'}
+                            if es_doc['_op_type'] == 'create'
+                            else {}
+                        ),
+                    },
+                ]
+            )
+        if refresh_policy == 'interval' and num_docs >= self.backfill_threshold:
+            with self._backfill():
+                success, errors = self._bulk(actions)
+        else:
+            success, errors = self._bulk(
+                actions, refresh=self._get_write_refresh(refresh_policy)
+            )
+        # stale copies might not have been copied into the new version yet
+        return success, [error for error in errors if error['error'] != 'not_found']
+
+    def _get_overwritten_tags(self, routings: Dict[str, Optional[str]]) -> Dict:
+        """Fetch the tags of documents which are about to be overwritten, with realtime
+        mget requests to the shard of their routing.
+
+        :param routings: dictionary mapping the ids of the documents to their routing
+        :return: dictionary mapping the id to the tags, for the documents which exist
+        """
+        ids = list(routings)
+        tags = {}
+        for start in range(0, len(ids), MAX_IDS_PER_MGET):
+            resp = self.es.mget(
+                index=self.index_name,
+                docs=[
+                    {
+                        '_id': doc_id,
+                        **({'routing': routings[doc_id]} if routings[doc_id] else {}),
+                    }
+                    for doc_id in ids[start : start + MAX_IDS_PER_MGET]
+                ],
+                _source=['tags'],
+            )
+            for es_doc in resp['docs']:
+                if es_doc.get('found'):
+                    tags[es_doc['_id']] = es_doc['_source'].get('tags', {})
+        return tags
+
+    def _delete_stale_copies(
+        self, written_tags: Dict[str, Dict], refresh_policy: str
+    ) -> Tuple[Dict[str, Dict], List[Dict]]:
+        """Delete the copies of written documents which were routed by another value of
+        the `routing_tag`, and so stay on the shard of the old value. They are found
+        with one search per `MAX_IDS_PER_MGET / 2` ids, which only sees copies which
+        were refreshed, as they are with the 'immediate' and 'wait_for' refresh policies.
+
+        :param written_tags: dictionary mapping the ids of the written documents to
+            their tags
+        :param refresh_policy: refresh policy of the request
+        :return: dictionary mapping the ids to the tags of their deleted copies, and
+            list of errors
+        """
+        ids = list(written_tags)
+        stale_copies = []
+        # each id can be found twice, the new document and its old copy
+        chunk_size = MAX_IDS_PER_MGET // 2
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start : start + chunk_size]
+            resp = self.es.search(
+                index=self.index_name,
+                query={'ids': {'values': chunk}},
+                _source=['tags'],
+                size=2 * len(chunk),
+            )
+            stale_copies += [
+                hit
+                for hit in resp['hits']['hits']
+                if hit.get('_routing')
+                != get_routing(written_tags[hit['_id']], self.routing_tag)
+            ]
+        if not stale_copies:
+            return {}, []
+        _, errors = self._write(
+            (
+                get_delete_action(self.index_name, hit['_id'], hit.get('_routing'))
+                for hit in stale_copies
+            ),
+            refresh_policy,
+            len(stale_copies),
+        )
+        return {
+            hit['_id']: hit['_source'].get('tags', {}) for hit in stale_copies
+        }, errors
+
+    def _bulk(
+        self, actions: Iterable[Dict], refresh: Optional[str] = None
+    ) -> Tuple[int, List[Dict]]:
+        """Stream bulk actions to Elasticsearch, in parallel if `bulk_thread_count`
+        is larger than 1.
+
+        :param actions: iterable of bulk actions, consumed lazily
+        :param refresh: `refresh` argument of every bulk request, e.g. 'wait_for'
+        :return: number of successful actions and list of errors, each with the id
+            of the document and the error reported by Elasticsearch
+        """
+        kwargs = {'refresh': refresh} if refresh else {}
+        if self.bulk_thread_count > 1:
+            results = parallel_bulk(
+                self.es,
+                actions,
+                thread_count=self.bulk_thread_count,
+                chunk_size=self.bulk_chunk_size,
+                max_chunk_bytes=self.bulk_max_chunk_bytes,
+                raise_on_error=False,
+                **kwargs,
+            )
+        else:
+            results = streaming_bulk(
+                self.es,
+                actions,
+                chunk_size=self.bulk_chunk_size,
+                max_chunk_bytes=self.bulk_max_chunk_bytes,
+                raise_on_error=False,
+                **kwargs,
+            )
+        success, errors = 0, []
+        for ok, item in results:
+            if ok:
+                success += 1
+            else:
+                op_result = next(iter(item.values()))
+                errors.append(
+                    {
+                        'id': op_result.get('_id'),
+                        'error': op_result.get('error', op_result.get('result')),
+                    }
+                )
+        return success, errors
+
+    def _get_refresh_policy(self, parameters: Dict) -> str:
+        refresh_policy = parameters.get('refresh_policy') or self.refresh_policy
+        if refresh_policy not in REFRESH_POLICIES:
+            raise ValueError(
+                f'Invalid refresh policy {refresh_policy}, must be one of {REFRESH_POLICIES}'
+            )
+        return refresh_policy
+
+    def _get_write_refresh(self, refresh_policy: str) -> Optional[str]:
+        """`refresh` argument for write requests. Writes don't wait for a refresh
+        while refreshes are disabled by a backfill, as they would never return."""
+        if refresh_policy == 'wait_for' and not self._backfills:
+            return 'wait_for'
+        return None
+
+    def _refresh_after_write(self, refresh_policy: str):
+        if refresh_policy == 'immediate':
+            self.es.indices.refresh(index=self.index_name)
+
+    @contextmanager
+    def _backfill(self):
+        """Disable periodic refreshes of the index while a large number of documents
+        is written, and restore the `refresh_interval` afterwards. Writing without
+        refreshes avoids creating many small segments which have to be merged."""
+        with self._backfill_lock:
+            if not self._backfills:
+                self.es.indices.put_settings(
+                    index=self.index_name, settings={'refresh_interval': '-1'}
+                )
+            self._backfills += 1
+        try:
+            yield
+        finally:
+            with self._backfill_lock:
+                self._backfills -= 1
+                if not self._backfills:
+                    self.es.indices.put_settings(
+                        index=self.index_name,
+                        settings={'refresh_interval': self.refresh_interval},
+                    )
+                    self.es.indices.refresh(index=self.index_name)
+
     def search(
         self,
         docs_map: Dict[str, DocumentArray] = None,  # encoder to docarray
@@ -218,13 +902,70 @@ class NOWElasticIndexer(Executor):
                     be ignored if 'custom_bm25_query' is specified.
                 - 'custom_bm25_query' (dict): Custom query to use for BM25. Note: this query can only be
                     passed if also passing `es_mapping`. Otherwise, only default bm25 scoring is enabled.
+                - 'search_mode' (str): 'exact' to score all documents with a script, 'approximate'
+                    to use kNN search or 'rescore' to rescore kNN candidates with the exact script.
+                    Defaults to the `search_mode` of the indexer.
+                - 'num_candidates' (int or dict): Number of candidates per shard for approximate
+                    search. Defaults to the `num_candidates` of the indexer.
+                - 'rescore_window_size' (int): Number of candidates per shard to rescore in 'rescore'
+                    search mode. Defaults to the `rescore_window_size` of the indexer.
+                - 'lightweight_matches' (bool): Whether to return matches which only hold the id,
+                    scores, tags and the text or uri of every field, without deserializing the
+                    stored documents. Default is False.
         :param docs: DocumentArray to search
         """
+        prepared_search = self._prepare_search(docs_map, parameters, docs)
+        if prepared_search is None:
+            return DocumentArray()
+        es_results = self._msearch(
+            prepared_search.es_bodies, routing=prepared_search.routing
+        )
+        return self._complete_search(prepared_search, es_results, parameters)
+
+    @secure_request(on='/search', level=SecurityLevel.USER)
+    async def async_search(
+        self,
+        docs_map: Dict[str, DocumentArray] = None,  # encoder to docarray
+        parameters: dict = {},
+        docs: Optional[DocumentArray] = None,
+        **kwargs,
+    ):
+        """Handler of the `/search` endpoint, see `search` for the parameters. The
+        `_msearch` requests are sent with the async client, concurrently for all
+        batches, so that the event loop serves other requests while Elasticsearch
+        answers. Building the queries and decoding the matches is CPU bound and runs
+        in the default thread pool of the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        prepared_search = await loop.run_in_executor(
+            None, self._prepare_search, docs_map, parameters, docs
+        )
+        if prepared_search is None:
+            return DocumentArray()
+        es_results = await self._async_msearch(
+            prepared_search.es_bodies, routing=prepared_search.routing
+        )
+        return await loop.run_in_executor(
+            None, self._complete_search, prepared_search, es_results, parameters
+        )
+
+    def _prepare_search(
+        self,
+        docs_map: Optional[Dict[str, DocumentArray]],
+        parameters: dict,
+        docs: Optional[DocumentArray],
+    ) -> Optional[PreparedSearch]:
+        """Build the Elasticsearch queries of a search request and answer the queries
+        which are cached.
+
+        :return: the queries and the bodies of the uncached queries, or None if there
+            is nothing to search
+        """
         if docs_map is None:
             docs_map = self._handle_no_docs_map(docs)
             if len(docs_map) == 0:
-                return DocumentArray()
-        aggregate_embeddings(docs_map)
+                return None
+        aggregate_embeddings(docs_map, self.pooling)
 
         limit = parameters.get('limit', self.limit)
         get_score_breakdown = parameters.get('get_score_breakdown', False)
@@ -234,30 +975,150 @@ class NOWElasticIndexer(Executor):
         if not semantic_scores:
             semantic_scores = generate_semantic_scores(docs_map, self.encoder_to_fields)
         filter = parameters.get('filter', {})
-        es_queries = build_es_queries(
-            docs_map=docs_map,
-            apply_default_bm25=apply_default_bm25,
-            get_score_breakdown=get_score_breakdown,
+        lightweight_matches = parameters.get('lightweight_matches', False)
+        # the mapping is replaced, not modified, when curated results change
+        query_to_curated_ids = self.query_to_curated_ids
+        search_mode = parameters.get('search_mode') or self.search_mode
+        if search_mode == 'approximate':
+            es_queries = build_es_knn_queries(
+                docs_map=docs_map,
+                apply_default_bm25=apply_default_bm25,
+                get_score_breakdown=get_score_breakdown,
+                semantic_scores=semantic_scores,
+                limit=limit,
+                num_candidates=parameters.get('num_candidates', self.num_candidates),
+                custom_bm25_query=custom_bm25_query,
+                filter=filter,
+                query_to_curated_ids=query_to_curated_ids,
+                vector_element_type=self.vector_element_type,
+            )
+        elif search_mode == 'rescore':
+            es_queries = build_es_rescore_queries(
+                docs_map=docs_map,
+                apply_default_bm25=apply_default_bm25,
+                get_score_breakdown=get_score_breakdown,
+                semantic_scores=semantic_scores,
+                limit=limit,
+                window_size=parameters.get(
+                    'rescore_window_size', self.rescore_window_size
+                ),
+                num_candidates=parameters.get('num_candidates', self.num_candidates),
+                custom_bm25_query=custom_bm25_query,
+                metric=self.metric,
+                filter=filter,
+                query_to_curated_ids=query_to_curated_ids,
+                stored_script=self.use_stored_script,
+                vector_element_type=self.vector_element_type,
+            )
+        elif search_mode == 'exact':
+            es_queries = [
+                (doc, {'query': query})
+                for doc, query in build_es_queries(
+                    docs_map=docs_map,
+                    apply_default_bm25=apply_default_bm25,
+                    get_score_breakdown=get_score_breakdown,
+                    semantic_scores=semantic_scores,
+                    custom_bm25_query=custom_bm25_query,
+                    metric=self.metric,
+                    filter=filter,
+                    query_to_curated_ids=query_to_curated_ids,
+                    stored_script=self.use_stored_script,
+                    vector_element_type=self.vector_element_type,
+                )
+            ]
+        else:
+            raise ValueError(
+                f'Invalid search mode {search_mode}, must be one of {SEARCH_MODES}'
+            )
+        cache_generation = self.search_cache.generation
+        cache_parameters = {
+            'limit': limit,
+            'get_score_breakdown': get_score_breakdown,
+            'custom_bm25_query': custom_bm25_query,
+            'apply_default_bm25': apply_default_bm25,
+            'semantic_scores': semantic_scores,
+            'filter': filter,
+            'search_mode': search_mode,
+            'num_candidates': parameters.get('num_candidates', self.num_candidates),
+            'rescore_window_size': parameters.get(
+                'rescore_window_size', self.rescore_window_size
+            ),
+            'lightweight_matches': lightweight_matches,
+        }
+        uncached_queries = []
+        for doc, body in es_queries:
+            cache_key = None
+            if self.search_cache.enabled and not self._pending_delete_tasks:
+                cache_key = get_search_cache_key(
+                    docs_map,
+                    doc.id,
+                    {
+                        **cache_parameters,
+                        'pinned': get_pinned_query(doc, query_to_curated_ids),
+                    },
+                )
+                cached_matches = self.search_cache.get(cache_key)
+                if cached_matches is not None:
+                    doc.matches = DocumentArray.from_bytes(cached_matches)
+                    continue
+            uncached_queries.append((doc, body, cache_key))
+        es_bodies = []
+        for doc, body, _ in uncached_queries:
+            # only the serialized document is needed, score breakdowns are
+            # computed by Elasticsearch instead of fetching the embeddings
+            body = {
+                **body,
+                'size': limit,
+                '_source': ['field_values', 'tags']
+                if lightweight_matches
+                else ['serialized_doc', 'serialization_format', 'tags'],
+            }
+            if get_score_breakdown:
+                body['script_fields'] = get_score_breakdown_script_fields(
+                    doc, semantic_scores, self.metric
+                )
+            es_bodies.append(body)
+        return PreparedSearch(
+            es_queries=es_queries,
+            uncached_queries=uncached_queries,
+            es_bodies=es_bodies,
             semantic_scores=semantic_scores,
-            custom_bm25_query=custom_bm25_query,
-            metric=self.metric,
-            filter=filter,
-            query_to_curated_ids=self.query_to_curated_ids,
+            cache_generation=cache_generation,
+            routing=get_filter_routing(filter, self.routing_tag),
         )
-        for doc, query in es_queries:
-            result = self.es.search(
-                index=self.index_name,
-                query=query,
-                source=True,
-                size=limit,
-            )['hits']['hits']
+
+    def _complete_search(
+        self,
+        prepared_search: PreparedSearch,
+        es_results: List[List[Dict]],
+        parameters: dict,
+    ) -> DocumentArray:
+        """Convert the hits of the uncached queries to matches and cache them.
+
+        :return: the query documents with their matches
+        """
+        get_score_breakdown = parameters.get('get_score_breakdown', False)
+        lightweight_matches = parameters.get('lightweight_matches', False)
+        semantic_scores = prepared_search.semantic_scores
+        es_queries = prepared_search.es_queries
+        for (doc, _, cache_key), result in zip(
+            prepared_search.uncached_queries, es_results
+        ):
             doc.matches = convert_es_results_to_matches(
                 query_doc=doc,
                 es_results=result,
                 get_score_breakdown=get_score_breakdown,
                 metric=self.metric,
                 semantic_scores=semantic_scores,
+                lightweight=lightweight_matches,
+                pool=self.decode_pool,
+                parallel_decode_min_bytes=self.parallel_decode_min_bytes,
             )
+            if cache_key:
+                self.search_cache.put(
+                    cache_key, doc.matches.to_bytes(), prepared_search.cache_generation
+                )
+        for doc, _ in es_queries:
             doc.tags.pop('embeddings')
             for c in doc.chunks:
                 c.embedding = None
@@ -266,71 +1127,484 @@ class NOWElasticIndexer(Executor):
             parameters.get('create_temp_link', False)
             and self.user_input.dataset_type == DatasetTypes.S3_BUCKET
         ):
-            self._create_temporary_links(results)
+            create_temporary_links(results, self.user_input)
 
         return results
 
-    def _create_temporary_links(self, docs: DocumentArray):
-        """For every match, it replaces the URI with a temporary link such that no credentials are needed for access."""
+    def _msearch(
+        self, bodies: List[Dict], routing: Optional[str] = None
+    ) -> List[List[Dict]]:
+        """Run search bodies against the index with as few `_msearch` round trips
+        as possible, sending at most `max_queries_per_msearch` bodies per request.
 
-        def _create_temp_link(d: Document) -> Document:
-            if (
-                not d.text
-                and not d.blob
-                and isinstance(d.uri, str)
-                and d.uri.startswith('s3://')
-            ):
-                session = boto3.session.Session(
-                    aws_access_key_id=self.user_input.aws_access_key_id,
-                    aws_secret_access_key=self.user_input.aws_secret_access_key,
-                    region_name=self.user_input.aws_region_name,
-                )
-                s3_client = session.client('s3')
-                bucket_name = d.uri.split('/')[2]
-                path_s3 = '/'.join(d.uri.split('/')[3:])
-                temp_url = s3_client.generate_presigned_url(
-                    'get_object',
-                    Params={'Bucket': bucket_name, 'Key': path_s3},
-                    ExpiresIn=300,
+        :param bodies: list of search request bodies
+        :param routing: routing of all searches, to only search the shards it routes to
+        :return: list of hits for each body, in the same order as `bodies`
+        """
+        header = {'routing': routing} if routing else {}
+        results = []
+        for i in range(0, len(bodies), self.max_queries_per_msearch):
+            searches = []
+            for body in bodies[i : i + self.max_queries_per_msearch]:
+                searches.extend([header, body])
+            results.extend(
+                get_msearch_hits(
+                    self.es.msearch(index=self.index_name, searches=searches)
                 )
-                d.uri = temp_url
-            return d
+            )
+        return results
 
-        for d in docs['@mc,mcc']:
-            _create_temp_link(d)
+    async def _async_msearch(
+        self, bodies: List[Dict], routing: Optional[str] = None
+    ) -> List[List[Dict]]:
+        """Like `_msearch`, but with the async client, which sends the `_msearch`
+        requests of all batches concurrently.
+
+        :param bodies: list of search request bodies
+        :param routing: routing of all searches, to only search the shards it routes to
+        :return: list of hits for each body, in the same order as `bodies`
+        """
+        header = {'routing': routing} if routing else {}
+        msearches = []
+        for i in range(0, len(bodies), self.max_queries_per_msearch):
+            searches = []
+            for body in bodies[i : i + self.max_queries_per_msearch]:
+                searches.extend([header, body])
+            msearches.append(
+                self.async_es.msearch(index=self.index_name, searches=searches)
+            )
+        results = []
+        for responses in await asyncio.gather(*msearches):
+            results.extend(get_msearch_hits(responses))
+        return results
 
     @secure_request(on='/update', level=SecurityLevel.USER)
-    def update(self, docs: DocumentArray, **kwargs) -> DocumentArray:
+    def update(
+        self,
+        docs_map: Dict[str, DocumentArray] = None,  # encoder to docarray
+        parameters: dict = {},
+        docs: Optional[DocumentArray] = None,
+        **kwargs,
+    ) -> DocumentArray:
         """
-        TODO: implement update endpoint, eg. update ES docs with new embeddings etc.
+        Partially update indexed `Document`s, which are identified by their ids. Only the
+        given changes are written with bulk update actions:
+            - tags: the tags of a document are merged into the indexed tags. Documents
+                without chunks only update tags and don't need to be encoded, so they
+                can be sent to the indexer directly with `target_executor`. The value
+                of the `routing_tag` can't be changed, as it determines the shard.
+            - embeddings: the embeddings of the fields of a document replace the
+                indexed embeddings of these fields for the encoder.
+            - content: if the text or uri of a field differs from the indexed one, the
+                field is replaced in the stored document and the bm25 text is rebuilt.
+        Fields which are not part of a document and the vectors of other encoders
+        are left untouched.
+
+        :param docs_map: map of encoder to DocumentArray
+        :param parameters: dictionary with options for updating, e.g. 'refresh_policy'.
+        :param docs: DocumentArray to update
+        :return: empty `DocumentArray`, or a `DocumentArray` with a single `Document`
+            holding the documents which failed to be updated in its tags.
         """
-        raise NotImplementedError()
+        if docs_map is None:
+            docs_map = self._handle_no_docs_map(docs)
+        if not docs_map:
+            docs_map = {None: docs} if docs else {}
+        refresh_policy = self._get_refresh_policy(parameters)
+        self._check_no_build()
+        aggregate_embeddings(docs_map, self.pooling)
+
+        partial_docs = {}
+        for documents in docs_map.values():
+            for doc in documents:
+                if doc.tags:
+                    partial_docs.setdefault(doc.id, {})['tags'] = {
+                        k: v for k, v in doc.tags.items() if k != 'embeddings'
+                    }
+        content_ids = list(
+            dict.fromkeys(
+                doc.id
+                for encoder, documents in docs_map.items()
+                if encoder in self.encoder_to_fields
+                for doc in documents
+                if doc.chunks
+            )
+        )
+        stored_docs = self._get_stored_docs(content_ids)
+        stored_tags = self._get_stored_tags(
+            [
+                doc_id
+                for doc_id, partial_doc in partial_docs.items()
+                if 'tags' in partial_doc
+            ]
+        )
+        changed_content_ids = set()
+        for encoder, documents in docs_map.items():
+            if encoder not in self.encoder_to_fields:
+                continue
+            for doc in documents:
+                if not doc.chunks or doc.id not in stored_docs:
+                    continue
+                partial_doc = partial_docs.setdefault(doc.id, {})
+                schema = doc._metadata.get('multi_modal_schema', {})
+                for field in self.encoder_to_fields[encoder]:
+                    if field not in schema:
+                        continue
+                    field_doc = getattr(doc, field)
+                    embedding = field_doc.embedding
+                    if embedding is not None:
+                        if self.vector_element_type == 'byte':
+                            embedding = quantize_embedding(embedding)
+                        partial_doc[f'{field}-{encoder}.embedding'] = embedding
+                    stored_field_doc = getattr(stored_docs[doc.id], field)
+                    if (field_doc.text, field_doc.uri) != (
+                        stored_field_doc.text,
+                        stored_field_doc.uri,
+                    ):
+                        stored_field_doc.content = field_doc.content
+                        stored_field_doc.uri = field_doc.uri
+                        changed_content_ids.add(doc.id)
+        for doc_id in changed_content_ids:
+            stored_doc = stored_docs[doc_id]
+            partial_docs[doc_id].update(
+                get_es_text_fields(stored_doc, self.encoder_to_fields)
+            )
+            partial_docs[doc_id]['serialized_doc'] = serialize_doc(
+                stored_doc, self.serialization_format
+            )
+            partial_docs[doc_id]['serialization_format'] = self.serialization_format
+            partial_docs[doc_id]['field_values'] = get_field_values(stored_doc)
+
+        routings = self._get_stored_routings(list(partial_docs))
+        for doc_id, tags in stored_tags.items():
+            new_tags = {**tags, **partial_docs[doc_id]['tags']}
+            if get_routing(new_tags, self.routing_tag) != routings.get(doc_id):
+                raise ValueError(
+                    f'Updating the {self.routing_tag} tag of document {doc_id} would move it to another shard, index the document again instead.'
+                )
+        success, errors = self._bulk(
+            (
+                {
+                    '_op_type': 'update',
+                    '_index': self.index_name,
+                    '_id': doc_id,
+                    'doc': partial_doc,
+                    **({'_routing': routings[doc_id]} if doc_id in routings else {}),
+                }
+                for doc_id, partial_doc in partial_docs.items()
+                if partial_doc
+            ),
+            refresh=self._get_write_refresh(refresh_policy),
+        )
+        self._refresh_after_write(refresh_policy)
+        self.invalidate_search_cache()
+        if success:
+            self.logger.info(
+                f'Updated {success} documents in Elasticsearch index {self.index_name}'
+            )
+        failed_ids = {error['id'] for error in errors}
+        for doc_id, tags in stored_tags.items():
+            if doc_id not in failed_ids:
+                self.tag_index.remove(tags)
+                self.tag_index.add({**tags, **partial_docs[doc_id]['tags']})
+        if errors:
+            self.logger.info(
+                f'Failed to update {len(errors)} documents in Elasticsearch index {self.index_name}'
+            )
+            return DocumentArray(
+                [Document(text='update_errors', tags={'update_errors': errors})]
+            )
+        return DocumentArray([])
+
+    def _get_stored_tags(self, ids: List[str]) -> Dict[str, Dict]:
+        """Fetch the tags of the given ids with a single request.
+
+        :param ids: ids of the documents
+        :return: dictionary mapping the id to the tags, for the documents which exist
+        """
+        return {
+            es_doc['_id']: es_doc['_source'].get('tags', {})
+            for es_doc in self._get_stored(ids, ['tags'])
+        }
+
+    def _get_stored_docs(self, ids: List[str]) -> Dict[str, Document]:
+        """Fetch the stored documents of the given ids with a single request.
+
+        :param ids: ids of the documents
+        :return: dictionary mapping the id to the document, for the documents which exist
+        """
+        return {
+            es_doc['_id']: deserialize_doc(es_doc['_source'])
+            for es_doc in self._get_stored(
+                ids, ['serialized_doc', 'serialization_format']
+            )
+        }
+
+    def _get_stored_routings(self, ids: List[str]) -> Dict[str, str]:
+        """Fetch the routing of the given ids, for the documents which were routed by
+        their `routing_tag`.
+
+        :param ids: ids of the documents
+        :return: dictionary mapping the id to the routing
+        """
+        if not self.routing_tag:
+            return {}
+        return {
+            es_doc['_id']: es_doc['_routing']
+            for es_doc in self._get_stored(ids, False)
+            if '_routing' in es_doc
+        }
+
+    def _get_stored(self, ids: List[str], source: Union[List[str], bool]) -> List[Dict]:
+        """Fetch the given ids with realtime mget requests of at most
+        `MAX_IDS_PER_MGET` ids, which also find documents that aren't refreshed yet.
+        The shard of a routed document can't be derived from its id, so if
+        `routing_tag` is set, the ids are fetched from every shard.
+
+        :param ids: ids of the documents
+        :param source: fields of `_source` to fetch
+        :return: list of the documents which exist, with `_id`, `_source` and
+            `_routing` if they were routed
+        """
+        if not ids:
+            return []
+        routings = self._get_shard_routings() if self.routing_tag else [None]
+        stored = {}
+        for start in range(0, len(ids), MAX_IDS_PER_MGET):
+            for routing in routings:
+                resp = self.es.mget(
+                    index=self.index_name,
+                    ids=ids[start : start + MAX_IDS_PER_MGET],
+                    _source=source,
+                    **({'routing': routing} if routing else {}),
+                )
+                for es_doc in resp['docs']:
+                    if es_doc.get('found'):
+                        stored[es_doc['_id']] = es_doc
+        return list(stored.values())
+
+    def _get_shard_routings(self) -> List[str]:
+        """Get one routing value per shard of the index, with which a get request
+        reaches the shard. A get finds a document on the shard it is sent to, whatever
+        its routing. The values are cached for the current version of the index.
+        """
+        index = get_routed_shard(
+            self.es.search_shards(index=self.index_name, routing='0')
+        )['index']
+        cached_index, routings = self._shard_routings
+        if index != cached_index:
+            num_shards = len(self.es.search_shards(index=index)['shards'])
+            shard_to_routing = {}
+            candidate = 0
+            while len(shard_to_routing) < num_shards:
+                shard = get_routed_shard(
+                    self.es.search_shards(index=index, routing=str(candidate))
+                )['shard']
+                shard_to_routing.setdefault(shard, str(candidate))
+                candidate += 1
+            routings = list(shard_to_routing.values())
+            self._shard_routings = (index, routings)
+        return routings
 
-    @secure_request(on='/list', level=SecurityLevel.USER)
     def list(self, parameters: dict = {}, **kwargs):
-        """List all indexed documents.
+        """List indexed documents.
 
-        Note: this implementation is naive and does not
-        consider the default maximum documents in a page returned by `Elasticsearch`.
-        Should be addressed in future with `scroll`.
+        Documents are either paged with limit and offset, which is only possible for
+        the first `index.max_result_window` documents and gets slower with the offset,
+        or with a cursor. Cursor pagination keeps a point in time of the index open
+        and continues after the last document of the previous page, so that all
+        documents can be listed consistently.
 
-        :param parameters: dictionary with limit and offset
+        :param parameters: dictionary with limit and offset or cursor
         - offset (int): number of documents to skip
         - limit (int): number of retrieved documents
+        - cursor (str): cursor returned with the previous page. Pass an empty string
+            to start listing with a cursor.
+        - keep_alive (str): time for which the point in time is kept open between two
+            pages, default '1m'.
+        :return: the listed documents, or, if listed with a cursor, a `DocumentArray`
+            with a single `Document` holding the documents as matches and the cursor
+            of the next page in its tags. The cursor is None after the last page.
         """
         limit = int(parameters.get('limit', self.limit))
-        offset = int(parameters.get('offset', 0))
+        if 'cursor' in parameters:
+            page, cursor = self._list_page(
+                parameters['cursor'], limit, parameters.get('keep_alive', '1m')
+            )
+            return get_list_cursor_result(page, cursor)
         try:
-            result = self.es.search(
-                index=self.index_name, size=limit, from_=offset, query={'match_all': {}}
-            )['hits']['hits']
+            resp = self.es.search(**self._get_list_request(parameters, limit))
         except Exception:
-            result = None
+            resp = None
             self.logger.info(traceback.format_exc())
-        if result:
-            return convert_es_to_da(result, get_score_breakdown=False)
-        else:
-            return DocumentArray()
+        return convert_list_response(resp)
+
+    @secure_request(on='/list', level=SecurityLevel.USER)
+    async def async_list(self, parameters: dict = {}, **kwargs):
+        """Handler of the `/list` endpoint, which lists the documents like `list` but
+        with the async client.
+        """
+        limit = int(parameters.get('limit', self.limit))
+        if 'cursor' in parameters:
+            page, cursor = await self._async_list_page(
+                parameters['cursor'], limit, parameters.get('keep_alive', '1m')
+            )
+            return get_list_cursor_result(page, cursor)
+        try:
+            resp = await self.async_es.search(
+                **self._get_list_request(parameters, limit)
+            )
+        except Exception:
+            resp = None
+            self.logger.info(traceback.format_exc())
+        return convert_list_response(resp)
+
+    def iter_pages(
+        self, page_size: int = 1000, keep_alive: str = '1m'
+    ) -> Iterator[DocumentArray]:
+        """Iterate over all indexed documents in pages of `page_size` documents, e.g. to
+        export the index. Only one page is held in memory at a time.
+
+        :param page_size: number of documents per page
+        :param keep_alive: time for which the point in time is kept open between two pages
+        :return: generator of pages of documents
+        """
+        cursor = ''
+        while cursor is not None:
+            page, cursor = self._list_page(cursor, page_size, keep_alive)
+            if page:
+                yield page
+
+    def _list_page(
+        self, cursor: str, limit: int, keep_alive: str
+    ) -> Tuple[DocumentArray, Optional[str]]:
+        """List one page of documents, sorted by `_shard_doc` within a point in time.
+
+        :param cursor: cursor of the previous page, or an empty string for the first page
+        :param limit: number of documents per page
+        :param keep_alive: time for which the point in time is kept open
+        :return: the documents of the page and the cursor of the next page, which is
+            None once all documents are listed
+        """
+        pit_id, search_after = decode_list_cursor(cursor) if cursor else (None, None)
+        if pit_id is None:
+            pit_id = self.es.open_point_in_time(
+                index=self.index_name, keep_alive=keep_alive
+            )['id']
+        try:
+            resp = self.es.search(
+                **get_list_page_request(pit_id, search_after, limit, keep_alive)
+            )
+        except NotFoundError:
+            raise ValueError(EXPIRED_CURSOR_MESSAGE)
+        page, pit_id, next_cursor = convert_list_page_response(resp, pit_id, limit)
+        if next_cursor is None:
+            self.es.close_point_in_time(id=pit_id)
+        return page, next_cursor
+
+    async def _async_list_page(
+        self, cursor: str, limit: int, keep_alive: str
+    ) -> Tuple[DocumentArray, Optional[str]]:
+        """Like `_list_page`, but with the async client."""
+        pit_id, search_after = decode_list_cursor(cursor) if cursor else (None, None)
+        if pit_id is None:
+            pit_id = (
+                await self.async_es.open_point_in_time(
+                    index=self.index_name, keep_alive=keep_alive
+                )
+            )['id']
+        try:
+            resp = await self.async_es.search(
+                **get_list_page_request(pit_id, search_after, limit, keep_alive)
+            )
+        except NotFoundError:
+            raise ValueError(EXPIRED_CURSOR_MESSAGE)
+        page, pit_id, next_cursor = convert_list_page_response(resp, pit_id, limit)
+        if next_cursor is None:
+            await self.async_es.close_point_in_time(id=pit_id)
+        return page, next_cursor
+
+    def _get_list_request(self, parameters: Dict, limit: int) -> Dict:
+        """Build the search request of `/list` with limit and offset."""
+        return {
+            'index': self.index_name,
+            'size': limit,
+            'from_': int(parameters.get('offset', 0)),
+            'query': {'match_all': {}},
+        }
+
+    @secure_request(on='/migrate_serialization', level=SecurityLevel.ADMIN)
+    def migrate_serialization(self, parameters: dict = {}, **kwargs):
+        """
+        Endpoint to convert all documents which are stored in another format than the
+        `serialization_format` of the indexer, or lack the `field_values` for lightweight
+        matches, e.g. documents written by older versions.
+
+        Indices created by older versions map `serialized_doc` as an indexed text field.
+        Converting their documents doesn't shrink them, this takes a `/reindex` into the
+        current mapping, which can be started right after the migration.
+
+        :param parameters: dictionary with options for the migration.
+            Keys accepted:
+                - 'reindex' (bool): Whether to start a `/reindex` after converting the
+                    documents if the mapping of the index is outdated. Default is False.
+        :return: `DocumentArray` with a single `Document` holding the number of
+            converted documents, whether a reindex is required and the id of the
+            reindex task, if one was started, in its tags.
+        """
+        self._check_no_build()
+
+        def _update_actions():
+            # `field_values` isn't indexed, so documents without it can't be queried
+            for hit in scan(
+                self.es,
+                index=self.index_name,
+                query={'query': {'match_all': {}}},
+                _source=['serialized_doc', 'serialization_format', 'field_values'],
+            ):
+                if (
+                    hit['_source'].get('serialization_format')
+                    == self.serialization_format
+                    and 'field_values' in hit['_source']
+                ):
+                    continue
+                doc = deserialize_doc(hit['_source'])
+                yield {
+                    '_op_type': 'update',
+                    '_index': self.index_name,
+                    '_id': hit['_id'],
+                    **({'_routing': hit['_routing']} if '_routing' in hit else {}),
+                    'doc': {
+                        'serialized_doc': serialize_doc(doc, self.serialization_format),
+                        'serialization_format': self.serialization_format,
+                        'field_values': get_field_values(doc),
+                    },
+                }
+
+        with self._backfill():
+            success, _ = self._bulk(_update_actions())
+        self.logger.info(
+            f'Migrated {success} documents in Elasticsearch index {self.index_name} '
+            f'to serialization format {self.serialization_format}'
+        )
+        es_mapping = self.es.indices.get_mapping(index=self.index_name)
+        serialized_doc_mapping = (
+            next(iter(es_mapping.values()), {})
+            .get('mappings', {})
+            .get('properties', {})
+            .get('serialized_doc', {})
+        )
+        reindex_required = serialized_doc_mapping.get('type') != 'binary'
+        tags = {'migrated': success, 'reindex_required': reindex_required}
+        if reindex_required:
+            if parameters.get('reindex', False):
+                tags['task_id'] = self.reindex(parameters=parameters)[0].tags['task_id']
+            else:
+                self.logger.info(
+                    f'The mapping of Elasticsearch index {self.index_name} is outdated, '
+                    f'run /reindex to shrink the stored documents'
+                )
+        return DocumentArray([Document(text='migrate_serialization', tags=tags)])
 
     @secure_request(on='/delete', level=SecurityLevel.USER)
     def delete(self, parameters: dict = {}, **kwargs):
@@ -338,47 +1612,447 @@ class NOWElasticIndexer(Executor):
         Endpoint to delete documents from an index. Either delete documents by filter condition
         or by specifying a list of document IDs.
 
+        Documents selected by IDs are deleted with a single bulk request. Documents
+        selected by a filter are deleted by a sliced `delete_by_query` task, which runs
+        in the background unless `wait_for_completion` is set. Its progress can be
+        followed with the `/task_status` endpoint. Searches aren't cached until the
+        task is done, so that they don't keep returning deleted documents.
+
         :param parameters: dictionary with filter conditions or list of IDs to select
             documents for deletion.
+            Keys accepted:
+                - 'filter' (dict): The filtering conditions on document tags
+                - 'ids' (list): The IDs of the documents to delete
+                - 'wait_for_completion' (bool): Whether to wait until all documents
+                    matching the filter are deleted. Default is False.
+                - 'refresh_policy' (str): 'immediate', 'interval' or 'wait_for'
+        :return: empty `DocumentArray`, or a `DocumentArray` with a single `Document`
+            holding the id of the delete task in its tags.
         """
         search_filter = parameters.get('filter', None)
         ids = parameters.get('ids', None)
+        refresh_policy = self._get_refresh_policy(parameters)
+        self._check_no_build()
         if search_filter:
-            es_search_filter = {
-                'query': {'bool': {'filter': process_filter(search_filter)}}
-            }
+            query = {'bool': {'filter': compile_filter(search_filter)}}
+            wait_for_completion = parameters.get('wait_for_completion', False)
             try:
+                deleted_tag_value_counts = self._aggregate_tags(query)
+                # delete by query can't wait for a refresh, it refreshes instead
                 resp = self.es.delete_by_query(
-                    index=self.index_name, body=es_search_filter
+                    index=self.index_name,
+                    query=query,
+                    routing=get_filter_routing(search_filter, self.routing_tag),
+                    refresh=refresh_policy != 'interval',
+                    slices='auto',
+                    conflicts='proceed',
+                    wait_for_completion=wait_for_completion,
                 )
-                self.es.indices.refresh(index=self.index_name)
-                self.update_tags()
+                if not wait_for_completion:
+                    self._pending_delete_tasks.add(resp['task'])
+                    threading.Thread(
+                        target=self._finish_delete, args=(resp['task'],), daemon=True
+                    ).start()
+                self.invalidate_search_cache()
+                if deleted_tag_value_counts:
+                    self.tag_index.remove_counts(deleted_tag_value_counts)
             except Exception:
                 self.logger.info(traceback.format_exc())
                 raise
+            if not wait_for_completion:
+                self.logger.info(
+                    f"Started task {resp['task']} to delete documents in Elasticsearch index {self.index_name}"
+                )
+                return DocumentArray(
+                    [Document(text='task_id', tags={'task_id': resp['task']})]
+                )
+            deleted = resp['deleted']
         elif ids:
-            resp = {'deleted': 0}
-            try:
-                for id in ids:
-                    r = self.es.delete(index=self.index_name, id=id)
-                    self.es.indices.refresh(index=self.index_name)
-                    resp['deleted'] += r['result'] == 'deleted'
-            except Exception as e:
-                self.logger.info(traceback.format_exc(), e)
+            deleted_tags = self._get_stored_tags(ids)
+            routings = self._get_stored_routings(ids)
+            deleted, errors = self._bulk(
+                (
+                    get_delete_action(self.index_name, id, routings.get(id))
+                    for id in ids
+                ),
+                refresh=self._get_write_refresh(refresh_policy),
+            )
+            self._refresh_after_write(refresh_policy)
+            self.invalidate_search_cache()
+            failed_ids = {error['id'] for error in errors}
+            for doc_id, tags in deleted_tags.items():
+                if doc_id not in failed_ids:
+                    self.tag_index.remove(tags)
+            if errors:
+                self.logger.info(
+                    f'Failed to delete {len(errors)} documents in Elasticsearch index {self.index_name}'
+                )
         else:
             raise ValueError('No filter or IDs provided for deletion.')
-        if resp:
+        self.logger.info(
+            f'Deleted {deleted} documents in Elasticsearch index {self.index_name}'
+        )
+        return DocumentArray()
+
+    @secure_request(on='/task_status', level=SecurityLevel.USER)
+    def task_status(self, parameters: dict = {}, **kwargs):
+        """
+        Endpoint to get the status of a task running in the background, e.g. deleting
+        documents by filter.
+
+        :param parameters: dictionary with the 'task_id' returned when the task started.
+        :return: `DocumentArray` with a single `Document` holding whether the task is
+            completed, its status and, once completed, its response in its tags.
+        """
+        task_id = parameters.get('task_id', None)
+        if not task_id:
+            raise ValueError('No task id provided.')
+        resp = self.es.tasks.get(task_id=task_id)
+        return DocumentArray(
+            [
+                Document(
+                    text='task_status',
+                    tags={
+                        'task_status': {
+                            'completed': resp['completed'],
+                            'status': resp['task'].get('status', {}),
+                            'response': resp.get('response', {}),
+                            'error': resp.get('error', {}),
+                        }
+                    },
+                )
+            ]
+        )
+
+    @secure_request(on='/reindex', level=SecurityLevel.ADMIN)
+    def reindex(self, parameters: dict = {}, **kwargs):
+        """
+        Endpoint to rebuild the index with the current mapping and settings of the
+        indexer, e.g. after changing `es_mapping` or `refresh_interval`, without
+        interrupting searches.
+
+        The documents are copied into a new version of the index by a `_reindex` task,
+        while the current version keeps answering searches. Documents indexed in the
+        meantime are written to both versions, updating and deleting documents fails
+        until the copy is done. Then the alias `index_name` is swapped to the new
+        version in one atomic step, and versions beyond `max_old_index_versions` are
+        deleted. Curated results refer to document ids and stay valid.
+
+        :param parameters: dictionary with options for reindexing.
+            Keys accepted:
+                - 'wait_for_completion' (bool): Whether to wait until the new version
+                    is built and swapped. Default is False, the progress can be
+                    followed with the `/task_status` endpoint.
+                - 'abort' (bool): Delete the version which is being built, e.g. if
+                    the indexer which started the reindex stopped before it was done.
+        :return: `DocumentArray` with a single `Document` holding the id of the reindex
+            task and the index of the new version in its tags.
+        """
+        build_index = self._get_build_index()
+        if parameters.get('abort', False):
+            if build_index:
+                self.es.indices.delete(index=build_index)
+                self.logger.info(f'Aborted building Elasticsearch index {build_index}')
+            return DocumentArray()
+        if build_index:
+            raise ValueError(f'The index is already being rebuilt into {build_index}.')
+        current_settings = next(
+            iter(self.es.indices.get_settings(index=self.index_name).values())
+        )['settings']['index']
+        build_settings = (
+            {'number_of_replicas': 0, 'refresh_interval': '-1'}
+            if self.fast_reindex
+            else {}
+        )
+        build_index = self._create_index_version(build_settings)
+        self.es.indices.put_alias(index=build_index, name=self.build_alias)
+        try:
+            task_id = self.es.reindex(
+                source={'index': self.index_name},
+                dest={'index': build_index, 'op_type': 'create'},
+                conflicts='proceed',
+                slices='auto',
+                wait_for_completion=False,
+            )['task']
+        except Exception:
+            self.es.indices.delete(index=build_index)
+            raise
+        self.logger.info(
+            f'Started task {task_id} to copy Elasticsearch index {self.index_name} into {build_index}'
+        )
+        final_settings = {
+            'number_of_replicas': self.number_of_replicas
+            if self.number_of_replicas is not None
+            else current_settings.get('number_of_replicas'),
+            'refresh_interval': self.refresh_interval,
+        }
+        if parameters.get('wait_for_completion', False):
+            self._finish_reindex(task_id, build_index, final_settings)
+        else:
+            threading.Thread(
+                target=self._finish_reindex,
+                args=(task_id, build_index, final_settings),
+                daemon=True,
+            ).start()
+        return DocumentArray(
+            [
+                Document(
+                    text='reindex',
+                    tags={'task_id': task_id, 'index': build_index},
+                )
+            ]
+        )
+
+    def _wait_for_task(self, task_id: str) -> Optional[Dict]:
+        """Poll a task until it is completed.
+
+        :return: the completed task, or None if the indexer is closed before
+        """
+        resp = self.es.tasks.get(task_id=task_id)
+        while not resp['completed']:
+            if self._stop_periodic_tasks.wait(TASK_POLL_INTERVAL):
+                return None
+            resp = self.es.tasks.get(task_id=task_id)
+        return resp
+
+    def _finish_delete(self, task_id: str):
+        """Wait for a delete task, then invalidate the search cache, which isn't used
+        while the task runs."""
+        try:
+            self._wait_for_task(task_id)
+        except Exception:
+            self.logger.info(traceback.format_exc())
+        finally:
+            self._pending_delete_tasks.discard(task_id)
+            self.invalidate_search_cache()
+
+    def _finish_reindex(self, task_id: str, build_index: str, settings: Dict):
+        """Wait for the reindex task, then enable the settings of the new version and
+        swap the alias to it. The new version is deleted if the task failed."""
+        try:
+            resp = self._wait_for_task(task_id)
+            if resp is None:
+                return
+            failures = resp.get('error') or resp.get('response', {}).get('failures')
+            if failures:
+                raise RuntimeError(f'Reindex task {task_id} failed: {failures}')
+            self.es.indices.put_settings(index=build_index, settings=settings)
+            self.es.indices.refresh(index=build_index)
+            self._swap_index_version(build_index)
+        except Exception:
+            self.logger.info(traceback.format_exc())
+            self.es.options(ignore_status=404).indices.delete(index=build_index)
+            return
+        self.invalidate_search_cache()
+        self.logger.info(
+            f'Swapped Elasticsearch index {self.index_name} to {build_index}'
+        )
+        self._delete_old_index_versions()
+
+    def _swap_index_version(self, index: str):
+        """Point the alias to `index` instead of the current version in one atomic
+        step. An index created before versions existed has the name of the alias and
+        is deleted in the same step."""
+        actions = [{'add': {'index': index, 'alias': self.index_name}}]
+        if index == self._get_build_index():
+            actions.append({'remove': {'index': index, 'alias': self.build_alias}})
+        if self.es.indices.exists_alias(name=self.index_name):
+            actions.extend(
+                {'remove': {'index': current_index, 'alias': self.index_name}}
+                for current_index in self.es.indices.get_alias(name=self.index_name)
+                if current_index != index
+            )
+        else:
+            actions.append({'remove_index': {'index': self.index_name}})
+        self.es.indices.update_aliases(actions=actions)
+
+    def _delete_old_index_versions(self):
+        """Delete the versions of the index before the current one, except the latest
+        `max_old_index_versions`. The curated index isn't a version and is kept."""
+        current_indices = set(self.es.indices.get_alias(name=self.index_name))
+        build_index = self._get_build_index()
+        old_indices = [
+            index
+            for _, index in sorted(self._get_index_versions().items())
+            if index not in current_indices and index != build_index
+        ]
+        for index in old_indices[
+            : max(len(old_indices) - self.max_old_index_versions, 0)
+        ]:
+            self.es.indices.delete(index=index)
             self.logger.info(
-                f"Deleted {resp['deleted']} documents in Elasticsearch index {self.index_name}"
+                f'Deleted old version {index} of Elasticsearch index {self.index_name}'
             )
-        return DocumentArray()
 
-    @secure_request(on='/tags', level=SecurityLevel.USER)
+    @secure_request(on='/snapshot', level=SecurityLevel.ADMIN)
+    def snapshot(self, parameters: dict = {}, **kwargs):
+        """
+        Endpoint to snapshot the index and the curated results into the filesystem
+        repository at `snapshot_path`, from which `/restore` restores them in a fraction
+        of the time it takes to encode and index the documents again. A previous
+        snapshot with the same name is replaced.
+
+        :param parameters: dictionary with options for the snapshot.
+            Keys accepted:
+                - 'snapshot' (str): Name of the snapshot, e.g. a hash of the indexed
+                    dataset. Default is 'latest'. Snapshots are only restored by indexers
+                    with the same mapping, i.e. the same encoders and fields.
+        :return: `DocumentArray` with a single `Document` holding the name of the
+            snapshot and the snapshotted indices in its tags.
+        """
+        snapshot = self._get_snapshot_name(parameters.get('snapshot', 'latest'))
+        self._create_snapshot_repository()
+        es = self.es.options(request_timeout=SNAPSHOT_REQUEST_TIMEOUT)
+        es.options(ignore_status=404).snapshot.delete(
+            repository=self.snapshot_repository, snapshot=snapshot
+        )
+        indices = self._get_current_indices()
+        resp = es.snapshot.create(
+            repository=self.snapshot_repository,
+            snapshot=snapshot,
+            indices=[*indices, self.curated_index_name],
+            include_global_state=False,
+            wait_for_completion=True,
+        )
+        self.logger.info(
+            f'Created snapshot {snapshot} of Elasticsearch index {self.index_name}'
+        )
+        return DocumentArray(
+            [
+                Document(
+                    text='snapshot',
+                    tags={
+                        'snapshot': snapshot,
+                        'indices': resp['snapshot']['indices'],
+                    },
+                )
+            ]
+        )
+
+    @secure_request(on='/restore', level=SecurityLevel.ADMIN)
+    def restore(self, parameters: dict = {}, **kwargs):
+        """
+        Endpoint to restore the index and the curated results from a snapshot taken by
+        `/snapshot`. The index is restored into a new version, to which the alias is
+        swapped once it is restored, so that searches aren't interrupted. Other replicas
+        reload the tags and curated results and drop their cached matches within
+        `curation_sync_interval`.
+
+        :param parameters: dictionary with options for restoring.
+            Keys accepted:
+                - 'snapshot' (str): Name of the snapshot. Default is 'latest'.
+        :return: `DocumentArray` with a single `Document` holding in its tags whether
+            the snapshot was restored, and whether snapshots are enabled at all. A
+            missing snapshot isn't an error, so that callers can index the documents
+            instead.
+        """
+        snapshot = self._get_snapshot_name(parameters.get('snapshot', 'latest'))
+        self._check_no_build()
+        try:
+            self._create_snapshot_repository()
+        except Exception:
+            self.logger.info(traceback.format_exc())
+            return DocumentArray(
+                [
+                    Document(
+                        text='restore',
+                        tags={'restored': False, 'snapshots_enabled': False},
+                    )
+                ]
+            )
+        es = self.es.options(request_timeout=SNAPSHOT_REQUEST_TIMEOUT)
+        resp = es.options(ignore_status=404).snapshot.get(
+            repository=self.snapshot_repository, snapshot=snapshot
+        )
+        restored = bool(resp.get('snapshots'))
+        if restored:
+            snapshot_indices = resp['snapshots'][0]['indices']
+            index = self._get_next_index_version()
+            es.snapshot.restore(
+                repository=self.snapshot_repository,
+                snapshot=snapshot,
+                indices=[i for i in snapshot_indices if i != self.curated_index_name],
+                rename_pattern='.+',
+                rename_replacement=index,
+                include_aliases=False,
+                include_global_state=False,
+                wait_for_completion=True,
+            )
+            if self.curated_index_name in snapshot_indices:
+                self.es.options(ignore_status=404).indices.delete(
+                    index=self.curated_index_name
+                )
+                es.snapshot.restore(
+                    repository=self.snapshot_repository,
+                    snapshot=snapshot,
+                    indices=[self.curated_index_name],
+                    include_aliases=False,
+                    include_global_state=False,
+                    wait_for_completion=True,
+                )
+            # other replicas pick up the restore once they see the swapped alias
+            self._swap_index_version(index)
+            self.sync_index_version()
+            self.sync_curated_ids()
+            self._delete_old_index_versions()
+            self.logger.info(
+                f'Restored Elasticsearch index {self.index_name} from snapshot {snapshot}'
+            )
+        return DocumentArray(
+            [
+                Document(
+                    text='restore',
+                    tags={'restored': restored, 'snapshots_enabled': True},
+                )
+            ]
+        )
+
+    def _create_snapshot_repository(self):
+        if not self.snapshot_path:
+            raise ValueError('No snapshot path configured.')
+        self.es.snapshot.create_repository(
+            name=self.snapshot_repository,
+            type='fs',
+            settings={'location': self.snapshot_path},
+        )
+
+    def _get_snapshot_name(self, snapshot: str) -> str:
+        """Name of a snapshot in the repository. It contains a hash of the mapping, so
+        that indexers with other encoders or fields don't restore it."""
+        if not re.fullmatch(r'[a-z0-9_.-]+', snapshot):
+            raise ValueError(
+                f'Invalid snapshot {snapshot}, must only contain lowercase letters, digits, _, . and -'
+            )
+        mapping_hash = hashlib.sha1(
+            json.dumps(self.es_mapping, sort_keys=True).encode()
+        ).hexdigest()[:12]
+        return f'{self.index_name}-{snapshot}-{mapping_hash}'
+
     def tags(self, **kwargs):
         """
-        Endpoint to get all tags and their possible values in the index.
+        Endpoint to get all tags and their possible values in the index. The values are
+        answered from memory. Tags which have more values than `max_values_per_tag`
+        are listed in `overflowed_tags`.
         """
-        return DocumentArray([Document(text='tags', tags={'tags': self.doc_id_tags})])
+        return DocumentArray(
+            [
+                Document(
+                    text='tags',
+                    tags={
+                        'tags': self.tag_index.to_dict(),
+                        'overflowed_tags': self.tag_index.overflowed,
+                    },
+                )
+            ]
+        )
+
+    @secure_request(on='/tags', level=SecurityLevel.USER)
+    async def async_tags(self, **kwargs):
+        """
+        Handler of the `/tags` endpoint. The tags are answered from memory, so it
+        doesn't need a thread of its own, see `tags`.
+        """
+        return self.tags()
 
     @secure_request(on='/curate', level=SecurityLevel.USER)
     def curate(self, parameters: dict = {}, **kwargs):
@@ -400,39 +2074,220 @@ class NOWElasticIndexer(Executor):
                 ],
             }
         }
+        The curated ids are persisted in the curated index, so that they survive
+        restarts and are picked up by the other replicas after `curation_sync_interval`.
         """
         search_filter = parameters.get('query_to_filter', None)
         if search_filter:
             self.update_curated_ids(search_filter)
+            self.search_cache.invalidate()
         else:
             raise ValueError('No filter provided for curating.')
 
-    def update_curated_ids(self, search_filter):
-        for query, filters in search_filter.items():
-            if query not in self.query_to_curated_ids:
-                self.query_to_curated_ids[query] = []
-            for filter in filters:
-                es_query = {'query': {'bool': {'filter': process_filter(filter)}}}
-
-                resp = self.es.search(index=self.index_name, body=es_query, size=100)
-                self.es.indices.refresh(index=self.index_name)
-                ids = [r['_id'] for r in resp['hits']['hits']]
-                self.query_to_curated_ids[query] += [
-                    id for id in ids if id not in self.query_to_curated_ids[query]
-                ]
+    @secure_request(on='/search_cache_stats', level=SecurityLevel.USER)
+    def search_cache_stats(self, **kwargs):
+        """
+        Endpoint to get the hit and miss counters and the size of the search result cache.
+        """
+        return DocumentArray(
+            [
+                Document(
+                    text='search_cache_stats',
+                    tags={'search_cache_stats': self.search_cache.stats()},
+                )
+            ]
+        )
+
+    def update_curated_ids(self, search_filter: Dict[str, List[Dict]]):
+        """
+        Resolve the filters of all queries with a single `_msearch` and append the ids
+        of the matching documents to the curated ids of the queries. The curated ids
+        of the changed queries are written to the curated index, from which all
+        replicas load them.
+
+        :param search_filter: dictionary mapping each query to a list of filters
+        """
+        query_filters = [
+            (query, filter)
+            for query, filters in search_filter.items()
+            for filter in filters
+        ]
+        results = self._msearch(
+            [
+                {
+                    'query': {'bool': {'filter': compile_filter(filter)}},
+                    'size': MAX_CURATED_IDS_PER_FILTER,
+                    '_source': False,
+                }
+                for _, filter in query_filters
+            ]
+        )
+        with self._curation_lock:
+            changed_curated_ids = {
+                query: list(self.query_to_curated_ids.get(query, []))
+                for query in search_filter
+            }
+            for (query, _), hits in zip(query_filters, results):
+                curated_ids = changed_curated_ids[query]
+                for hit in hits:
+                    if hit['_id'] not in curated_ids:
+                        curated_ids.append(hit['_id'])
+            _, errors = self._bulk(
+                (
+                    {
+                        '_op_type': 'index',
+                        '_index': self.curated_index_name,
+                        '_id': get_curation_id(query),
+                        'query': query,
+                        'ids': ids,
+                    }
+                    for query, ids in changed_curated_ids.items()
+                ),
+                refresh='wait_for',
+            )
+            if errors:
+                raise RuntimeError(f'Failed to persist curated results: {errors}')
+            self.query_to_curated_ids = {
+                **self.query_to_curated_ids,
+                **changed_curated_ids,
+            }
+
+    def sync_curated_ids(self):
+        """
+        Load the curated ids of all queries from the curated index, which holds the
+        results curated by any replica of the indexer.
+        """
+        try:
+            with self._curation_lock:
+                self.query_to_curated_ids = {
+                    hit['_source']['query']: hit['_source']['ids']
+                    for hit in scan(
+                        self.es,
+                        index=self.curated_index_name,
+                        query={'query': {'exists': {'field': 'query'}}},
+                    )
+                }
+        except Exception:
+            self.logger.info(traceback.format_exc())
+
+    def _sync_curated_ids_periodically(self):
+        while not self._stop_periodic_tasks.wait(self.curation_sync_interval):
+            self.sync_index_version()
+            self.sync_curated_ids()
+
+    def sync_index_version(self):
+        """
+        Pick up a new version of the index, which the alias was swapped to by `/restore`
+        or `/reindex`, possibly on another replica. The tags are reloaded and cached
+        matches are dropped, since they are from the previous version.
+        """
+        try:
+            index_version = self._get_current_indices()
+        except Exception:
+            self.logger.info(traceback.format_exc())
+            return
+        if index_version != self._index_version:
+            self._index_version = index_version
+            self.search_cache.invalidate()
+            self.update_tags()
+            self.logger.info(
+                f'Picked up version {index_version} of Elasticsearch index {self.index_name}'
+            )
+
+    def invalidate_search_cache(self):
+        """
+        Drop the cached matches after a write to the index. A new generation of the
+        search cache is written to the curated index, so that the other replicas drop
+        their cached matches within `search_cache_sync_interval`, too. Generations are
+        random, so that a generation restored from a snapshot is never mistaken for a
+        later one.
+        """
+        self.search_cache.invalidate()
+        if not self.search_cache.enabled:
+            return
+        generation = uuid.uuid4().hex
+        try:
+            self.es.index(
+                index=self.curated_index_name,
+                id=SEARCH_CACHE_GENERATION_ID,
+                document={'generation': generation},
+            )
+            self._search_cache_generation = generation
+        except Exception:
+            self.logger.info(traceback.format_exc())
+
+    def sync_search_cache(self):
+        """
+        Drop the cached matches if another replica wrote a new generation of the search
+        cache to the curated index since the last check.
+        """
+        try:
+            resp = self.es.options(ignore_status=404).get(
+                index=self.curated_index_name, id=SEARCH_CACHE_GENERATION_ID
+            )
+        except Exception:
+            self.logger.info(traceback.format_exc())
+            return
+        generation = resp['_source']['generation'] if resp.get('found') else None
+        if generation != self._search_cache_generation:
+            self._search_cache_generation = generation
+            self.search_cache.invalidate()
+
+    def _sync_search_cache_periodically(self):
+        while not self._stop_periodic_tasks.wait(self.search_cache_sync_interval):
+            self.sync_search_cache()
+
+    def _get_current_indices(self) -> List[str]:
+        """Get the indices the alias points to, or the index itself if it was created
+        before versions existed."""
+        if self.es.indices.exists_alias(name=self.index_name):
+            return sorted(self.es.indices.get_alias(name=self.index_name))
+        return [self.index_name]
 
     def update_tags(self):
         """
         The indexer keeps track of which tags are indexed and what their possible
-        values are, which is stored in self.doc_id_tags. This method queries the
-        elasticsearch index for the current es_mapping to find the current tags on all
-        indexed documents. It then queries elasticsearch for an aggregation of all values
-        inside this field, and updates the self.doc_id_tags dictionary with tags as keys,
-        and values as values in the dictionary.
+        values are in self.tag_index, which is updated incrementally by every write.
+        This method reconciles it with the index, to correct drift, e.g. from documents
+        which were overwritten. It queries the elasticsearch index for the current
+        es_mapping to find the current tags on all indexed documents, and then queries
+        elasticsearch for an aggregation of all values inside these fields.
+        """
+        tag_value_counts = self._aggregate_tags()
+        if tag_value_counts is not None:
+            self.tag_index.reset(tag_value_counts)
+
+    def _reconcile_tags_periodically(self):
+        while not self._stop_periodic_tasks.wait(self.tag_reconciliation_interval):
+            self.update_tags()
+
+    def close(self):
+        self._stop_periodic_tasks.set()
+        if self.decode_pool is not None:
+            self.decode_pool.shutdown()
+        try:
+            asyncio.get_running_loop().create_task(self.async_es.close())
+        except RuntimeError:
+            asyncio.run(self.async_es.close())
+        super().close()
+
+    def _aggregate_tags(
+        self, query: Optional[Dict] = None
+    ) -> Optional[Dict[str, Dict[Any, int]]]:
+        """
+        Aggregate the values of the filter fields in the tags of the documents.
+
+        :param query: query selecting the documents to aggregate, all documents if None.
+            For all documents, one value more than `max_values_per_tag` is aggregated
+            per tag to detect overflows, and up to `MAX_TAG_BUCKETS` values for the
+            selected documents.
+        :return: dictionary mapping each tag to a dictionary of values and their number
+            of documents, or None if the aggregation failed or there are no tags.
         """
         es_mapping = self.es.indices.get_mapping(index=self.index_name)
+        # the mapping is keyed by the index the alias points to
         tag_categories = (
-            es_mapping.get(self.index_name, {})
+            next(iter(es_mapping.values()), {})
             .get('mappings', {})
             .get('properties', {})
             .get('tags', {})
@@ -443,7 +2298,11 @@ class NOWElasticIndexer(Executor):
             for tag, map in tag_categories.items()
             if tag in self.user_input.filter_fields
         }
+        size = self.tag_index.max_values_per_tag + 1
         aggs = {'aggs': {}, 'size': 0}
+        if query is not None:
+            size = MAX_TAG_BUCKETS
+            aggs['query'] = query
         for tag, map in tag_categories.items():
             for tag_type, extension in [
                 ['text', '.keyword'],
@@ -452,20 +2311,21 @@ class NOWElasticIndexer(Executor):
             ]:
                 if map['type'] == tag_type:
                     aggs['aggs'][tag] = {
-                        'terms': {'field': f'tags.{tag}{extension}', 'size': 100}
+                        'terms': {'field': f'tags.{tag}{extension}', 'size': size}
                     }
 
         try:
             if not aggs['aggs']:
-                return
+                return None
             result = self.es.search(index=self.index_name, body=aggs)
             aggregations = result['aggregations']
-            updated_tags = {}
-            for tag, agg in aggregations.items():
-                updated_tags[tag] = [bucket['key'] for bucket in agg['buckets']]
-            self.doc_id_tags = updated_tags
+            return {
+                tag: {bucket['key']: bucket['doc_count'] for bucket in agg['buckets']}
+                for tag, agg in aggregations.items()
+            }
         except Exception:
             self.logger.info(traceback.format_exc())
+            return None
 
     @secure_request(on='/get_encoder_to_fields', level=SecurityLevel.USER)
     def get_encoder_to_fields(self, **kwargs) -> DocumentArray:
@@ -511,19 +2371,239 @@ class NOWElasticIndexer(Executor):
         )
 
 
-def aggregate_embeddings(docs_map: Dict[str, DocumentArray]):
-    """Aggregate embeddings of cc level to c level.
+def create_temporary_links(docs: DocumentArray, user_input: UserInput):
+    """For every match, it replaces the URI with a temporary link such that no credentials are needed for access."""
+
+    def _create_temp_link(d: Document) -> Document:
+        if (
+            not d.text
+            and not d.blob
+            and isinstance(d.uri, str)
+            and d.uri.startswith('s3://')
+        ):
+            session = boto3.session.Session(
+                aws_access_key_id=user_input.aws_access_key_id,
+                aws_secret_access_key=user_input.aws_secret_access_key,
+                region_name=user_input.aws_region_name,
+            )
+            s3_client = session.client('s3')
+            bucket_name = d.uri.split('/')[2]
+            path_s3 = '/'.join(d.uri.split('/')[3:])
+            temp_url = s3_client.generate_presigned_url(
+                'get_object',
+                Params={'Bucket': bucket_name, 'Key': path_s3},
+                ExpiresIn=300,
+            )
+            d.uri = temp_url
+        return d
+
+    for d in docs['@mc,mcc']:
+        _create_temp_link(d)
+
+
+def get_msearch_hits(msearch_response: Mapping) -> List[List[Dict]]:
+    """Return the hits of every search of an `_msearch` response.
+
+    :raises RuntimeError: if one of the searches failed
+    """
+    results = []
+    for response in msearch_response['responses']:
+        if 'error' in response:
+            raise RuntimeError(f'Elasticsearch search failed: {response["error"]}')
+        results.append(response['hits']['hits'])
+    return results
+
+
+def get_default_number_of_shards(
+    expected_num_docs: int,
+    document_mappings: List[FieldEmbedding],
+    vector_element_type: str = 'float',
+) -> int:
+    """Derive the number of shards of an index from the expected number of documents
+    and the size of their vectors, so that no shard exceeds
+    `MAX_VECTOR_BYTES_PER_SHARD` and `MAX_DOCS_PER_SHARD`."""
+    bytes_per_element = 1 if vector_element_type == 'byte' else 4
+    vector_bytes_per_doc = sum(
+        int(embedding_size) * bytes_per_element * len(fields)
+        for _, embedding_size, fields in document_mappings
+    )
+    return max(
+        1,
+        math.ceil(
+            expected_num_docs * vector_bytes_per_doc / MAX_VECTOR_BYTES_PER_SHARD
+        ),
+        math.ceil(expected_num_docs / MAX_DOCS_PER_SHARD),
+    )
+
+
+def get_delete_action(index: str, doc_id: str, routing: Optional[str]) -> Dict:
+    """Build the bulk action which deletes a document, with the routing it was written
+    with."""
+    return {
+        '_op_type': 'delete',
+        '_index': index,
+        '_id': doc_id,
+        **({'_routing': routing} if routing else {}),
+    }
+
+
+def is_version_conflict(error: Union[Dict, str]) -> bool:
+    """Whether a bulk action failed because the document already exists."""
+    return (
+        isinstance(error, dict)
+        and error.get('type') == 'version_conflict_engine_exception'
+    )
+
+
+def get_routing(tags: Dict, routing_tag: Optional[str]) -> Optional[str]:
+    """Routing of a document with the given tags, None if it isn't routed."""
+    value = tags.get(routing_tag) if routing_tag else None
+    return value if isinstance(value, str) else None
+
+
+def get_routed_shard(search_shards_response: Dict) -> Dict:
+    """Get the primary copy of the shard which a `search_shards` request with a single
+    routing value routes to."""
+    return next(
+        shard for shard in search_shards_response['shards'][0] if shard['primary']
+    )
+
+
+def get_filter_routing(
+    filter: Optional[Dict], routing_tag: Optional[str]
+) -> Optional[str]:
+    """Routing of the documents which can match a filter, None if they can be on any
+    shard. Documents can only match if their routing tag equals one of the values of an
+    `$eq` or `$in` condition on it."""
+    if not filter or not routing_tag:
+        return None
+    conditions = filter.get(f'tags__{routing_tag}', {})
+    values = conditions.get('$in', [conditions['$eq']] if '$eq' in conditions else [])
+    if values and all(isinstance(value, str) for value in values):
+        return ','.join(values)
+    return None
+
+
+def get_curation_id(query: str) -> str:
+    """Id of the document of a query in the curated index. Queries are hashed, as
+    they could exceed the maximum length of ids."""
+    return hashlib.sha1(query.encode()).hexdigest()
+
+
+def get_list_page_request(
+    pit_id: str, search_after: Optional[List], limit: int, keep_alive: str
+) -> Dict:
+    """Build the search request of a page of `/list` with a cursor, which continues
+    after the last document of the previous page within the point in time."""
+    return {
+        'pit': {'id': pit_id, 'keep_alive': keep_alive},
+        'size': limit,
+        'sort': [{'_shard_doc': 'asc'}],
+        'search_after': search_after,
+        'query': {'match_all': {}},
+    }
+
+
+def convert_list_page_response(
+    resp: Dict, pit_id: str, limit: int
+) -> Tuple[DocumentArray, str, Optional[str]]:
+    """Convert the response to a request of `get_list_page_request`.
+
+    :return: the documents of the page, the id of the point in time, which might have
+        changed with the request, and the cursor of the next page. The cursor is None
+        after the last page, in which case the point in time should be closed.
+    """
+    hits = resp['hits']['hits']
+    pit_id = resp.get('pit_id', pit_id)
+    next_cursor = (
+        encode_list_cursor(pit_id, hits[-1]['sort']) if len(hits) >= limit else None
+    )
+    return convert_es_to_da(hits, get_score_breakdown=False), pit_id, next_cursor
+
+
+def convert_list_response(resp: Optional[Dict]) -> DocumentArray:
+    """Convert the response to a request of `/list` with limit and offset."""
+    if resp and resp['hits']['hits']:
+        return convert_es_to_da(resp['hits']['hits'], get_score_breakdown=False)
+    return DocumentArray()
+
+
+def get_list_cursor_result(page: DocumentArray, cursor: Optional[str]) -> DocumentArray:
+    """Wrap a page of `/list` with a cursor into the result of the endpoint."""
+    return DocumentArray(
+        [Document(text='cursor', tags={'cursor': cursor}, matches=page)]
+    )
+
+
+def encode_list_cursor(pit_id: str, search_after: List) -> str:
+    """Encode the point in time and the sort values of the last listed document into
+    an opaque cursor."""
+    return base64.urlsafe_b64encode(
+        json.dumps({'pit_id': pit_id, 'search_after': search_after}).encode()
+    ).decode()
+
+
+def decode_list_cursor(cursor: str) -> Tuple[str, List]:
+    """Decode a cursor created by `encode_list_cursor`."""
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return state['pit_id'], state['search_after']
+    except Exception:
+        raise ValueError(f'Invalid cursor {cursor}')
+
+
+def aggregate_embeddings(docs_map: Dict[str, DocumentArray], pooling: str = 'mean'):
+    """Aggregate embeddings of cc level to c level. The embeddings of all cc level
+    documents of an encoder are stacked into one array and pooled with a single
+    segmented reduction.
 
     :param docs_map: a dictionary of `DocumentArray`s, where the key is the embedding space aka encoder name.
+    :param pooling: how to pool the embeddings of the cc level documents, one of
+        `POOLING_STRATEGIES`.
     """
+    if pooling not in POOLING_STRATEGIES:
+        raise ValueError(
+            f'Invalid pooling {pooling}, must be one of {POOLING_STRATEGIES}'
+        )
     for docs in docs_map.values():
+        pooled_chunks, embeddings, offsets = [], [], []
         for doc in docs:
             for c in doc.chunks:
-                if c.chunks.embeddings is not None:
-                    c.embedding = c.chunks.embeddings.mean(axis=0)
+                if not c.chunks:
+                    continue
+                chunk_embeddings = [cc.embedding for cc in c.chunks]
+                if all(embedding is not None for embedding in chunk_embeddings):
+                    pooled_chunks.append(c)
+                    offsets.append(len(embeddings))
+                    embeddings.extend(chunk_embeddings)
                 if c.chunks[0].text or not c.uri:
                     c.content = c.chunks[0].content
                 c.chunks = DocumentArray()
+        if pooled_chunks:
+            pooled_embeddings = pool_embeddings(
+                np.stack(embeddings), np.array(offsets), pooling
+            )
+            for c, embedding in zip(pooled_chunks, pooled_embeddings):
+                c.embedding = embedding
+
+
+def pool_embeddings(
+    embeddings: np.ndarray, offsets: np.ndarray, pooling: str
+) -> np.ndarray:
+    """Pool consecutive segments of embeddings.
+
+    :param embeddings: array of all embeddings, one per row.
+    :param offsets: index of the first embedding of each segment, in increasing order.
+    :param pooling: 'mean', 'max' or 'first'.
+    :return: array with one pooled embedding per segment.
+    """
+    if pooling == 'mean':
+        counts = np.diff(offsets, append=len(embeddings))
+        return np.add.reduceat(embeddings, offsets, axis=0) / counts[:, np.newaxis]
+    elif pooling == 'max':
+        return np.maximum.reduceat(embeddings, offsets, axis=0)
+    else:
+        return embeddings[offsets]
 
 
 def wait_until_cluster_is_up(es, hosts):
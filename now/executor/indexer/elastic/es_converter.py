@@ -1,10 +1,25 @@
-from typing import Dict, List, Union
+import base64
+from concurrent.futures import Executor
+from contextlib import contextmanager
+from functools import partial
+from typing import Dict, Iterator, List, Optional, Union
 
+import numpy as np
 from docarray import Document, DocumentArray
+from docarray.document.pydantic_model import PydanticDocument
 from docarray.score import NamedScore
-from numpy import dot
 from numpy.linalg import norm
 
+# Formats of the `serialized_doc` field, given as `{protocol}` or `{protocol}-{compress}`.
+# Documents without a `serialization_format` field were written with the legacy format.
+SERIALIZATION_FORMATS = ['pickle', 'protobuf', 'protobuf-zlib']
+LEGACY_SERIALIZATION_FORMAT = 'pickle'
+DEFAULT_SERIALIZATION_FORMAT = 'protobuf-zlib'
+
+# Element types of the `dense_vector` fields. 'byte' stores scalar-quantized vectors
+# with one signed byte per dimension instead of a float32.
+VECTOR_ELEMENT_TYPES = ['float', 'byte']
+
 
 def get_bm25_fields(doc: Document) -> str:
     try:
@@ -13,79 +28,257 @@ def get_bm25_fields(doc: Document) -> str:
         return ''
 
 
+def quantize_embedding(embedding) -> np.ndarray:
+    """
+    Scalar-quantize an embedding to signed bytes. The embedding is normalized first,
+    so that every component is in [-1, 1] and can be mapped to [-127, 127]. This
+    keeps cosine similarities, which don't depend on the length of the vectors.
+
+    :param embedding: the embedding to quantize.
+    :return: the quantized embedding as `int8` array.
+    """
+    embedding = np.asarray(embedding, dtype=np.float32)
+    embedding_norm = norm(embedding)
+    if embedding_norm > 0:
+        embedding = embedding / embedding_norm
+    return np.clip(np.round(embedding * 127), -127, 127).astype(np.int8)
+
+
+def serialize_doc(
+    doc: Document,
+    serialization_format: str = DEFAULT_SERIALIZATION_FORMAT,
+    exclude_embeddings: bool = False,
+) -> str:
+    """Serialize a document to base64, which Elasticsearch accepts for binary fields.
+
+    :param doc: the document to serialize.
+    :param serialization_format: one of `SERIALIZATION_FORMATS`.
+    :param exclude_embeddings: whether to leave out the embeddings of the document and
+        all its nested documents. The document is not copied for this, see
+        `detached_embeddings`.
+    :return: the serialized document.
+    """
+    protocol, _, compress = serialization_format.partition('-')
+    if not exclude_embeddings:
+        return doc.to_base64(protocol=protocol, compress=compress or None)
+    with detached_embeddings(doc):
+        return doc.to_base64(protocol=protocol, compress=compress or None)
+
+
+@contextmanager
+def detached_embeddings(doc: Document):
+    """
+    Remove the embeddings of a document and of all its nested chunks and matches while
+    inside the context, and put them back afterwards, also on errors.
+
+    :param doc: the document whose embeddings are detached.
+    """
+    embeddings = []
+    for d in _iter_nested_docs(doc):
+        if d.embedding is not None:
+            embeddings.append((d, d.embedding))
+            d.embedding = None
+    try:
+        yield doc
+    finally:
+        for d, embedding in embeddings:
+            d.embedding = embedding
+
+
+def _iter_nested_docs(doc: Document) -> Iterator[Document]:
+    yield doc
+    for nested_doc in doc.chunks:
+        yield from _iter_nested_docs(nested_doc)
+    for nested_doc in doc.matches:
+        yield from _iter_nested_docs(nested_doc)
+
+
+def deserialize_doc(es_source: Dict) -> Document:
+    """Deserialize the document stored in the `_source` of an Elasticsearch document."""
+    protocol, _, compress = es_source.get(
+        'serialization_format', LEGACY_SERIALIZATION_FORMAT
+    ).partition('-')
+    return Document.from_base64(
+        es_source['serialized_doc'], protocol=protocol, compress=compress or None
+    )
+
+
 def convert_es_to_da(
     result: Union[Dict, List[Dict]], get_score_breakdown: bool
 ) -> DocumentArray:
     """
     Transform Elasticsearch documents into DocumentArray. Assumes that all Elasticsearch
-    documents have a 'text' field. It returns embeddings as part of the tags for each field that is encoded.
+    documents have a 'text' field. It returns embeddings as part of the tags for each field that is encoded,
+    and the similarities computed by `script_fields` as `similarities` in the tags.
 
     :param result: results from an Elasticsearch query.
-    :param get_score_breakdown: whether to return the embeddings as tags for each document.
+    :param get_score_breakdown: whether to return the embeddings and similarities as tags for each document.
     :return: a DocumentArray containing all results.
     """
     if isinstance(result, Dict):
         result = [result]
-    da = DocumentArray()
-    for es_doc in result:
-        doc = Document.from_base64(es_doc['_source']['serialized_doc'])
-        for k, v in es_doc['_source'].items():
-            if (
-                k.startswith('embedding') or k.endswith('embedding')
-            ) and get_score_breakdown:
+    return DocumentArray(
+        [convert_es_hit_to_doc(es_doc, get_score_breakdown) for es_doc in result]
+    )
+
+
+def convert_es_hit_to_doc(es_doc: Dict, get_score_breakdown: bool) -> Document:
+    """
+    Transform a single Elasticsearch document into a `Document`, see `convert_es_to_da`.
+
+    :param es_doc: Elasticsearch document, e.g. a search hit.
+    :param get_score_breakdown: whether to return the embeddings and similarities as tags.
+    :return: the deserialized document.
+    """
+    es_source = es_doc['_source']
+    doc = deserialize_doc(es_source)
+    # tags can be updated in place without updating the serialized document
+    doc.tags.update(es_source.get('tags', {}))
+    if get_score_breakdown:
+        for k, v in es_source.items():
+            if k.startswith('embedding') or k.endswith('embedding'):
                 if 'embeddings' not in doc.tags:
                     doc.tags['embeddings'] = {}
                 doc.tags['embeddings'][k] = v
-        da.append(doc)
-    return da
+        if 'fields' in es_doc:
+            doc.tags['similarities'] = {k: v[0] for k, v in es_doc['fields'].items()}
+    return doc
+
+
+def convert_es_hit_to_lightweight_doc(
+    es_doc: Dict, get_score_breakdown: bool = False
+) -> Document:
+    """
+    Transform a single Elasticsearch document into a lightweight `Document`, which only
+    holds the id, the tags and the text or uri of every field, without deserializing the
+    stored document. The fields are read from `field_values`, see `get_field_values`.
+
+    :param es_doc: Elasticsearch document, e.g. a search hit.
+    :param get_score_breakdown: whether to return the similarities as tags.
+    :return: a multi-modal document with one chunk per field.
+    """
+    es_source = es_doc['_source']
+    doc = Document(id=es_doc['_id'], tags=es_source.get('tags', {}))
+    field_values = es_source.get('field_values', {})
+    if field_values:
+        schema = {}
+        for field, values in field_values.items():
+            schema[field] = {
+                'attribute_type': 'document',
+                'type': values['type'],
+                'position': values['position'],
+            }
+        doc.chunks = [
+            Document(text=values.get('text'), uri=values.get('uri'))
+            for values in sorted(field_values.values(), key=lambda v: v['position'])
+        ]
+        doc._metadata['multi_modal_schema'] = schema
+    if get_score_breakdown and 'fields' in es_doc:
+        doc.tags['similarities'] = {k: v[0] for k, v in es_doc['fields'].items()}
+    return doc
+
+
+def get_field_values(doc: Document) -> Dict:
+    """
+    Get the text or uri of every field of a multi-modal document, which is stored next to
+    the serialized document to build lightweight matches.
+
+    :param doc: the multi-modal document.
+    :return: dictionary mapping each field to its type, position, and text or uri.
+    """
+    field_values = {}
+    for field, schema in doc._metadata.get('multi_modal_schema', {}).items():
+        if 'position' not in schema:
+            continue
+        field_doc = doc.chunks[schema['position']]
+        values = {'type': schema['type'], 'position': schema['position']}
+        if field_doc.text:
+            values['text'] = field_doc.text
+        elif field_doc.uri and not field_doc.uri.startswith('data:'):
+            values['uri'] = field_doc.uri
+        field_values[field] = values
+    return field_values
 
 
 def convert_doc_map_to_es(
     docs_map: Dict[str, DocumentArray],
     index_name: str,
     encoder_to_fields: dict,
-) -> List[Dict]:
+    serialization_format: str = DEFAULT_SERIALIZATION_FORMAT,
+    vector_element_type: str = 'float',
+) -> Iterator[Dict]:
     """
-    Transform a dictionary (mapping encoder to DocumentArray) into a list of Elasticsearch documents.
+    Transform a dictionary (mapping encoder to DocumentArray) into Elasticsearch documents.
     The `docs_map` dictionary is expected to have the following structure:
     {
         'encoder1': DocumentArray([...]),
         'encoder2': DocumentArray([...]), # same number of documents as encoder1
         ...
     }
+    The Elasticsearch documents are built one at a time, so that they can be streamed
+    into the bulk API without holding all of them in memory.
 
     :param docs_map: dictionary mapping encoder to DocumentArray.
     :param index_name: name of the index to be used in Elasticsearch.
     :param encoder_to_fields: dictionary mapping encoder to fields.
-    :return: a list of Elasticsearch documents as dictionaries ready to be indexed.
-    """
-    es_docs = {}
-    for executor_name, documents in docs_map.items():
-        for doc in documents:
-            if doc.id not in es_docs:
-                es_docs[doc.id] = get_base_es_doc(doc, index_name)
-                _doc = DocumentArray(Document(doc, copy=True))
-                # remove embeddings from serialized doc
-                _doc[..., 'embedding'] = None
-                es_docs[doc.id]['serialized_doc'] = _doc[0].to_base64()
-            es_doc = es_docs[doc.id]
+    :param serialization_format: format in which the document is stored in `serialized_doc`.
+    :param vector_element_type: element type of the vector fields. If 'byte', embeddings are
+        quantized with `quantize_embedding`.
+    :return: a generator of Elasticsearch documents as dictionaries ready to be indexed.
+    """
+    doc_ids = dict.fromkeys(
+        doc_id for documents in docs_map.values() for doc_id in documents[:, 'id']
+    )
+    for doc_id in doc_ids:
+        es_doc = None
+        for executor_name, documents in docs_map.items():
+            if doc_id not in documents:
+                continue
+            doc = documents[doc_id]
+            if es_doc is None:
+                es_doc = get_base_es_doc(doc, index_name)
+                es_doc['serialized_doc'] = serialize_doc(
+                    doc, serialization_format, exclude_embeddings=True
+                )
+                es_doc['serialization_format'] = serialization_format
+                es_doc['field_values'] = get_field_values(doc)
             for encoded_field in encoder_to_fields[executor_name]:
                 field_doc = getattr(doc, encoded_field)
-                es_doc[
-                    f'{encoded_field}-{executor_name}.embedding'
-                ] = field_doc.embedding
+                embedding = field_doc.embedding
+                if vector_element_type == 'byte' and embedding is not None:
+                    embedding = quantize_embedding(embedding)
+                es_doc[f'{encoded_field}-{executor_name}.embedding'] = embedding
                 if hasattr(field_doc, 'text') and field_doc.text:
                     es_doc['bm25_text'] += field_doc.text + ' '
                     es_doc['text'] = field_doc.text
                 if hasattr(field_doc, 'uri') and field_doc.uri:
                     es_doc['uri'] = field_doc.uri
-    return list(es_docs.values())
+        yield es_doc
+
+
+def get_es_text_fields(doc: Document, encoder_to_fields: dict) -> Dict:
+    """
+    Get the text fields of the Elasticsearch document of a multi-modal document, in the
+    same way as `convert_doc_map_to_es` builds them.
+
+    :param doc: the multi-modal document.
+    :param encoder_to_fields: dictionary mapping encoder to fields.
+    :return: dictionary with `bm25_text` and, if the document has them, `text` and `uri`.
+    """
+    es_fields = {'bm25_text': get_bm25_fields(doc)}
+    for encoded_fields in encoder_to_fields.values():
+        for encoded_field in encoded_fields:
+            field_doc = getattr(doc, encoded_field)
+            if hasattr(field_doc, 'text') and field_doc.text:
+                es_fields['bm25_text'] += field_doc.text + ' '
+                es_fields['text'] = field_doc.text
+            if hasattr(field_doc, 'uri') and field_doc.uri:
+                es_fields['uri'] = field_doc.uri
+    return es_fields
 
 
 def get_base_es_doc(doc: Document, index_name: str) -> Dict:
-    es_doc = {k: v for k, v in doc.to_dict().items() if v}
-    es_doc.pop('chunks', None)
-    es_doc.pop('_metadata', None)
+    es_doc = {k: v for k, v in get_top_level_dict(doc).items() if v}
     es_doc['bm25_text'] = get_bm25_fields(doc)
     es_doc['_op_type'] = 'index'
     es_doc['_index'] = index_name
@@ -95,12 +288,37 @@ def get_base_es_doc(doc: Document, index_name: str) -> Dict:
     return es_doc
 
 
+def get_top_level_dict(doc: Document) -> Dict:
+    """
+    Like `doc.to_dict()`, but without the chunks, matches and metadata, which are not
+    converted at all instead of being dropped afterwards.
+
+    :param doc: the document to convert.
+    :return: the fields of the document as a dictionary.
+    """
+    fields = {}
+    for f in doc.non_empty_fields:
+        if f in ('chunks', 'matches', '_metadata'):
+            continue
+        v = getattr(doc, f)
+        if f in ('scores', 'evaluations'):
+            fields[f] = {k: v.to_dict() for k, v in v.items()}
+        elif f == 'blob':
+            fields[f] = base64.b64encode(v).decode('utf8')
+        else:
+            fields[f] = v
+    return PydanticDocument(**fields).dict()
+
+
 def convert_es_results_to_matches(
     query_doc: Document,
     es_results: List[Dict],
     get_score_breakdown: bool,
     metric: str,
     semantic_scores,
+    lightweight: bool = False,
+    pool: Optional[Executor] = None,
+    parallel_decode_min_bytes: int = 2**20,
 ) -> DocumentArray:
     """
     Transform a list of results from Elasticsearch into a matches in the form of a `DocumentArray`.
@@ -110,38 +328,57 @@ def convert_es_results_to_matches(
     :param get_score_breakdown: whether to calculate the score breakdown for matches.
     :param metric: the metric used to calculate the score.
     :param semantic_scores: the semantic scores for each match.
+    :param lightweight: whether to return lightweight matches, see `convert_es_hit_to_lightweight_doc`.
+    :param pool: optional executor to deserialize the stored documents in parallel.
+    :param parallel_decode_min_bytes: minimum total size of the stored documents for which
+        they are deserialized in parallel with `pool`.
 
     :return: `DocumentArray` that holds all matches in the form of `Document`s.
     """
-    matches = DocumentArray()
-    for result in es_results:
-        d = convert_es_to_da(result, get_score_breakdown)[0]
+    if lightweight:
+        matches = [
+            convert_es_hit_to_lightweight_doc(result, get_score_breakdown)
+            for result in es_results
+        ]
+    else:
+        convert = partial(
+            convert_es_hit_to_doc, get_score_breakdown=get_score_breakdown
+        )
+        payload_bytes = sum(
+            len(result['_source'].get('serialized_doc', '')) for result in es_results
+        )
+        if pool is not None and payload_bytes >= parallel_decode_min_bytes:
+            matches = list(pool.map(convert, es_results))
+        else:
+            matches = [convert(result) for result in es_results]
+    for d, result in zip(matches, es_results):
         d.scores[metric] = NamedScore(value=result['_score'])
-        if get_score_breakdown:
-            d = calculate_score_breakdown(query_doc, d, semantic_scores, metric)
         d.embedding = None
-        matches.append(d)
-    return matches
+    if get_score_breakdown:
+        calculate_score_breakdowns(query_doc, matches, semantic_scores, metric)
+    return DocumentArray(matches)
 
 
-def calculate_score_breakdown(
-    query_doc: Document, retrieved_doc: Document, semantic_scores, metric
-) -> Document:
+def calculate_score_breakdowns(
+    query_doc: Document, retrieved_docs: List[Document], semantic_scores, metric
+) -> List[Document]:
     """
-    Calculate the score breakdown for a given retrieved document. Each semantic score in the indexer's
+    Calculate the score breakdown for all retrieved documents of a query. Each semantic score in the indexer's
     `semantic_scores` should have a corresponding value, returned inside a list of scores in the documents
-    tags under `score_breakdown`.
+    tags under `score_breakdown`. The scores of one semantic score are computed for all documents at once.
 
     :param query_doc: The query document. Contains embeddings for the semantic score calculation at tag level.
-    :param retrieved_doc: The Elasticsearch results, containing embeddings inside the `_source` field.
+    :param retrieved_docs: The Elasticsearch results, containing either the similarities computed by
+        Elasticsearch or embeddings inside the `_source` field.
     :param semantic_scores: The semantic scores to be used for the score breakdown.
     :param metric: The metric to be used for the score breakdown.
 
-    :return: List of integers representing the score breakdown.
+    :return: the retrieved documents with their score breakdowns.
     """
-    retrieved_doc.scores['total'] = retrieved_doc.scores.pop(
-        metric
-    )  # save the final script score as total
+    vector_scores = [[] for _ in retrieved_docs]
+    for retrieved_doc in retrieved_docs:
+        # save the final script score as total
+        retrieved_doc.scores['total'] = retrieved_doc.scores.pop(metric)
     add_bm25 = False
     for (
         query_field,
@@ -152,47 +389,94 @@ def calculate_score_breakdown(
         if encoder == 'bm25':
             add_bm25 = True
             continue
-        q_emb = query_doc.tags['embeddings'][f'{query_field}-{encoder}']
-        d_emb = retrieved_doc.tags['embeddings'][
-            f'{document_field}-{encoder}.embedding'
-        ]
-        if metric == 'cosine':
-            score = calculate_cosine(d_emb, q_emb) * linear_weight
-        elif metric == 'l2_norm':
-            score = calculate_l2_norm(d_emb, q_emb) * linear_weight
-        else:
-            raise ValueError(f'Invalid metric {metric}')
-        retrieved_doc.scores[
-            '-'.join(
-                [
-                    query_field,
-                    document_field,
-                    encoder,
-                    str(linear_weight),
-                ]
-            )
-        ] = NamedScore(value=round(score, 6))
-
-    if add_bm25:
-        # calculate bm25 score
-        vector_total = sum(
-            [v.value for k, v in retrieved_doc.scores.items() if k != 'total']
+        score_name = '-'.join(
+            [
+                query_field,
+                document_field,
+                encoder,
+                str(linear_weight),
+            ]
         )
-        bm25_normalized = retrieved_doc.scores['total'].value - vector_total - 1
-        bm25_raw = bm25_normalized * 10
-        retrieved_doc.scores['bm25_normalized'] = NamedScore(
-            value=round(bm25_normalized, 6)
+        scores = (
+            get_similarities(
+                query_doc,
+                retrieved_docs,
+                score_name,
+                f'{query_field}-{encoder}',
+                f'{document_field}-{encoder}.embedding',
+                metric,
+            )
+            * linear_weight
         )
-        retrieved_doc.scores['bm25_raw'] = NamedScore(value=round(bm25_raw, 6))
-
-    # remove embeddings from document
-    retrieved_doc.tags.pop('embeddings', None)
-    return retrieved_doc
+        for retrieved_doc, doc_vector_scores, score in zip(
+            retrieved_docs, vector_scores, scores.tolist()
+        ):
+            score = round(score, 6)
+            retrieved_doc.scores[score_name] = NamedScore(value=score)
+            doc_vector_scores.append(score)
 
+    for retrieved_doc, doc_vector_scores in zip(retrieved_docs, vector_scores):
+        if add_bm25:
+            # calculate bm25 score
+            bm25_normalized = (
+                retrieved_doc.scores['total'].value - sum(doc_vector_scores) - 1
+            )
+            bm25_raw = bm25_normalized * 10
+            retrieved_doc.scores['bm25_normalized'] = NamedScore(
+                value=round(bm25_normalized, 6)
+            )
+            retrieved_doc.scores['bm25_raw'] = NamedScore(value=round(bm25_raw, 6))
+        # remove embeddings and similarities from document
+        retrieved_doc.tags.pop('embeddings', None)
+        retrieved_doc.tags.pop('similarities', None)
+    return retrieved_docs
 
-def calculate_l2_norm(d_emb, q_emb):
-    return norm(q_emb - d_emb)
 
+def get_similarities(
+    query_doc: Document,
+    retrieved_docs: List[Document],
+    score_name: str,
+    query_embedding_name: str,
+    document_embedding_name: str,
+    metric: str,
+) -> np.ndarray:
+    """
+    Get the similarities between a query field and a document field for all retrieved documents.
+    Similarities computed by Elasticsearch are used if available. The others are computed with
+    a single matrix-vector product between the stacked document embeddings and the query embedding.
 
-def calculate_cosine(d_emb, q_emb):
-    return dot(q_emb, d_emb) / (norm(q_emb) * norm(d_emb))
+    :param query_doc: The query document, with its embeddings at tag level.
+    :param retrieved_docs: The retrieved documents, with similarities or embeddings at tag level.
+    :param score_name: The name of the similarity computed by Elasticsearch.
+    :param query_embedding_name: The name of the query embedding in the tags of the query document.
+    :param document_embedding_name: The name of the document embedding in the tags of the retrieved documents.
+    :param metric: The metric of the similarity.
+    :return: array with the similarity of every retrieved document.
+    """
+    similarities = np.zeros(len(retrieved_docs))
+    missing = []
+    for i, retrieved_doc in enumerate(retrieved_docs):
+        doc_similarities = retrieved_doc.tags.get('similarities', {})
+        if score_name in doc_similarities:
+            similarities[i] = doc_similarities[score_name] or 0.0
+        else:
+            missing.append(i)
+    if missing:
+        # cast to float, quantized embeddings would overflow as integers
+        q_emb = np.asarray(query_doc.tags['embeddings'][query_embedding_name], float)
+        d_embs = np.asarray(
+            [
+                retrieved_docs[i].tags['embeddings'][document_embedding_name]
+                for i in missing
+            ],
+            dtype=float,
+        )
+        if metric == 'cosine':
+            similarities[missing] = (d_embs @ q_emb) / (
+                norm(d_embs, axis=1) * norm(q_emb)
+            )
+        elif metric == 'l2_norm':
+            similarities[missing] = norm(d_embs - q_emb, axis=1)
+        else:
+            raise ValueError(f'Invalid metric {metric}')
+    return similarities
@@ -1,13 +1,83 @@
+import json
 from collections import defaultdict
-from typing import Dict, List, Optional, Tuple, Union
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from docarray import Document, DocumentArray
+from numpy.linalg import norm
+
+from now.executor.indexer.elastic.es_converter import quantize_embedding
 
 metrics_mapping = {
     'cosine': 'cosineSimilarity',
     'l2_norm': 'l2norm',
 }
 
+SEARCH_MODES = ['exact', 'approximate', 'rescore']
+RANGE_OPERATORS = {'$gt': 'gt', '$gte': 'gte', '$lt': 'lt', '$lte': 'lte'}
+FILTER_OPERATORS = ['$eq', '$ne', '$in', '$nin', '$exists', *RANGE_OPERATORS]
+DEFAULT_NUM_CANDIDATES = 100
+DEFAULT_RESCORE_WINDOW_SIZE = 100
+
+# Stored script which computes the semantic score of `build_es_queries` from its
+# params. Referencing it by id means Elasticsearch compiles it once, no matter
+# which fields, weights and metrics a query uses. The native vector functions can't
+# be called with a field name that changes inside a loop, so the similarities are
+# computed element by element, which is slower than the inline script per document.
+SEMANTIC_SCORE_SCRIPT_ID = 'now-semantic-score'
+SEMANTIC_SCORE_SCRIPT = {
+    'lang': 'painless',
+    'source': """
+        double score = params.bm25 ? 1.0 + _score / (_score + 10.0) : 1.0;
+        for (def entry : params.vectors) {
+            def field = doc[entry.field];
+            if (field.size() == 0) {
+                continue;
+            }
+            float[] v = field.vectorValue;
+            List q = params.query_vectors[entry.query];
+            double value = 0.0;
+            if (entry.metric == 'cosine') {
+                for (int i = 0; i < v.length; i++) {
+                    value += (double) q[i] * v[i];
+                }
+                value /= entry.query_norm * field.magnitude;
+            } else {
+                for (int i = 0; i < v.length; i++) {
+                    double diff = (double) q[i] - v[i];
+                    value += diff * diff;
+                }
+                value = Math.sqrt(value);
+            }
+            score += entry.weight * value;
+        }
+        return score;
+    """,
+}
+
+# Script which computes the similarity of a single query vector and document field.
+# It is used in `script_fields` to return the score breakdown of each hit, so that
+# the document embeddings don't have to be fetched.
+VECTOR_SIMILARITY_SCRIPT = """
+    def field = doc[params.field];
+    if (field.size() == 0) {
+        return null;
+    }
+    float[] v = field.vectorValue;
+    double value = 0.0;
+    if (params.metric == 'cosine') {
+        for (int i = 0; i < v.length; i++) {
+            value += (double) params.query_vector[i] * v[i];
+        }
+        return value / (params.query_norm * field.magnitude);
+    }
+    for (int i = 0; i < v.length; i++) {
+        double diff = (double) params.query_vector[i] - v[i];
+        value += diff * diff;
+    }
+    return Math.sqrt(value);
+"""
+
 
 def generate_semantic_scores(
     docs_map: Dict[str, DocumentArray],
@@ -59,6 +129,8 @@ def build_es_queries(
     metric: Optional[str] = 'cosine',
     filter: dict = {},
     query_to_curated_ids: Dict[str, list] = {},
+    stored_script: bool = False,
+    vector_element_type: str = 'float',
 ) -> Dict:
     """
     Build script-score query used in Elasticsearch. To do this, we extract
@@ -77,15 +149,21 @@ def build_es_queries(
     :param semantic_scores: list of semantic scores used to calculate a score for a document.
     :param custom_bm25_query: custom query to use for BM25.
     :param metric: metric to use for vector search.
-    :param filter: dictionary of filters to apply to the search.
+    :param filter: dictionary of filters to apply to the search, see `compile_filter`.
     :param query_to_curated_ids: dictionary mapping query text to list of curated ids.
+    :param stored_script: whether to reference the stored `SEMANTIC_SCORE_SCRIPT` with
+        parameters instead of building an inline script for each query.
+    :param vector_element_type: element type of the vector fields. If 'byte', query
+        embeddings are quantized like the indexed ones.
     :return: a dictionary containing query and filter.
     """
+    filter_clauses = compile_filter(filter)
     queries = {}
     pinned_queries = {}
     docs = {}
     sources = {}
     script_params = defaultdict(dict)
+    stored_script_params = {}
     for executor_name, da in docs_map.items():
         for doc in da:
             if doc.id not in docs:
@@ -98,7 +176,7 @@ def build_es_queries(
                     apply_default_bm25,
                     semantic_scores,
                     custom_bm25_query,
-                    filter,
+                    filter_clauses,
                 )
                 pinned_queries[doc.id] = get_pinned_query(
                     doc,
@@ -109,6 +187,11 @@ def build_es_queries(
                     sources[doc.id] = '1.0 + _score / (_score + 10.0)'
                 else:
                     sources[doc.id] = '1.0'
+                stored_script_params[doc.id] = {
+                    'bm25': bool(apply_default_bm25 or custom_bm25_query),
+                    'query_vectors': {},
+                    'vectors': [],
+                }
 
             for (
                 query_field,
@@ -116,11 +199,13 @@ def build_es_queries(
                 encoder,
                 linear_weight,
             ) in get_scores(executor_name, semantic_scores):
-                field_doc = getattr(doc, query_field)
+                query_embedding = get_query_embedding(
+                    getattr(doc, query_field), vector_element_type
+                )
                 if get_score_breakdown:
                     docs[doc.id].tags['embeddings'][
                         f'{query_field}-{encoder}'
-                    ] = field_doc.embedding
+                    ] = query_embedding
 
                 query_string = f'params.query_{query_field}_{executor_name}'
                 document_string = f'{document_field}-{encoder}'
@@ -131,20 +216,40 @@ def build_es_queries(
 
                 script_params[doc.id][
                     f'query_{query_field}_{executor_name}'
-                ] = field_doc.embedding
+                ] = query_embedding
+
+                stored_script_params[doc.id]['query_vectors'][
+                    f'query_{query_field}_{executor_name}'
+                ] = query_embedding
+                stored_script_params[doc.id]['vectors'].append(
+                    {
+                        'query': f'query_{query_field}_{executor_name}',
+                        'query_norm': float(norm(query_embedding)),
+                        'field': f'{document_string}.embedding',
+                        'weight': float(linear_weight),
+                        'metric': metric,
+                    }
+                )
 
     es_queries = []
 
     for doc_id, query in queries.items():
+        if stored_script:
+            script = {
+                'id': SEMANTIC_SCORE_SCRIPT_ID,
+                'params': stored_script_params[doc_id],
+            }
+        else:
+            script = {
+                'source': sources[doc_id],
+                'params': script_params[doc_id],
+            }
         script_score = {
             'script_score': {
                 'query': {
                     'bool': query['bool'],
                 },
-                'script': {
-                    'source': sources[doc_id],
-                    'params': script_params[doc_id],
-                },
+                'script': script,
             },
         }
         if pinned_queries[doc_id]:
@@ -156,12 +261,230 @@ def build_es_queries(
     return es_queries
 
 
+def build_es_knn_queries(
+    docs_map,
+    apply_default_bm25: bool,
+    get_score_breakdown: bool,
+    semantic_scores: List[Tuple],
+    limit: int,
+    num_candidates: Union[int, Dict[str, int]] = DEFAULT_NUM_CANDIDATES,
+    custom_bm25_query: Optional[dict] = None,
+    filter: dict = {},
+    query_to_curated_ids: Dict[str, list] = {},
+    vector_element_type: str = 'float',
+) -> List[Tuple[Document, Dict]]:
+    """
+    Build approximate kNN search requests used in Elasticsearch. Instead of scoring
+    every document with a script, each semantic score becomes a top-level `knn` clause
+    which is answered by the HNSW graph of its document field and boosted by its
+    linear weight. BM25 scoring is added as a `query` next to the `knn` clauses, and
+    the filter is applied to both of them.
+    The query document will be returned with all of its embeddings as tags with
+    their corresponding field+encoder as key.
+
+    Note that Elasticsearch scores kNN hits with a normalized similarity, e.g.
+    `(1 + cosine) / 2` for cosine, so scores differ from the ones of `build_es_queries`.
+
+    :param docs_map: dictionary mapping encoder to DocumentArray.
+    :param apply_default_bm25: whether to combine bm25 with vector search.
+    :param get_score_breakdown: whether to return the embeddings of a query document.
+    :param semantic_scores: list of semantic scores used to calculate a score for a document.
+    :param limit: number of nearest neighbours to retrieve per `knn` clause.
+    :param num_candidates: number of candidates each shard considers per `knn` clause.
+        Either a single value or a dictionary mapping `{document_field}-{encoder}` to
+        a value. Fields missing in the dictionary use `DEFAULT_NUM_CANDIDATES`.
+    :param custom_bm25_query: custom query to use for BM25.
+    :param filter: dictionary of filters to apply to the search, see `compile_filter`.
+    :param query_to_curated_ids: dictionary mapping query text to list of curated ids.
+    :param vector_element_type: element type of the vector fields. If 'byte', query
+        embeddings are quantized like the indexed ones.
+    :return: a list of tuples of query document and search request body.
+    """
+    filter_clauses = compile_filter(filter)
+    docs = {}
+    knn_clauses = defaultdict(list)
+    for executor_name, da in docs_map.items():
+        for doc in da:
+            if doc.id not in docs:
+                docs[doc.id] = doc
+                docs[doc.id].tags['embeddings'] = {}
+
+            for (
+                query_field,
+                document_field,
+                encoder,
+                linear_weight,
+            ) in get_scores(executor_name, semantic_scores):
+                query_embedding = get_query_embedding(
+                    getattr(doc, query_field), vector_element_type
+                )
+                if get_score_breakdown:
+                    docs[doc.id].tags['embeddings'][
+                        f'{query_field}-{encoder}'
+                    ] = query_embedding
+
+                document_string = f'{document_field}-{encoder}'
+                if isinstance(num_candidates, dict):
+                    field_num_candidates = num_candidates.get(
+                        document_string, DEFAULT_NUM_CANDIDATES
+                    )
+                else:
+                    field_num_candidates = num_candidates
+                knn = {
+                    'field': f'{document_string}.embedding',
+                    'query_vector': query_embedding,
+                    'k': limit,
+                    'num_candidates': max(limit, field_num_candidates),
+                    'boost': float(linear_weight),
+                }
+                if filter_clauses:
+                    knn['filter'] = filter_clauses
+                knn_clauses[doc.id].append(knn)
+
+    es_queries = []
+    for doc_id, doc in docs.items():
+        body = {'knn': knn_clauses[doc_id]}
+        query = None
+        bm25_query = get_bm25_query(
+            doc, apply_default_bm25, semantic_scores, custom_bm25_query
+        )
+        if bm25_query:
+            query = {'bool': {'should': [bm25_query], 'minimum_should_match': 1}}
+            if filter_clauses:
+                query['bool']['filter'] = filter_clauses
+        pinned_query = get_pinned_query(doc, query_to_curated_ids)
+        if pinned_query:
+            pinned_query['pinned']['organic'] = query or {'match_none': {}}
+            query = pinned_query
+        if query:
+            body['query'] = query
+        es_queries.append((doc, body))
+    return es_queries
+
+
+def build_es_rescore_queries(
+    docs_map,
+    apply_default_bm25: bool,
+    get_score_breakdown: bool,
+    semantic_scores: List[Tuple],
+    limit: int,
+    window_size: int = DEFAULT_RESCORE_WINDOW_SIZE,
+    num_candidates: Union[int, Dict[str, int]] = DEFAULT_NUM_CANDIDATES,
+    custom_bm25_query: Optional[dict] = None,
+    metric: Optional[str] = 'cosine',
+    filter: dict = {},
+    query_to_curated_ids: Dict[str, list] = {},
+    stored_script: bool = False,
+    vector_element_type: str = 'float',
+) -> List[Tuple[Document, Dict]]:
+    """
+    Build two-stage search requests used in Elasticsearch. The `knn` clauses of
+    `build_es_knn_queries` collect a candidate set, and a `rescore` step then applies
+    the exact script-score query of `build_es_queries` to the top `window_size`
+    candidates only. Scores of the returned matches are the ones of the exact query,
+    but only the candidates need to be scored with the script.
+
+    :param docs_map: dictionary mapping encoder to DocumentArray.
+    :param apply_default_bm25: whether to combine bm25 with vector search.
+    :param get_score_breakdown: whether to return the embeddings of a query document.
+    :param semantic_scores: list of semantic scores used to calculate a score for a document.
+    :param limit: number of matches to retrieve.
+    :param window_size: number of candidates per shard which are rescored. Is at least `limit`.
+    :param num_candidates: number of candidates each shard considers per `knn` clause.
+    :param custom_bm25_query: custom query to use for BM25.
+    :param metric: metric to use for the exact scores.
+    :param filter: dictionary of filters to apply to the search, see `compile_filter`.
+    :param query_to_curated_ids: dictionary mapping query text to list of curated ids.
+    :param stored_script: whether to use the stored `SEMANTIC_SCORE_SCRIPT` for rescoring.
+    :param vector_element_type: element type of the vector fields.
+    :return: a list of tuples of query document and search request body.
+    """
+    window_size = max(limit, window_size)
+    knn_queries = build_es_knn_queries(
+        docs_map=docs_map,
+        apply_default_bm25=apply_default_bm25,
+        get_score_breakdown=get_score_breakdown,
+        semantic_scores=semantic_scores,
+        limit=window_size,
+        num_candidates=num_candidates,
+        custom_bm25_query=custom_bm25_query,
+        filter=filter,
+        query_to_curated_ids=query_to_curated_ids,
+        vector_element_type=vector_element_type,
+    )
+    exact_queries = build_es_queries(
+        docs_map=docs_map,
+        apply_default_bm25=apply_default_bm25,
+        get_score_breakdown=get_score_breakdown,
+        semantic_scores=semantic_scores,
+        custom_bm25_query=custom_bm25_query,
+        metric=metric,
+        filter=filter,
+        query_to_curated_ids=query_to_curated_ids,
+        stored_script=stored_script,
+        vector_element_type=vector_element_type,
+    )
+    es_queries = []
+    for (doc, body), (_, exact_query) in zip(knn_queries, exact_queries):
+        body['rescore'] = {
+            'window_size': window_size,
+            'query': {
+                'rescore_query': exact_query,
+                'query_weight': 0.0,
+                'rescore_query_weight': 1.0,
+            },
+        }
+        es_queries.append((doc, body))
+    return es_queries
+
+
+def get_score_breakdown_script_fields(
+    query_doc: Document, semantic_scores: List[Tuple], metric: str = 'cosine'
+) -> Dict:
+    """
+    Build `script_fields` which return the similarity of each vector semantic score
+    for every hit. The query document needs the embeddings in its tags, as returned
+    by the query building functions with `get_score_breakdown` enabled.
+
+    :param query_doc: the query document.
+    :param semantic_scores: list of semantic scores used to calculate a score for a document.
+    :param metric: metric to use for the similarities.
+    :return: dictionary of script fields, named like the scores of the score breakdown.
+    """
+    script_fields = {}
+    for query_field, document_field, encoder, linear_weight in semantic_scores:
+        if encoder == 'bm25':
+            continue
+        query_vector = query_doc.tags['embeddings'][f'{query_field}-{encoder}']
+        score_name = '-'.join(
+            [query_field, document_field, encoder, str(linear_weight)]
+        )
+        script_fields[score_name] = {
+            'script': {
+                'source': VECTOR_SIMILARITY_SCRIPT,
+                'params': {
+                    'query_vector': query_vector,
+                    'query_norm': float(norm(query_vector)),
+                    'field': f'{document_field}-{encoder}.embedding',
+                    'metric': metric,
+                },
+            }
+        }
+    return script_fields
+
+
+def get_query_embedding(field_doc: Document, vector_element_type: str = 'float'):
+    if vector_element_type == 'byte':
+        return quantize_embedding(field_doc.embedding)
+    return field_doc.embedding
+
+
 def get_default_query(
     doc: Document,
     apply_default_bm25: bool,
     semantic_scores: List[Tuple],
     custom_bm25_query: Dict = None,
-    filter: Dict = {},
+    filter_clauses: List[Dict] = [],
 ):
     query = {
         'bool': {
@@ -172,6 +495,25 @@ def get_default_query(
     }
 
     # build bm25 part
+    bm25_query = get_bm25_query(
+        doc, apply_default_bm25, semantic_scores, custom_bm25_query
+    )
+    if bm25_query:
+        query['bool']['should'].append(bm25_query)
+
+    # add filter
+    if filter_clauses:
+        query['bool']['filter'] = filter_clauses
+
+    return query
+
+
+def get_bm25_query(
+    doc: Document,
+    apply_default_bm25: bool,
+    semantic_scores: List[Tuple],
+    custom_bm25_query: Dict = None,
+) -> Optional[Dict]:
     if apply_default_bm25:
         bm25_semantic_score = next((x for x in semantic_scores if x[2] == 'bm25'))
         if not bm25_semantic_score:
@@ -179,17 +521,10 @@ def get_default_query(
                 'No bm25 semantic scores found. Please specify this in the semantic_scores parameter.'
             )
         text = getattr(doc, bm25_semantic_score[0]).text
-        multi_match = {'multi_match': {'query': text, 'fields': ['bm25_text']}}
-        query['bool']['should'].append(multi_match)
+        return {'multi_match': {'query': text, 'fields': ['bm25_text']}}
     elif custom_bm25_query:
-        query['bool']['should'].append(custom_bm25_query)
-
-    # add filter
-    if filter:
-        es_search_filter = process_filter(filter)
-        query['bool']['filter'] = es_search_filter
-
-    return query
+        return custom_bm25_query
+    return None
 
 
 def get_pinned_query(doc: Document, query_to_curated_ids: Dict[str, list] = {}) -> Dict:
@@ -201,17 +536,54 @@ def get_pinned_query(doc: Document, query_to_curated_ids: Dict[str, list] = {})
     return pinned_query
 
 
-def process_filter(filter) -> dict:
-    es_search_filter = {}
-    for field, filters in filter.items():
-        for operator, filter in filters.items():
-            field = field.replace('__', '.')
-            if isinstance(filter, str):
-                es_search_filter['term'] = {field: filter}
-            elif isinstance(filter, int) or isinstance(filter, float):
-                operator = operator.replace('$', '')
-                es_search_filter['range'] = {field: {operator: filter}}
-    return es_search_filter
+def compile_filter(filter: Dict[str, Dict[str, Any]]) -> List[Dict]:
+    """
+    Compile a filter like `{'tags__color': {'$in': ['red', 'blue']}, 'tags__price':
+    {'$gte': 1, '$lt': 10}}` into the clauses of a `bool.filter`. Every condition
+    becomes a clause of its own, the range conditions of a field are merged into one
+    `range` clause, and negated conditions are collected in one `must_not`. Identical
+    filters compile to identical clauses, whose bitsets Elasticsearch caches.
+
+    Compiled filters are memoized, so the returned clauses must not be modified.
+
+    :param filter: dictionary mapping a field, with `__` as separator of nested
+        fields, to a dictionary mapping one of `FILTER_OPERATORS` to a value.
+    :return: list of filter clauses, empty for an empty filter.
+    """
+    if not filter:
+        return []
+    return _compile_filter(json.dumps(filter, sort_keys=True))
+
+
+@lru_cache(maxsize=1024)
+def _compile_filter(filter_json: str) -> List[Dict]:
+    clauses = []
+    must_not = []
+    for field, conditions in json.loads(filter_json).items():
+        field = field.replace('__', '.')
+        ranges = {}
+        for operator, value in conditions.items():
+            if operator == '$eq':
+                clauses.append({'term': {field: value}})
+            elif operator == '$ne':
+                must_not.append({'term': {field: value}})
+            elif operator == '$in':
+                clauses.append({'terms': {field: value}})
+            elif operator == '$nin':
+                must_not.append({'terms': {field: value}})
+            elif operator == '$exists':
+                (clauses if value else must_not).append({'exists': {'field': field}})
+            elif operator in RANGE_OPERATORS:
+                ranges[RANGE_OPERATORS[operator]] = value
+            else:
+                raise ValueError(
+                    f'Invalid filter operator {operator}, must be one of {FILTER_OPERATORS}'
+                )
+        if ranges:
+            clauses.append({'range': {field: ranges}})
+    if must_not:
+        clauses.append({'bool': {'must_not': must_not}})
+    return clauses
 
 
 def get_scores(encoder, semantic_scores):
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from time import time
+from typing import Dict, Optional
+
+import numpy as np
+from docarray import DocumentArray
+
+
+class SearchResultCache:
+    """
+    In-process LRU cache for the matches of search queries. It is bounded by the
+    number of entries and by the total size of the cached values in bytes, and
+    entries expire after `ttl` seconds.
+
+    Every write to the index has to call `invalidate`, which bumps the generation of
+    the cache. Entries from an older generation are never served. The cache only sees
+    writes of its own process, writes of other replicas are propagated by
+    `NOWElasticIndexer.sync_search_cache`.
+    """
+
+    def __init__(
+        self, max_entries: int = 1000, max_bytes: int = 2**26, ttl: float = 600
+    ):
+        """
+        :param max_entries: maximum number of cached queries. 0 disables the cache.
+        :param max_bytes: maximum total size of all cached values in bytes.
+        :param ttl: time in seconds after which an entry expires.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.size_bytes = 0
+        self._entries = OrderedDict()  # key -> (generation, timestamp, value)
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.max_bytes > 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Return the cached value for `key`, or None if it is missing or stale."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                generation, timestamp, value = entry
+                if generation == self.generation and time() - timestamp < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: bytes, generation: int):
+        """Cache `value` under `key` and evict the least recently used entries
+        until the cache is within its bounds again.
+
+        :param key: cache key of the query.
+        :param value: serialized matches of the query.
+        :param generation: generation of the cache when the search started. Values
+            computed before an invalidation are dropped.
+        """
+        if not self.enabled or len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (self.generation, time(), value)
+            self.size_bytes += len(value)
+            while (
+                len(self._entries) > self.max_entries
+                or self.size_bytes > self.max_bytes
+            ):
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self):
+        """Bump the generation, so that all cached entries become stale."""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def stats(self) -> Dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+            'size_bytes': self.size_bytes,
+            'generation': self.generation,
+        }
+
+    def _remove(self, key: str):
+        _, _, value = self._entries.pop(key)
+        self.size_bytes -= len(value)
+
+
+def get_search_cache_key(
+    docs_map: Dict[str, DocumentArray], doc_id: str, parameters: Dict
+) -> str:
+    """
+    Hash a query document together with the search parameters into a cache key.
+    The content and embeddings of every field of the query document are part of
+    the key for each encoder.
+
+    :param docs_map: dictionary mapping encoder to DocumentArray of query documents.
+    :param doc_id: id of the query document.
+    :param parameters: search parameters which influence the matches, e.g. filter,
+        limit, semantic scores, bm25 settings and curated ids.
+    :return: hex digest identifying the query.
+    """
+    key = hashlib.sha256()
+    key.update(json.dumps(parameters, sort_keys=True, default=str).encode())
+    for encoder in sorted(docs_map):
+        doc = docs_map[encoder][doc_id]
+        key.update(encoder.encode())
+        for field_name in sorted(doc._metadata['multi_modal_schema'].keys()):
+            chunk = getattr(doc, field_name)
+            key.update(field_name.encode())
+            key.update((chunk.text or chunk.uri or '').encode())
+            if chunk.embedding is not None:
+                key.update(np.asarray(chunk.embedding).tobytes())
+    return key.hexdigest()
@@ -0,0 +1,118 @@
+import json
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+
+
+class TagValueIndex:
+    """
+    In-memory index of the values of the filter fields in the tags of the indexed
+    documents. Every value is reference counted with the number of documents which
+    have it, so that values disappear once their last document is deleted.
+
+    Values are tracked in the string form in which Elasticsearch indexes them into
+    keyword fields, see `get_keyword_value`, so that the values of written documents
+    and of aggregations over the index match.
+
+    The number of values per tag is capped. Values of a tag which exceed the cap are
+    not tracked and the tag is marked as overflowed instead.
+    """
+
+    def __init__(self, filter_fields: Iterable[str], max_values_per_tag: int = 1000):
+        """
+        :param filter_fields: tags whose values are tracked.
+        :param max_values_per_tag: maximum number of values tracked per tag.
+        """
+        self.filter_fields = list(filter_fields)
+        self.max_values_per_tag = max_values_per_tag
+        self._counts: Dict[str, Dict[Any, int]] = {}
+        self._overflowed = set()
+        self._lock = threading.Lock()
+
+    def add(self, tags: Dict):
+        """Add the tag values of a written document."""
+        self._update(tags, 1)
+
+    def remove(self, tags: Dict):
+        """Remove the tag values of a deleted document."""
+        self._update(tags, -1)
+
+    def remove_counts(self, value_counts: Dict[str, Dict[Any, int]]):
+        """Remove the tag values of several deleted documents.
+
+        :param value_counts: dictionary mapping each tag to a dictionary of values and
+            their number of deleted documents.
+        """
+        with self._lock:
+            for tag, counts in value_counts.items():
+                if tag not in self.filter_fields:
+                    continue
+                for value, count in counts.items():
+                    self._change(tag, value, -count)
+
+    def reset(self, value_counts: Dict[str, Dict[Any, int]]):
+        """Replace all values and their counts, e.g. with an aggregation over the index.
+
+        :param value_counts: dictionary mapping each tag to a dictionary of values and
+            their number of documents. Tags with more than `max_values_per_tag` values
+            are marked as overflowed.
+        """
+        with self._lock:
+            self._counts = {}
+            self._overflowed = set()
+            for tag, counts in value_counts.items():
+                if tag not in self.filter_fields:
+                    continue
+                keyword_counts = {}
+                for value, count in counts.items():
+                    key = get_keyword_value(value)
+                    keyword_counts[key] = keyword_counts.get(key, 0) + count
+                self._counts[tag] = dict(
+                    list(keyword_counts.items())[: self.max_values_per_tag]
+                )
+                if len(keyword_counts) > self.max_values_per_tag:
+                    self._overflowed.add(tag)
+
+    def to_dict(self) -> Dict[str, List]:
+        """Return the tracked values of every tag."""
+        with self._lock:
+            return {tag: list(counts) for tag, counts in self._counts.items()}
+
+    @property
+    def overflowed(self) -> List[str]:
+        """Tags which have more values than `max_values_per_tag`."""
+        with self._lock:
+            return sorted(self._overflowed)
+
+    def _update(self, tags: Optional[Dict], delta: int):
+        if not tags:
+            return
+        with self._lock:
+            for tag in self.filter_fields:
+                if tag not in tags:
+                    continue
+                values = tags[tag] if isinstance(tags[tag], list) else [tags[tag]]
+                for value in values:
+                    if value is not None:
+                        self._change(tag, value, delta)
+
+    def _change(self, tag: str, value: Any, delta: int):
+        value = get_keyword_value(value)
+        counts = self._counts.setdefault(tag, {})
+        if value in counts:
+            counts[value] += delta
+            if counts[value] <= 0:
+                del counts[value]
+        elif delta > 0:
+            if len(counts) < self.max_values_per_tag:
+                counts[value] = delta
+            else:
+                self._overflowed.add(tag)
+
+
+def get_keyword_value(value: Any) -> str:
+    """
+    Convert a tag value to the string which Elasticsearch indexes for it in a keyword
+    field, and which is the key of its terms aggregation, e.g. `5.0` to `'5.0'` and
+    `True` to `'true'`.
+    """
+    return value if isinstance(value, str) else json.dumps(value)
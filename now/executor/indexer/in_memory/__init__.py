@@ -0,0 +1 @@
+from .in_memory_indexer import NOWInMemoryIndexer
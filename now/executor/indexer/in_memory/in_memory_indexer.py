@@ -0,0 +1,773 @@
+import json
+import operator
+import os
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from docarray import Document, DocumentArray
+from docarray.score import NamedScore
+
+from now.constants import DatasetTypes
+from now.executor.abstract.auth import (
+    SecurityLevel,
+    get_auth_executor_class,
+    secure_request,
+)
+from now.executor.indexer.elastic.elastic_indexer import (
+    MAX_CURATED_IDS_PER_FILTER,
+    POOLING_STRATEGIES,
+    FieldEmbedding,
+    aggregate_embeddings,
+    create_temporary_links,
+)
+from now.executor.indexer.elastic.es_converter import (
+    DEFAULT_SERIALIZATION_FORMAT,
+    SERIALIZATION_FORMATS,
+    calculate_score_breakdowns,
+    convert_doc_map_to_es,
+    deserialize_doc,
+)
+from now.executor.indexer.elastic.es_query_building import (
+    generate_semantic_scores,
+    get_pinned_query,
+)
+from now.executor.indexer.elastic.tag_index import TagValueIndex
+from now.executor.indexer.in_memory.vector_store import (
+    METRICS,
+    VECTOR_DTYPES,
+    VectorStore,
+)
+
+# operators which match a document if any of its values matches, like in Elasticsearch
+FILTER_OPERATORS = {
+    '$eq': operator.eq,
+    '$in': lambda row_value, values: row_value in values,
+    '$exists': lambda row_value, exists: True,
+    '$gt': operator.gt,
+    '$gte': operator.ge,
+    '$lt': operator.lt,
+    '$lte': operator.le,
+}
+RANGE_FILTER_OPERATORS = ['$gt', '$gte', '$lt', '$lte']
+# operators which match the documents the positive operator doesn't match, including
+# documents without the field, like a `must_not` clause in Elasticsearch
+NEGATED_FILTER_OPERATORS = {'$ne': '$eq', '$nin': '$in'}
+# minimum number of records in the log before it is compacted
+MIN_COMPACTED_LOG_RECORDS = 1000
+
+Executor = get_auth_executor_class()
+
+
+class NOWInMemoryIndexer(Executor):
+    """
+    NOWInMemoryIndexer indexes Documents without an external search engine, e.g. for
+    small deployments. It has the same endpoints as the NOWElasticIndexer and scores
+    documents with the same semantic scores, but without bm25.
+
+    The vectors of every field and encoder are kept in a matrix, which is memory mapped
+    from the workspace, and searched with one matrix multiplication per request. The
+    documents and their tags are kept in memory and persisted in an append-only log in
+    the workspace, which is compacted once enough of its records are outdated. Equality
+    filters on the filter fields are answered with boolean masks, which are updated
+    with every write.
+    """
+
+    def __init__(
+        self,
+        document_mappings: List[Tuple[str, int, List[str]]],
+        metric: str = 'cosine',
+        limit: int = 10,
+        max_values_per_tag: int = 1000,
+        vector_dtype: str = 'float32',
+        serialization_format: str = DEFAULT_SERIALIZATION_FORMAT,
+        initial_capacity: int = 1024,
+        pooling: str = 'mean',
+        log_compaction_ratio: float = 0.5,
+        *args,
+        **kwargs,
+    ):
+        """
+        :param document_mappings: list of FieldEmbedding tuples that define which encoder
+            encodes which fields, and the embedding size of the encoder.
+        :param metric: Distance metric type. Can be 'cosine' or 'l2_norm'.
+        :param limit: Number of results to get for each query document in search
+        :param max_values_per_tag: Maximum number of values per tag which are kept in
+            memory and returned by `/tags`. Tags with more values are marked as
+            overflowed and are filtered without masks.
+        :param vector_dtype: Element type of the vector matrices, 'float32' or 'float16'.
+            'float16' halves the memory, at the cost of precision.
+        :param serialization_format: Format in which documents are stored, one of
+            `SERIALIZATION_FORMATS`.
+        :param initial_capacity: Number of rows allocated for a new index. The matrices
+            double in size whenever they are full.
+        :param pooling: How the embeddings of the sentences of a text field, or the frames
+            of a video, are pooled into the embedding of the field. Either 'mean', 'max'
+            or 'first'.
+        :param log_compaction_ratio: Fraction of the records in the log of the workspace
+            which are outdated by later writes and deletes, at which the log is
+            rewritten with one record per document. Logs with fewer than
+            `MIN_COMPACTED_LOG_RECORDS` records aren't compacted.
+        """
+        super().__init__(*args, **kwargs)
+        if metric not in METRICS:
+            raise ValueError(f'Invalid metric {metric}, must be one of {METRICS}')
+        self.metric = metric
+        self.limit = limit
+        if vector_dtype not in VECTOR_DTYPES:
+            raise ValueError(
+                f'Invalid vector dtype {vector_dtype}, must be one of {VECTOR_DTYPES}'
+            )
+        if serialization_format not in SERIALIZATION_FORMATS:
+            raise ValueError(
+                f'Invalid serialization format {serialization_format}, must be one of {SERIALIZATION_FORMATS}'
+            )
+        self.serialization_format = serialization_format
+        if pooling not in POOLING_STRATEGIES:
+            raise ValueError(
+                f'Invalid pooling {pooling}, must be one of {POOLING_STRATEGIES}'
+            )
+        self.pooling = pooling
+        self.document_mappings = [FieldEmbedding(*dm) for dm in document_mappings]
+        self.encoder_to_fields = {
+            document_mapping.encoder: document_mapping.fields
+            for document_mapping in self.document_mappings
+        }
+        self.query_to_curated_ids = {}
+        self.filter_fields = self.user_input.filter_fields or []
+        self.tag_index = TagValueIndex(
+            filter_fields=self.filter_fields, max_values_per_tag=max_values_per_tag
+        )
+
+        self.index_path = (
+            os.path.join(self.workspace, 'in_memory_index') if self.workspace else None
+        )
+        if self.index_path:
+            os.makedirs(self.index_path, exist_ok=True)
+        self.vector_stores = {
+            f'{field}-{encoder}': VectorStore(
+                dim=embedding_size,
+                metric=metric,
+                dtype=vector_dtype,
+                path=self.index_path
+                and os.path.join(self.index_path, f'{field}-{encoder}'),
+                capacity=initial_capacity,
+            )
+            for encoder, embedding_size, fields in self.document_mappings
+            for field in fields
+        }
+        self._capacity = min(store.capacity for store in self.vector_stores.values())
+        # rows of the documents, rows of deleted documents are reused
+        self._ids: List[Optional[str]] = []
+        self._id_to_row: Dict[str, int] = {}
+        self._serialized_docs: List[Optional[str]] = []
+        self._serialization_formats: List[Optional[str]] = []
+        self._tags: List[Dict] = []
+        self._fields: List[Dict] = []
+        self._free_rows: Set[int] = set()
+        self._alive = np.zeros(self._capacity, dtype=bool)
+        # masks of the rows with each value of a filter field, None once a tag has
+        # more than `max_values_per_tag` values
+        self._tag_masks: Dict[str, Optional[Dict[Any, np.ndarray]]] = {
+            tag: {} for tag in self.filter_fields
+        }
+        # numeric values of the filter fields for range filters, NaN if not numeric
+        self._tag_numbers: Dict[str, np.ndarray] = {
+            tag: np.full(self._capacity, np.nan) for tag in self.filter_fields
+        }
+        self.log_path = (
+            os.path.join(self.index_path, 'documents.jsonl')
+            if self.index_path
+            else None
+        )
+        self.log_compaction_ratio = log_compaction_ratio
+        self._num_log_records = 0
+        if self.log_path and os.path.exists(self.log_path):
+            self._load()
+        self.curated_ids_path = (
+            os.path.join(self.index_path, 'curated_ids.json')
+            if self.index_path
+            else None
+        )
+        if self.curated_ids_path and os.path.exists(self.curated_ids_path):
+            with open(self.curated_ids_path, 'r') as fp:
+                self.query_to_curated_ids = json.load(fp)
+
+    @property
+    def num_rows(self) -> int:
+        return len(self._ids)
+
+    def _handle_no_docs_map(self, docs: DocumentArray):
+        if docs and len(self.encoder_to_fields) == 1:
+            return {list(self.encoder_to_fields.keys())[0]: docs}
+        else:
+            return {}
+
+    @secure_request(on='/index', level=SecurityLevel.USER)
+    def index(
+        self,
+        docs_map: Dict[str, DocumentArray] = None,  # encoder to docarray
+        parameters: dict = {},
+        docs: Optional[DocumentArray] = None,
+        **kwargs,
+    ) -> DocumentArray:
+        """
+        Index new `Document`s. Documents with the id of an indexed document replace it.
+
+        :param docs_map: map of encoder to DocumentArray
+        :param parameters: dictionary with options for indexing, unused.
+        :param docs: DocumentArray to index
+        :return: empty `DocumentArray`
+        """
+        if docs_map is None:
+            docs_map = self._handle_no_docs_map(docs)
+            if len(docs_map) == 0:
+                return DocumentArray()
+        aggregate_embeddings(docs_map, self.pooling)
+        records = []
+        for es_doc in convert_doc_map_to_es(
+            docs_map,
+            index_name='',
+            encoder_to_fields=self.encoder_to_fields,
+            serialization_format=self.serialization_format,
+        ):
+            doc_id = es_doc['_id']
+            row = self._id_to_row.get(doc_id)
+            if row is None:
+                row = self._allocate_row()
+            for name, store in self.vector_stores.items():
+                embedding = es_doc.get(f'{name}.embedding')
+                if embedding is None:
+                    store.clear(row)
+                else:
+                    store.set(row, embedding)
+            record = {
+                'row': row,
+                'id': doc_id,
+                'serialized_doc': es_doc['serialized_doc'],
+                'serialization_format': es_doc['serialization_format'],
+                'tags': es_doc.get('tags', {}),
+                'fields': {k: es_doc[k] for k in ['text', 'uri'] if k in es_doc},
+            }
+            self._set_row(record)
+            records.append(record)
+        self._persist(records)
+        self.logger.info(f'Inserted {len(records)} documents into the in-memory index')
+        return DocumentArray([])
+
+    @secure_request(on='/search', level=SecurityLevel.USER)
+    def search(
+        self,
+        docs_map: Dict[str, DocumentArray] = None,  # encoder to docarray
+        parameters: dict = {},
+        docs: Optional[DocumentArray] = None,
+        **kwargs,
+    ):
+        """Perform vector search with the semantic scores. The score of a document is
+        1 plus the weighted sum of the similarities of all semantic scores, as in the
+        NOWElasticIndexer. Semantic scores with the 'bm25' encoder are ignored.
+
+        The similarities of all query documents of a request are computed with one
+        matrix multiplication per semantic score, and the top documents are selected
+        with `np.argpartition`.
+
+        :param docs_map: map of encoder to DocumentArray
+        :param parameters: dictionary of options for searching.
+            Keys accepted:
+                - 'filter' (dict): The filtering conditions on document tags
+                - 'limit' (int): Number of matches to get per Document.
+                - 'get_score_breakdown' (bool): Wether to return the score breakdown, i.e. the scores of each
+                    field+encoder combination/comparison.
+                - 'semantic_scores' (list): The semantic scores, generated from the
+                    query documents if not given.
+        :param docs: DocumentArray to search
+        """
+        if docs_map is None:
+            docs_map = self._handle_no_docs_map(docs)
+            if len(docs_map) == 0:
+                return DocumentArray()
+        aggregate_embeddings(docs_map, self.pooling)
+
+        limit = int(parameters.get('limit', self.limit))
+        get_score_breakdown = parameters.get('get_score_breakdown', False)
+        semantic_scores = parameters.get('semantic_scores', None)
+        if not semantic_scores:
+            semantic_scores = generate_semantic_scores(docs_map, self.encoder_to_fields)
+        query_docs = {}
+        for documents in docs_map.values():
+            for doc in documents:
+                query_docs.setdefault(doc.id, doc)
+        query_ids = list(query_docs)
+        filter_mask = self._get_filter_mask(parameters.get('filter', {}))
+        scores, similarities = self._score(docs_map, query_ids, semantic_scores)
+        for column, query_id in enumerate(query_ids):
+            doc = query_docs[query_id]
+            pinned_rows = [
+                self._id_to_row[doc_id]
+                for doc_id in get_pinned_query(doc, self.query_to_curated_ids)
+                .get('pinned', {})
+                .get('ids', [])
+                if doc_id in self._id_to_row
+            ][:limit]
+            mask = filter_mask.copy()
+            mask[pinned_rows] = False
+            rows = pinned_rows + list(
+                top_k(scores[:, column], mask, limit - len(pinned_rows))
+            )
+            matches = []
+            for row in rows:
+                match = self._get_doc(row)
+                match.scores[self.metric] = NamedScore(value=float(scores[row, column]))
+                if get_score_breakdown:
+                    match.tags['similarities'] = {
+                        score_name: float(score_similarities[row, column])
+                        for score_name, score_similarities in similarities.items()
+                    }
+                matches.append(match)
+            if get_score_breakdown:
+                calculate_score_breakdowns(doc, matches, semantic_scores, self.metric)
+            doc.matches = DocumentArray(matches)
+        for documents in docs_map.values():
+            for doc in documents:
+                for c in doc.chunks:
+                    c.embedding = None
+        results = DocumentArray(list(query_docs.values()))
+        if (
+            parameters.get('create_temp_link', False)
+            and self.user_input.dataset_type == DatasetTypes.S3_BUCKET
+        ):
+            create_temporary_links(results, self.user_input)
+        return results
+
+    def _score(
+        self,
+        docs_map: Dict[str, DocumentArray],
+        query_ids: List[str],
+        semantic_scores: List[Tuple],
+    ) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """
+        Score all rows for all query documents.
+
+        :param docs_map: map of encoder to the query documents
+        :param query_ids: ids of the query documents, one column of the scores each
+        :param semantic_scores: the semantic scores
+        :return: array of shape `(num_rows, len(query_ids))` with the scores, and a
+            dictionary mapping the name of each semantic score in the score breakdown
+            to the unweighted similarities of the same shape
+        """
+        scores = np.ones((self.num_rows, len(query_ids)), dtype=np.float32)
+        similarities = {}
+        for query_field, document_field, encoder, linear_weight in semantic_scores:
+            store = self.vector_stores.get(f'{document_field}-{encoder}')
+            if encoder == 'bm25' or store is None or encoder not in docs_map:
+                continue
+            columns, query_embeddings = [], []
+            for column, query_id in enumerate(query_ids):
+                if query_id not in docs_map[encoder]:
+                    continue
+                embedding = getattr(docs_map[encoder][query_id], query_field).embedding
+                if embedding is not None:
+                    columns.append(column)
+                    query_embeddings.append(embedding)
+            if not query_embeddings:
+                continue
+            score_similarities = np.zeros_like(scores)
+            score_similarities[:, columns] = store.similarities(
+                np.stack(query_embeddings), self.num_rows
+            )
+            score_name = '-'.join(
+                [query_field, document_field, encoder, str(linear_weight)]
+            )
+            similarities[score_name] = score_similarities
+            scores += float(linear_weight) * score_similarities
+        return scores, similarities
+
+    @secure_request(on='/list', level=SecurityLevel.USER)
+    def list(self, parameters: dict = {}, **kwargs):
+        """List indexed documents, in the order of their rows.
+
+        :param parameters: dictionary with limit and offset or cursor
+        - offset (int): number of documents to skip
+        - limit (int): number of retrieved documents
+        - cursor (str): cursor returned with the previous page. Pass an empty string
+            to start listing with a cursor.
+        :return: the listed documents, or, if listed with a cursor, a `DocumentArray`
+            with a single `Document` holding the documents as matches and the cursor
+            of the next page in its tags. The cursor is None after the last page.
+        """
+        limit = int(parameters.get('limit', self.limit))
+        rows = np.flatnonzero(self._alive[: self.num_rows])
+        if 'cursor' in parameters:
+            cursor = parameters['cursor']
+            try:
+                start = int(cursor) if cursor else 0
+            except ValueError:
+                raise ValueError(f'Invalid cursor {cursor}')
+            rows = rows[rows >= start][:limit]
+            next_cursor = str(rows[-1] + 1) if len(rows) == limit else None
+            return DocumentArray(
+                [
+                    Document(
+                        text='cursor',
+                        tags={'cursor': next_cursor},
+                        matches=[self._get_doc(row) for row in rows],
+                    )
+                ]
+            )
+        offset = int(parameters.get('offset', 0))
+        return DocumentArray(
+            [self._get_doc(row) for row in rows[offset : offset + limit]]
+        )
+
+    @secure_request(on='/delete', level=SecurityLevel.USER)
+    def delete(self, parameters: dict = {}, **kwargs):
+        """
+        Endpoint to delete documents from an index. Either delete documents by filter condition
+        or by specifying a list of document IDs.
+
+        :param parameters: dictionary with filter conditions or list of IDs to select
+            documents for deletion.
+            Keys accepted:
+                - 'filter' (dict): The filtering conditions on document tags
+                - 'ids' (list): The IDs of the documents to delete
+        :return: empty `DocumentArray`
+        """
+        search_filter = parameters.get('filter', None)
+        ids = parameters.get('ids', None)
+        if search_filter:
+            rows = np.flatnonzero(self._get_filter_mask(search_filter)).tolist()
+        elif ids:
+            rows = [self._id_to_row[id] for id in ids if id in self._id_to_row]
+        else:
+            raise ValueError('No filter or IDs provided for deletion.')
+        records = []
+        for row in rows:
+            for store in self.vector_stores.values():
+                store.clear(row)
+            record = {'row': row, 'id': None}
+            self._set_row(record)
+            records.append(record)
+        self._persist(records)
+        self.logger.info(f'Deleted {len(records)} documents in the in-memory index')
+        return DocumentArray()
+
+    @secure_request(on='/tags', level=SecurityLevel.USER)
+    def tags(self, **kwargs):
+        """
+        Endpoint to get all tags and their possible values in the index. Tags which
+        have more values than `max_values_per_tag` are listed in `overflowed_tags`.
+        """
+        return DocumentArray(
+            [
+                Document(
+                    text='tags',
+                    tags={
+                        'tags': self.tag_index.to_dict(),
+                        'overflowed_tags': self.tag_index.overflowed,
+                    },
+                )
+            ]
+        )
+
+    @secure_request(on='/curate', level=SecurityLevel.USER)
+    def curate(self, parameters: dict = {}, **kwargs):
+        """
+        This endpoint is only relevant for text queries. It defines the top results
+        of each query as the documents matching a list of filters, see
+        `NOWElasticIndexer.curate` for the format of `query_to_filter`. The curated
+        ids are persisted in the workspace.
+        """
+        search_filter = parameters.get('query_to_filter', None)
+        if not search_filter:
+            raise ValueError('No filter provided for curating.')
+        for query, filters in search_filter.items():
+            curated_ids = self.query_to_curated_ids.setdefault(query, [])
+            for filter in filters:
+                rows = np.flatnonzero(self._get_filter_mask(filter))
+                for row in rows[:MAX_CURATED_IDS_PER_FILTER]:
+                    if self._ids[row] not in curated_ids:
+                        curated_ids.append(self._ids[row])
+        if self.curated_ids_path:
+            with open(self.curated_ids_path, 'w') as fp:
+                json.dump(self.query_to_curated_ids, fp)
+
+    @secure_request(on='/get_encoder_to_fields', level=SecurityLevel.USER)
+    def get_encoder_to_fields(self, **kwargs) -> DocumentArray:
+        """
+        Returns a DocumentArray with one Document, which has the dictionary of encoder
+        names to the dataclass fields they encode and their modality, and the
+        dictionary of dataclass fields to their field names in its tags, see
+        `NOWElasticIndexer.get_encoder_to_fields`.
+        """
+        dataclass_fields_modalities_dict = {
+            self.user_input.field_names_to_dataclass_fields[field]: modality
+            for field, modality in self.user_input.index_field_candidates_to_modalities.items()
+            if field in self.user_input.index_fields
+        }
+        encoder_to_fields_and_modalities = {
+            encoder: {
+                field: dataclass_fields_modalities_dict[field] for field in fields
+            }
+            for encoder, fields in self.encoder_to_fields.items()
+        }
+        return DocumentArray(
+            [
+                Document(
+                    text='index_fields',
+                    tags={
+                        'index_fields_dict': encoder_to_fields_and_modalities,
+                        'field_names_to_dataclass_fields': self.user_input.field_names_to_dataclass_fields,
+                    },
+                )
+            ]
+        )
+
+    def _get_doc(self, row: int) -> Document:
+        doc = deserialize_doc(
+            {
+                'serialized_doc': self._serialized_docs[row],
+                'serialization_format': self._serialization_formats[row],
+            }
+        )
+        doc.tags.update(self._tags[row])
+        return doc
+
+    def _allocate_row(self) -> int:
+        if self._free_rows:
+            return self._free_rows.pop()
+        self._append_row()
+        return self.num_rows - 1
+
+    def _append_row(self):
+        if self.num_rows == self._capacity:
+            self._resize(2 * self._capacity)
+        self._ids.append(None)
+        self._serialized_docs.append(None)
+        self._serialization_formats.append(None)
+        self._tags.append({})
+        self._fields.append({})
+
+    def _resize(self, capacity: int):
+        for store in self.vector_stores.values():
+            if store.capacity < capacity:
+                store.resize(capacity)
+        self._alive = _resize(self._alive, capacity, False)
+        for tag, masks in self._tag_masks.items():
+            if masks is not None:
+                for value, mask in masks.items():
+                    masks[value] = _resize(mask, capacity, False)
+        for tag, numbers in self._tag_numbers.items():
+            self._tag_numbers[tag] = _resize(numbers, capacity, np.nan)
+        self._capacity = capacity
+
+    def _set_row(self, record: Dict):
+        """Apply a record of the log, which either writes a document to a row or,
+        if its id is None, deletes the document of the row."""
+        row = record['row']
+        while row >= self.num_rows:
+            self._append_row()
+            self._free_rows.add(self.num_rows - 1)
+        if self._ids[row] is not None:
+            del self._id_to_row[self._ids[row]]
+            self._remove_row_tags(row)
+        if record['id'] is None:
+            self._ids[row] = None
+            self._serialized_docs[row] = None
+            self._serialization_formats[row] = None
+            self._tags[row] = {}
+            self._fields[row] = {}
+            self._alive[row] = False
+            self._free_rows.add(row)
+            return
+        self._free_rows.discard(row)
+        self._ids[row] = record['id']
+        self._id_to_row[record['id']] = row
+        self._serialized_docs[row] = record['serialized_doc']
+        self._serialization_formats[row] = record['serialization_format']
+        self._tags[row] = record['tags']
+        self._fields[row] = {'id': record['id'], **record['fields']}
+        self._alive[row] = True
+        self._add_row_tags(row)
+
+    def _add_row_tags(self, row: int):
+        tags = self._tags[row]
+        self.tag_index.add(tags)
+        for tag in self.filter_fields:
+            if tag not in tags:
+                continue
+            values = tags[tag] if isinstance(tags[tag], list) else [tags[tag]]
+            masks = self._tag_masks[tag]
+            if masks is not None:
+                for value in values:
+                    if value not in masks:
+                        if len(masks) >= self.tag_index.max_values_per_tag:
+                            # too many values to keep a mask for each
+                            self._tag_masks[tag] = masks = None
+                            break
+                        masks[value] = np.zeros(self._capacity, dtype=bool)
+                    masks[value][row] = True
+            if len(values) == 1 and _is_number(values[0]):
+                self._tag_numbers[tag][row] = values[0]
+
+    def _remove_row_tags(self, row: int):
+        tags = self._tags[row]
+        self.tag_index.remove(tags)
+        for tag in self.filter_fields:
+            masks = self._tag_masks[tag]
+            if masks is not None and tag in tags:
+                values = tags[tag] if isinstance(tags[tag], list) else [tags[tag]]
+                for value in values:
+                    if value in masks:
+                        masks[value][row] = False
+            self._tag_numbers[tag][row] = np.nan
+
+    def _get_filter_mask(self, filter: Dict) -> np.ndarray:
+        """
+        Get the mask of the rows of the documents which match all conditions of a filter.
+
+        :param filter: dictionary mapping a field, e.g. 'tags__color' or 'uri', to a
+            dictionary of operators and values, e.g. `{'$eq': 'red'}`. The operators
+            have the semantics of the Elasticsearch indexer, e.g. `$ne` and `$nin`
+            match documents without the field.
+        :return: boolean array with one element per row
+        """
+        mask = self._alive[: self.num_rows].copy()
+        for field, conditions in filter.items():
+            for filter_operator, value in conditions.items():
+                if filter_operator in NEGATED_FILTER_OPERATORS:
+                    mask &= ~self._get_condition_mask(
+                        field, NEGATED_FILTER_OPERATORS[filter_operator], value
+                    )
+                elif filter_operator == '$exists' and not value:
+                    mask &= ~self._get_condition_mask(field, '$exists', True)
+                elif filter_operator in FILTER_OPERATORS:
+                    mask &= self._get_condition_mask(field, filter_operator, value)
+                else:
+                    raise ValueError(
+                        f'Invalid filter operator {filter_operator}, must be one of {[*FILTER_OPERATORS, *NEGATED_FILTER_OPERATORS]}'
+                    )
+        return mask
+
+    def _get_condition_mask(
+        self, field: str, filter_operator: str, value: Any
+    ) -> np.ndarray:
+        tag = field[len('tags__') :] if field.startswith('tags__') else None
+        if tag in self.filter_fields:
+            masks = self._tag_masks[tag]
+            if filter_operator in ['$eq', '$in', '$exists'] and masks is not None:
+                if filter_operator == '$eq':
+                    values = [value]
+                elif filter_operator == '$in':
+                    values = value
+                else:
+                    values = list(masks)
+                mask = np.zeros(self.num_rows, dtype=bool)
+                for tag_value in values:
+                    if tag_value in masks:
+                        mask |= masks[tag_value][: self.num_rows]
+                return mask
+            if filter_operator in RANGE_FILTER_OPERATORS and _is_number(value):
+                return FILTER_OPERATORS[filter_operator](
+                    self._tag_numbers[tag][: self.num_rows], value
+                )
+        # fields without masks are compared row by row
+        compare = FILTER_OPERATORS[filter_operator]
+        mask = np.zeros(self.num_rows, dtype=bool)
+        for row in range(self.num_rows):
+            row_value = (
+                self._tags[row].get(tag) if tag else self._fields[row].get(field)
+            )
+            row_values = row_value if isinstance(row_value, list) else [row_value]
+            mask[row] = any(
+                _matches(compare, row_value, value) for row_value in row_values
+            )
+        return mask
+
+    def _persist(self, records: List[Dict]):
+        """Flush the vectors and append the records to the log, so that only rows
+        whose vectors are written are restored."""
+        if not self.log_path or not records:
+            return
+        for store in self.vector_stores.values():
+            store.flush()
+        with open(self.log_path, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        self._num_log_records += len(records)
+        num_outdated = self._num_log_records - len(self._id_to_row)
+        if (
+            self._num_log_records >= MIN_COMPACTED_LOG_RECORDS
+            and num_outdated >= self.log_compaction_ratio * self._num_log_records
+        ):
+            self._compact()
+
+    def _compact(self):
+        """Rewrite the log with one record per document, and replace the old log once
+        the new one is complete."""
+        compacted_path = f'{self.log_path}.compacted'
+        with open(compacted_path, 'w') as f:
+            for doc_id, row in self._id_to_row.items():
+                fields = {k: v for k, v in self._fields[row].items() if k != 'id'}
+                record = {
+                    'row': row,
+                    'id': doc_id,
+                    'serialized_doc': self._serialized_docs[row],
+                    'serialization_format': self._serialization_formats[row],
+                    'tags': self._tags[row],
+                    'fields': fields,
+                }
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(compacted_path, self.log_path)
+        self.logger.info(
+            f'Compacted the log of the in-memory index from {self._num_log_records} '
+            f'to {len(self._id_to_row)} records'
+        )
+        self._num_log_records = len(self._id_to_row)
+
+    def _load(self):
+        """Restore the documents from the log in the workspace."""
+        with open(self.log_path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    self._set_row(json.loads(line))
+                    self._num_log_records += 1
+        self.logger.info(
+            f'Loaded {len(self._id_to_row)} documents into the in-memory index'
+        )
+
+
+def top_k(scores: np.ndarray, mask: np.ndarray, k: int) -> np.ndarray:
+    """
+    Select the `k` rows with the highest scores among the rows in `mask`.
+
+    :param scores: score of every row
+    :param mask: boolean array of the rows to select from
+    :param k: number of rows to select
+    :return: the selected rows, sorted by descending score
+    """
+    candidates = np.flatnonzero(mask)
+    if k <= 0:
+        return candidates[:0]
+    if len(candidates) > k:
+        candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+def _resize(array: np.ndarray, capacity: int, fill_value) -> np.ndarray:
+    resized = np.full(capacity, fill_value, dtype=array.dtype)
+    resized[: len(array)] = array
+    return resized
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _matches(compare, row_value: Any, value: Any) -> bool:
+    if row_value is None:
+        return False
+    try:
+        return compare(row_value, value)
+    except TypeError:
+        return False
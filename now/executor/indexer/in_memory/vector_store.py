@@ -0,0 +1,137 @@
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+from numpy.linalg import norm
+
+VECTOR_DTYPES = ['float32', 'float16']
+METRICS = ['cosine', 'l2_norm']
+# number of rows which are converted to float32 and multiplied at once
+BLOCK_SIZE = 2**16
+
+
+class VectorStore:
+    """
+    Matrix of the vectors of one document field and encoder, with one row per row of
+    the indexer. If a path is given, the matrix and the mask of the rows which hold a
+    vector are memory mapped from `.npy` files, so that they are persisted and don't
+    have to fit into memory. For the 'cosine' metric, vectors are normalized when they
+    are written, so that similarities are dot products.
+    """
+
+    def __init__(
+        self,
+        dim: int,
+        metric: str = 'cosine',
+        dtype: str = 'float32',
+        path: Optional[str] = None,
+        capacity: int = 1024,
+    ):
+        """
+        :param dim: dimension of the vectors.
+        :param metric: 'cosine' or 'l2_norm'.
+        :param dtype: element type of the matrix, 'float32' or 'float16'. Existing
+            matrices keep the element type they were created with.
+        :param path: path of the matrix without extension, or None to keep it in memory.
+        :param capacity: initial number of rows.
+        """
+        if metric not in METRICS:
+            raise ValueError(f'Invalid metric {metric}, must be one of {METRICS}')
+        if dtype not in VECTOR_DTYPES:
+            raise ValueError(
+                f'Invalid vector dtype {dtype}, must be one of {VECTOR_DTYPES}'
+            )
+        self.dim = dim
+        self.metric = metric
+        self.vectors = open_array(path and f'{path}.npy', (capacity, dim), dtype)
+        self.present = open_array(
+            path and f'{path}.present.npy', (len(self.vectors),), bool
+        )
+
+    @property
+    def capacity(self) -> int:
+        return len(self.present)
+
+    def resize(self, capacity: int):
+        """Grow the matrix to `capacity` rows."""
+        self.vectors = resize_array(self.vectors, capacity)
+        self.present = resize_array(self.present, capacity)
+
+    def set(self, row: int, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        if self.metric == 'cosine':
+            vector_norm = norm(vector)
+            if vector_norm > 0:
+                vector = vector / vector_norm
+        self.vectors[row] = vector
+        self.present[row] = True
+
+    def clear(self, row: int):
+        self.present[row] = False
+
+    def flush(self):
+        for array in [self.vectors, self.present]:
+            if isinstance(array, np.memmap):
+                array.flush()
+
+    def similarities(self, queries: np.ndarray, num_rows: int) -> np.ndarray:
+        """
+        Compute the similarities of the first `num_rows` rows to all query vectors with
+        one matrix multiplication per block of rows. Rows without a vector have a
+        similarity of 0, like fields missing in Elasticsearch don't add to the score.
+
+        :param queries: array of query vectors, one per row.
+        :param num_rows: number of rows to compare.
+        :return: array of shape `(num_rows, len(queries))`.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        if self.metric == 'cosine':
+            query_norms = norm(queries, axis=1, keepdims=True)
+            queries = queries / np.where(query_norms > 0, query_norms, 1)
+        else:
+            squared_query_norms = (queries**2).sum(axis=1)
+        similarities = np.zeros((num_rows, len(queries)), dtype=np.float32)
+        for start in range(0, num_rows, BLOCK_SIZE):
+            stop = min(start + BLOCK_SIZE, num_rows)
+            block = np.asarray(self.vectors[start:stop], dtype=np.float32)
+            products = block @ queries.T
+            if self.metric == 'cosine':
+                similarities[start:stop] = products
+            else:
+                squared_distances = (
+                    (block**2).sum(axis=1)[:, np.newaxis]
+                    - 2 * products
+                    + squared_query_norms
+                )
+                similarities[start:stop] = np.sqrt(np.maximum(squared_distances, 0))
+        similarities[~self.present[:num_rows]] = 0
+        return similarities
+
+
+def open_array(path: Optional[str], shape: Tuple[int, ...], dtype) -> np.ndarray:
+    """Open the `.npy` file at `path` as memory map, or create it with `shape` and
+    `dtype` if it doesn't exist. Without a path, an array in memory is returned."""
+    if path is None:
+        return np.zeros(shape, dtype=dtype)
+    if os.path.exists(path):
+        return np.load(path, mmap_mode='r+')
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+
+def resize_array(array: np.ndarray, capacity: int) -> np.ndarray:
+    """Return a copy of `array` with `capacity` rows. Memory mapped arrays are copied
+    into a new file, which replaces the old one."""
+    shape = (capacity,) + array.shape[1:]
+    if not isinstance(array, np.memmap):
+        resized = np.zeros(shape, dtype=array.dtype)
+        resized[: len(array)] = array
+        return resized
+    path = array.filename
+    resized = np.lib.format.open_memmap(
+        f'{path}.tmp', mode='w+', dtype=array.dtype, shape=shape
+    )
+    resized[: len(array)] = array
+    resized.flush()
+    del resized
+    os.replace(f'{path}.tmp', path)
+    return np.load(path, mmap_mode='r+')
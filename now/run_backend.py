@@ -1,3 +1,5 @@
+import hashlib
+import json
 import random
 import sys
 import uuid
@@ -117,12 +119,19 @@ def trigger_scheduler(user_input, host):
 
 def index_docs(user_input, dataset, client, print_callback, **kwargs):
     """
-    Index the data right away
+    Index the data right away. If the indexer has a snapshot of the same dataset,
+    encoded by the same encoders, it is restored instead of encoding the data again.
+    After indexing, a snapshot is taken for the next deployment.
     """
-    print_callback(f"▶ indexing {len(dataset)} documents in batches")
     params = {'access_paths': ACCESS_PATHS}
     if user_input.secured:
         params['jwt'] = user_input.jwt
+    snapshot = get_dataset_fingerprint(dataset)
+    restore_status = call_indexer(client, '/restore', params, snapshot)
+    if restore_status.get('restored'):
+        print_callback('⭐ Success - your data is restored from a snapshot')
+        return
+    print_callback(f"▶ indexing {len(dataset)} documents in batches")
     call_flow(
         client=client,
         dataset=dataset,
@@ -131,9 +140,51 @@ def index_docs(user_input, dataset, client, print_callback, **kwargs):
         return_results=False,
         **kwargs,
     )
+    if restore_status.get('snapshots_enabled'):
+        try:
+            call_indexer(client, '/snapshot', params, snapshot)
+        except Exception as e:
+            # the data is indexed, only the next deployment has to index it again
+            print_callback(f'⚠ taking a snapshot of the index failed: {e}')
     print_callback('⭐ Success - your data is indexed')
 
 
+def get_dataset_fingerprint(dataset: DocumentArray) -> str:
+    """
+    Hash the content and tags of the documents. Ids are left out, since they are
+    generated anew whenever the data is loaded. Files are identified by their uri.
+    """
+    fingerprint = hashlib.sha1()
+    for doc in dataset:
+        fingerprint.update(json.dumps(doc.tags, sort_keys=True, default=str).encode())
+        for chunk in doc.chunks:
+            if chunk.text:
+                fingerprint.update(chunk.text.encode())
+            elif chunk.uri:
+                fingerprint.update(chunk.uri.encode())
+            elif chunk.blob:
+                fingerprint.update(chunk.blob)
+            elif chunk.tensor is not None:
+                fingerprint.update(chunk.tensor.tobytes())
+    return fingerprint.hexdigest()[:16]
+
+
+def call_indexer(client, endpoint: str, parameters: Dict, snapshot: str) -> Dict:
+    """
+    Call the `/snapshot` or `/restore` endpoint of the indexer and return the tags of
+    its response. Indexers without the endpoint leave the request unchanged, so an
+    empty dictionary is returned, and indexers without a snapshot path return
+    `snapshots_enabled` False. In both cases the data is just indexed. Errors of the
+    endpoint are raised, so that a failed restore doesn't go unnoticed.
+    """
+    response = client.post(
+        on=endpoint,
+        parameters={**parameters, 'snapshot': snapshot},
+        target_executor=r'\Aindexer\Z',
+    )
+    return response[0].tags if response else {}
+
+
 @time_profiler
 def call_flow(
     client: Client,
@@ -178,7 +178,10 @@ class TestElasticIndexer:
         assert len(listed_docs) == NUMBER_OF_DOCS
         flow.post(
             on='/delete',
-            parameters={'filter': {'tags__parent_tag': {'$eq': 'different_value'}}},
+            parameters={
+                'filter': {'tags__parent_tag': {'$eq': 'different_value'}},
+                'wait_for_completion': True,
+            },
         )
         listed_docs = flow.post(on='/list', return_results=True)
         assert len(listed_docs) == NUMBER_OF_DOCS - 1
@@ -202,7 +205,10 @@ class TestElasticIndexer:
         )
         flow.post(
             on='/delete',
-            parameters={'filter': {'tags__color': {'$eq': 'blue'}}},
+            parameters={
+                'filter': {'tags__color': {'$eq': 'blue'}},
+                'wait_for_completion': True,
+            },
         )
         response = flow.post(on='/tags')
         assert response[0].text == 'tags'
@@ -211,7 +217,10 @@ class TestElasticIndexer:
         assert 'blue' not in response[0].tags['tags']['color']
         flow.post(
             on='/delete',
-            parameters={'filter': {'tags__greeting': {'$eq': 'hello'}}},
+            parameters={
+                'filter': {'tags__greeting': {'$eq': 'hello'}},
+                'wait_for_completion': True,
+            },
         )
         response = flow.post(on='/tags')
         assert 'hello' not in response[0].tags['tags']['greeting']
@@ -1,11 +1,24 @@
 import numpy as np
-from docarray import Document
+import pytest
+from docarray import Document, dataclass
 from docarray.score import NamedScore
+from docarray.typing import Text
 
-from now.executor.indexer.elastic.elastic_indexer import aggregate_embeddings
+from now.executor.indexer.elastic.elastic_indexer import (
+    aggregate_embeddings,
+    pool_embeddings,
+)
 from now.executor.indexer.elastic.es_converter import (
-    calculate_score_breakdown,
+    DEFAULT_SERIALIZATION_FORMAT,
+    calculate_score_breakdowns,
     convert_doc_map_to_es,
+    convert_es_results_to_matches,
+    deserialize_doc,
+    detached_embeddings,
+    get_field_values,
+    get_similarities,
+    quantize_embedding,
+    serialize_doc,
 )
 
 
@@ -24,19 +37,46 @@ def test_convert_doc_map_to_es(es_inputs, random_index_name):
     encoder_to_fields = {document_mappings[0]: document_mappings[2]}
     first_doc_clip = index_docs_map['clip'][0]
     aggregate_embeddings(index_docs_map)
-    first_result = convert_doc_map_to_es(
-        docs_map=index_docs_map,
-        index_name=random_index_name,
-        encoder_to_fields=encoder_to_fields,
-    )[0]
+    first_result = next(
+        convert_doc_map_to_es(
+            docs_map=index_docs_map,
+            index_name=random_index_name,
+            encoder_to_fields=encoder_to_fields,
+        )
+    )
     assert first_result['id'] == first_doc_clip.id
     assert first_result['bm25_text'] == first_doc_clip.title.text + ' '
     assert first_result['_op_type'] == 'index'
 
 
+def test_pool_embeddings():
+    """
+    This test checks the pooling strategies on segments of different lengths.
+    """
+    embeddings = np.array([[1.0, 4.0], [3.0, 2.0], [5.0, 0.0], [2.0, 2.0]])
+    offsets = np.array([0, 2, 3])
+    assert np.allclose(
+        pool_embeddings(embeddings, offsets, 'mean'),
+        [[2.0, 3.0], [5.0, 0.0], [2.0, 2.0]],
+    )
+    assert np.allclose(
+        pool_embeddings(embeddings, offsets, 'max'),
+        [[3.0, 4.0], [5.0, 0.0], [2.0, 2.0]],
+    )
+    assert np.allclose(
+        pool_embeddings(embeddings, offsets, 'first'),
+        [[1.0, 4.0], [5.0, 0.0], [2.0, 2.0]],
+    )
+
+
+def cosine(d_emb, q_emb):
+    d_emb, q_emb = np.asarray(d_emb, dtype=float), np.asarray(q_emb, dtype=float)
+    return np.dot(q_emb, d_emb) / (np.linalg.norm(q_emb) * np.linalg.norm(d_emb))
+
+
 def test_calculate_score_breakdown(es_inputs):
     """
-    This test tests the calculate_score_breakdown function.
+    This test tests the calculate_score_breakdowns function for a single document.
     """
     default_semantic_scores = es_inputs.default_semantic_scores
     metric = 'cosine'
@@ -60,12 +100,12 @@ def test_calculate_score_breakdown(es_inputs):
         },
         scores={metric: NamedScore(value=5.0)},
     )
-    doc_score_breakdown = calculate_score_breakdown(
+    doc_score_breakdown = calculate_score_breakdowns(
         query_doc=query_doc,
-        retrieved_doc=retrieved_doc,
+        retrieved_docs=[retrieved_doc],
         metric=metric,
         semantic_scores=default_semantic_scores,
-    )
+    )[0]
     scores = {
         'total': {'value': 5.0},
         'query_text-title-clip-1': {'value': 0.921791},
@@ -75,3 +115,217 @@ def test_calculate_score_breakdown(es_inputs):
     }
     for score, val in scores.items():
         assert doc_score_breakdown.scores[score].value == val['value']
+
+
+def test_calculate_score_breakdown_with_similarities(es_inputs):
+    """
+    This test tests the calculate_score_breakdowns function with similarities
+    computed by Elasticsearch instead of document embeddings.
+    """
+    default_semantic_scores = es_inputs.default_semantic_scores
+    metric = 'cosine'
+    retrieved_doc = Document(
+        tags={
+            'similarities': {
+                'query_text-title-clip-1': 0.5,
+                'query_text-gif-clip-1': 0.25,
+            }
+        },
+        scores={metric: NamedScore(value=2.0)},
+    )
+    doc_score_breakdown = calculate_score_breakdowns(
+        query_doc=Document(),
+        retrieved_docs=[retrieved_doc],
+        metric=metric,
+        semantic_scores=default_semantic_scores,
+    )[0]
+    assert doc_score_breakdown.scores['query_text-title-clip-1'].value == 0.5
+    assert doc_score_breakdown.scores['query_text-gif-clip-1'].value == 0.25
+    assert doc_score_breakdown.scores['bm25_normalized'].value == 0.25
+    assert 'similarities' not in doc_score_breakdown.tags
+
+
+def test_calculate_score_breakdowns(es_inputs):
+    """
+    This test tests that the score breakdowns of several documents, which are computed
+    at once, match the similarities of each single document.
+    """
+    default_semantic_scores = es_inputs.default_semantic_scores
+    metric = 'cosine'
+    np.random.seed(0)
+    q_emb = np.random.random(8)
+    query_doc = Document(tags={'embeddings': {'query_text-clip': q_emb}})
+    d_embs = np.random.random((3, 2, 8))
+    retrieved_docs = [
+        Document(
+            tags={
+                'embeddings': {
+                    'title-clip.embedding': title_emb,
+                    'gif-clip.embedding': gif_emb,
+                }
+            },
+            scores={metric: NamedScore(value=5.0)},
+        )
+        for title_emb, gif_emb in d_embs
+    ]
+    breakdowns = calculate_score_breakdowns(
+        query_doc, retrieved_docs, default_semantic_scores, metric
+    )
+    for (title_emb, gif_emb), breakdown in zip(d_embs, breakdowns):
+        title_score = breakdown.scores['query_text-title-clip-1'].value
+        gif_score = breakdown.scores['query_text-gif-clip-1'].value
+        assert np.isclose(title_score, cosine(title_emb, q_emb), atol=1e-6)
+        assert np.isclose(gif_score, cosine(gif_emb, q_emb), atol=1e-6)
+        assert np.isclose(
+            breakdown.scores['bm25_normalized'].value,
+            5.0 - title_score - gif_score - 1,
+            atol=1e-6,
+        )
+        assert 'embeddings' not in breakdown.tags
+
+
+@pytest.mark.parametrize('metric', ['cosine', 'l2_norm'])
+def test_get_similarities(metric):
+    """
+    This test tests that similarities computed by Elasticsearch are used as they are,
+    and that the others are computed from the embeddings of the documents.
+    """
+    np.random.seed(0)
+    q_emb = np.random.random(8)
+    d_embs = np.random.random((3, 8))
+    query_doc = Document(tags={'embeddings': {'query_text-clip': q_emb}})
+    retrieved_docs = [
+        Document(tags={'embeddings': {'title-clip.embedding': d_emb}})
+        for d_emb in d_embs
+    ]
+    retrieved_docs[1].tags['similarities'] = {'query_text-title-clip-1': 0.5}
+    similarities = get_similarities(
+        query_doc,
+        retrieved_docs,
+        'query_text-title-clip-1',
+        'query_text-clip',
+        'title-clip.embedding',
+        metric,
+    )
+    for i in [0, 2]:
+        expected = (
+            cosine(d_embs[i], q_emb)
+            if metric == 'cosine'
+            else np.linalg.norm(d_embs[i] - q_emb)
+        )
+        assert np.isclose(similarities[i], expected, atol=1e-6)
+    assert similarities[1] == 0.5
+    with pytest.raises(ValueError):
+        get_similarities(
+            query_doc,
+            retrieved_docs,
+            'query_text-title-clip-1',
+            'query_text-clip',
+            'title-clip.embedding',
+            'dot_product',
+        )
+
+
+def test_lightweight_matches():
+    """
+    This test tests that lightweight matches hold the same fields, tags and scores as
+    the deserialized matches.
+    """
+
+    @dataclass
+    class MMDoc:
+        title: Text
+        description: Text
+
+    doc = Document(MMDoc(title='a cat', description='a small cat'))
+    es_results = [
+        {
+            '_id': doc.id,
+            '_score': 2.0,
+            '_source': {
+                'serialized_doc': serialize_doc(doc),
+                'serialization_format': DEFAULT_SERIALIZATION_FORMAT,
+                'field_values': get_field_values(doc),
+                'tags': {'color': 'red'},
+            },
+        }
+    ]
+    matches = {
+        lightweight: convert_es_results_to_matches(
+            query_doc=Document(),
+            es_results=es_results,
+            get_score_breakdown=False,
+            metric='cosine',
+            semantic_scores=[],
+            lightweight=lightweight,
+        )
+        for lightweight in [True, False]
+    }
+    for match in [matches[True][0], matches[False][0]]:
+        assert match.id == doc.id
+        assert match.title.text == 'a cat'
+        assert match.description.text == 'a small cat'
+        assert match.tags == {'color': 'red'}
+        assert match.scores['cosine'].value == 2.0
+
+
+def test_serialization_formats():
+    """
+    This test checks that documents can be read in the format they were stored in,
+    including documents without `serialization_format` written by older versions.
+    """
+    doc = Document(text='cat', tags={'color': 'red'})
+    legacy_source = {'serialized_doc': doc.to_base64()}
+    compact_source = {
+        'serialized_doc': serialize_doc(doc, 'protobuf-zlib'),
+        'serialization_format': 'protobuf-zlib',
+    }
+    for es_source in [legacy_source, compact_source]:
+        result = deserialize_doc(es_source)
+        assert result.id == doc.id
+        assert result.text == 'cat'
+        assert result.tags['color'] == 'red'
+
+
+def test_serialize_doc_without_embeddings():
+    """
+    This test checks that embeddings are left out of the serialized document without
+    removing them from the document itself.
+    """
+    doc = Document(
+        embedding=np.ones(4),
+        chunks=[Document(text='cat', embedding=np.ones(4), blob=b'image')],
+    )
+    for exclude_embeddings in [True, False]:
+        result = deserialize_doc(
+            {
+                'serialized_doc': serialize_doc(
+                    doc, exclude_embeddings=exclude_embeddings
+                ),
+                'serialization_format': DEFAULT_SERIALIZATION_FORMAT,
+            }
+        )
+        assert result.chunks[0].blob == b'image'
+        assert (result.embedding is None) == exclude_embeddings
+        assert (result.chunks[0].embedding is None) == exclude_embeddings
+    assert doc.embedding is not None
+    assert doc.chunks[0].embedding is not None
+    with pytest.raises(RuntimeError):
+        with detached_embeddings(doc):
+            assert doc.chunks[0].embedding is None
+            raise RuntimeError()
+    assert doc.chunks[0].embedding is not None
+
+
+def test_quantize_embedding():
+    """
+    This test checks that quantized embeddings are signed bytes and keep
+    cosine similarities close to the ones of the float embeddings.
+    """
+    np.random.seed(42)
+    d_emb, q_emb = np.random.normal(size=(2, 512))
+    quantized_d_emb = quantize_embedding(d_emb)
+    quantized_q_emb = quantize_embedding(q_emb)
+    assert quantized_d_emb.dtype == np.int8
+    assert np.abs(quantized_d_emb).max() <= 127
+    assert abs(cosine(quantized_d_emb, quantized_q_emb) - cosine(d_emb, q_emb)) < 0.01
@@ -1,6 +1,13 @@
+import numpy as np
+import pytest
+
 from now.executor.indexer.elastic.elastic_indexer import aggregate_embeddings
 from now.executor.indexer.elastic.es_query_building import (
+    SEMANTIC_SCORE_SCRIPT_ID,
+    build_es_knn_queries,
     build_es_queries,
+    build_es_rescore_queries,
+    compile_filter,
     generate_semantic_scores,
 )
 
@@ -68,3 +75,165 @@ def test_build_es_queries(es_inputs):
             },
         }
     }
+
+
+def test_build_es_knn_queries(es_inputs):
+    """
+    This test tests the build_es_knn_queries function of es_query_building.
+    It should return one boosted kNN clause per semantic score, filtered like
+    the BM25 query next to it.
+    """
+    (
+        index_docs_map,
+        query_docs_map,
+        document_mappings,
+        default_semantic_scores,
+    ) = es_inputs
+    aggregate_embeddings(query_docs_map)
+    query_embedding = query_docs_map['clip'][0].query_text.embedding
+    filter = {'tags__color': {'$eq': 'red'}}
+    _, body = build_es_knn_queries(
+        docs_map=query_docs_map,
+        apply_default_bm25=True,
+        get_score_breakdown=False,
+        semantic_scores=default_semantic_scores,
+        limit=10,
+        num_candidates={'gif-clip': 5},
+        filter=filter,
+    )[0]
+    assert body == {
+        'knn': [
+            {
+                'field': 'title-clip.embedding',
+                'query_vector': query_embedding,
+                'k': 10,
+                'num_candidates': 100,
+                'boost': 1.0,
+                'filter': [{'term': {'tags.color': 'red'}}],
+            },
+            {
+                'field': 'gif-clip.embedding',
+                'query_vector': query_embedding,
+                'k': 10,
+                'num_candidates': 10,
+                'boost': 1.0,
+                'filter': [{'term': {'tags.color': 'red'}}],
+            },
+        ],
+        'query': {
+            'bool': {
+                'should': [
+                    {'multi_match': {'query': 'cat', 'fields': ['bm25_text']}},
+                ],
+                'minimum_should_match': 1,
+                'filter': [{'term': {'tags.color': 'red'}}],
+            }
+        },
+    }
+
+
+def test_build_es_rescore_queries(es_inputs):
+    """
+    This test tests the build_es_rescore_queries function of es_query_building.
+    kNN clauses should collect at least `window_size` candidates, which are then
+    rescored with the exact script-score query only.
+    """
+    (
+        index_docs_map,
+        query_docs_map,
+        document_mappings,
+        default_semantic_scores,
+    ) = es_inputs
+    aggregate_embeddings(query_docs_map)
+    _, exact_query = build_es_queries(
+        docs_map=query_docs_map,
+        apply_default_bm25=True,
+        get_score_breakdown=False,
+        semantic_scores=default_semantic_scores,
+    )[0]
+    _, body = build_es_rescore_queries(
+        docs_map=query_docs_map,
+        apply_default_bm25=True,
+        get_score_breakdown=False,
+        semantic_scores=default_semantic_scores,
+        limit=10,
+        window_size=50,
+    )[0]
+    assert [knn['k'] for knn in body['knn']] == [50, 50]
+    assert body['rescore'] == {
+        'window_size': 50,
+        'query': {
+            'rescore_query': exact_query,
+            'query_weight': 0.0,
+            'rescore_query_weight': 1.0,
+        },
+    }
+
+
+def test_build_es_queries_with_stored_script(es_inputs):
+    """
+    This test tests the build_es_queries function with a stored script. The script
+    should be referenced by id, and the semantic scores passed as parameters.
+    """
+    (
+        index_docs_map,
+        query_docs_map,
+        document_mappings,
+        default_semantic_scores,
+    ) = es_inputs
+    aggregate_embeddings(query_docs_map)
+    query_embedding = query_docs_map['clip'][0].query_text.embedding
+    _, es_query = build_es_queries(
+        docs_map=query_docs_map,
+        apply_default_bm25=True,
+        get_score_breakdown=False,
+        semantic_scores=default_semantic_scores,
+        stored_script=True,
+    )[0]
+    script = es_query['script_score']['script']
+    assert script == {
+        'id': SEMANTIC_SCORE_SCRIPT_ID,
+        'params': {
+            'bm25': True,
+            'query_vectors': {'query_query_text_clip': query_embedding},
+            'vectors': [
+                {
+                    'query': 'query_query_text_clip',
+                    'query_norm': float(np.linalg.norm(query_embedding)),
+                    'field': f'{document_field}-clip.embedding',
+                    'weight': 1.0,
+                    'metric': 'cosine',
+                }
+                for document_field in ['title', 'gif']
+            ],
+        },
+    }
+
+
+def test_compile_filter():
+    """
+    This test tests that every condition of a filter becomes a clause of its own, that
+    range conditions of a field are merged and that negations end up in `must_not`.
+    """
+    filter = {
+        'tags__color': {'$in': ['red', 'blue'], '$ne': 'green'},
+        'tags__size': {'$eq': 'xl'},
+        'tags__price': {'$gte': 1, '$lt': 10},
+        'tags__discount': {'$exists': False},
+    }
+    assert compile_filter(filter) == [
+        {'terms': {'tags.color': ['red', 'blue']}},
+        {'range': {'tags.price': {'gte': 1, 'lt': 10}}},
+        {'term': {'tags.size': 'xl'}},
+        {
+            'bool': {
+                'must_not': [
+                    {'term': {'tags.color': 'green'}},
+                    {'exists': {'field': 'tags.discount'}},
+                ]
+            }
+        },
+    ]
+    assert compile_filter({}) == []
+    with pytest.raises(ValueError):
+        compile_filter({'tags__color': {'$like': 'red'}})
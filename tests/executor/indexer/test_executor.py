@@ -1,8 +1,20 @@
+import asyncio
 import tempfile
+import threading
+from time import sleep
 
+import pytest
+from docarray import Document, DocumentArray
+from elasticsearch import Elasticsearch
+
+from now.executor.indexer.elastic import elastic_indexer
 from now.executor.indexer.elastic.elastic_indexer import (
+    MAX_DOCS_PER_SHARD,
+    MAX_IDS_PER_MGET,
     FieldEmbedding,
     NOWElasticIndexer,
+    get_default_number_of_shards,
+    get_filter_routing,
 )
 
 
@@ -19,6 +31,9 @@ def test_generate_es_mappings(setup_service_running):
         'properties': {
             'id': {'type': 'keyword'},
             'bm25_text': {'type': 'text', 'analyzer': 'standard'},
+            'serialized_doc': {'type': 'binary', 'doc_values': False},
+            'serialization_format': {'type': 'keyword'},
+            'field_values': {'type': 'object', 'enabled': False},
             'title-clip': {
                 'properties': {
                     'embedding': {
@@ -96,6 +111,99 @@ def test_index_and_search_with_multimodal_docs(
             assert isinstance(results[0].matches[0].scores[score_string].value, float)
 
 
+def test_search_with_multiple_query_docs(
+    setup_service_running, es_inputs, random_index_name
+):
+    """
+    This test checks that all query documents of one request are answered and that
+    queries are split across several `_msearch` requests if they exceed the cap.
+    """
+    (
+        index_docs_map,
+        query_docs_map,
+        document_mappings,
+        default_semantic_scores,
+    ) = es_inputs
+    indexer = NOWElasticIndexer(
+        document_mappings=document_mappings,
+        hosts='http://localhost:9200',
+        index_name=random_index_name,
+        max_queries_per_msearch=1,
+    )
+    indexer.index(index_docs_map)
+
+    second_query_doc = Document(query_docs_map['clip'][0], copy=True)
+    second_query_doc.id = 'second_query'
+    query_docs_map['clip'].append(second_query_doc)
+    results = indexer.search(
+        query_docs_map,
+        parameters={'semantic_scores': default_semantic_scores[:-1]},
+    )
+    assert len(results) == 2
+    for result in results:
+        assert len(result.matches) == len(index_docs_map['clip'])
+    assert results[0].matches[:, 'id'] == results[1].matches[:, 'id']
+
+
+def test_approximate_search(setup_service_running, es_inputs, random_index_name):
+    """
+    This test tests approximate kNN search of the NOWElasticIndexer, with the search
+    mode chosen per request.
+    """
+    (
+        index_docs_map,
+        query_docs_map,
+        document_mappings,
+        default_semantic_scores,
+    ) = es_inputs
+    indexer = NOWElasticIndexer(
+        document_mappings=document_mappings,
+        hosts='http://localhost:9200',
+        index_name=random_index_name,
+    )
+    indexer.index(index_docs_map)
+    results = indexer.search(
+        query_docs_map,
+        parameters={
+            'search_mode': 'approximate',
+            'apply_default_bm25': True,
+            'semantic_scores': default_semantic_scores,
+            'filter': {'tags__price': {'$lte': 1}},
+        },
+    )
+    assert len(results[0].matches) == 1
+    assert results[0].matches[0].tags['price'] < 1
+
+
+@pytest.mark.parametrize('refresh_policy', ['wait_for', 'interval'])
+def test_refresh_policy(
+    setup_service_running, es_inputs, random_index_name, refresh_policy
+):
+    """
+    This test tests that documents are searchable after indexing with the refresh
+    policies 'wait_for' and 'interval', where the index request is a backfill.
+    """
+    (
+        index_docs_map,
+        query_docs_map,
+        document_mappings,
+        default_semantic_scores,
+    ) = es_inputs
+    indexer = NOWElasticIndexer(
+        document_mappings=document_mappings,
+        hosts='http://localhost:9200',
+        index_name=random_index_name,
+        refresh_policy=refresh_policy,
+        backfill_threshold=1,
+    )
+    indexer.index(index_docs_map)
+    settings = indexer.es.indices.get_settings(index=random_index_name)
+    index_settings = next(iter(settings.values()))['settings']['index']
+    assert 'refresh_interval' not in index_settings
+    result = indexer.list()
+    assert len(result) == len(index_docs_map['clip'])
+
+
 def test_list_endpoint(setup_service_running, es_inputs, random_index_name):
     """
     This test tests the list endpoint of the NOWElasticIndexer.
@@ -122,6 +230,78 @@ def test_list_endpoint(setup_service_running, es_inputs, random_index_name):
     assert len(result_with_offset) == len(index_docs_map['clip']) - offset
 
 
+def test_list_with_cursor(setup_service_running, es_inputs, random_index_name):
+    """
+    This test tests cursor pagination of the list endpoint and iterating over all
+    documents in pages.
+    """
+    (
+        index_docs_map,
+        query_docs_map,
+        document_mappings,
+        default_semantic_scores,
+    ) = es_inputs
+    es_indexer = NOWElasticIndexer(
+        document_mappings=document_mappings,
+        hosts='http://localhost:9200',
+        index_name=random_index_name,
+    )
+    es_indexer.index(index_docs_map)
+    listed_ids = []
+    cursor = ''
+    while cursor is not None:
+        result = es_indexer.list(parameters={'limit': 1, 'cursor': cursor})
+        assert len(result[0].matches) <= 1
+        listed_ids += result[0].matches[:, 'id']
+        cursor = result[0].tags['cursor']
+    assert sorted(listed_ids) == sorted(index_docs_map['clip'][:, 'id'])
+
+    pages = list(es_indexer.iter_pages(page_size=1))
+    assert len(pages) == len(index_docs_map['clip'])
+
+
+def test_async_handlers(setup_service_running, es_inputs, random_index_name):
+    """
+    This test checks that the async handlers of `/search` and `/list` return the same
+    results as the synchronous methods.
+    """
+    (
+        index_docs_map,
+        query_docs_map,
+        document_mappings,
+        default_semantic_scores,
+    ) = es_inputs
+    es_indexer = NOWElasticIndexer(
+        document_mappings=document_mappings,
+        hosts='http://localhost:9200',
+        index_name=random_index_name,
+        max_concurrency=2,
+        max_queries_per_msearch=1,
+        search_cache_max_entries=0,
+    )
+    es_indexer.index(index_docs_map)
+    parameters = {'semantic_scores': default_semantic_scores}
+    loop = asyncio.new_event_loop()
+    try:
+        results = es_indexer.search(query_docs_map, parameters=parameters)
+        async_results = loop.run_until_complete(
+            es_indexer.async_search(query_docs_map, parameters=parameters)
+        )
+        assert [doc.matches[:, 'id'] for doc in async_results] == [
+            doc.matches[:, 'id'] for doc in results
+        ]
+        listed = loop.run_until_complete(es_indexer.async_list())
+        assert sorted(listed[:, 'id']) == sorted(index_docs_map['clip'][:, 'id'])
+        page = loop.run_until_complete(
+            es_indexer.async_list(parameters={'limit': 100, 'cursor': ''})
+        )[0]
+        assert len(page.matches) == len(index_docs_map['clip'])
+        assert page.tags['cursor'] is None
+        loop.run_until_complete(es_indexer.async_es.close())
+    finally:
+        loop.close()
+
+
 def test_delete_by_id(setup_service_running, es_inputs, random_index_name):
     """
     This test tests the delete endpoint of the NOWElasticIndexer, by deleting a list of IDs.
@@ -166,13 +346,526 @@ def test_delete_by_filter(setup_service_running, es_inputs, random_index_name):
     es_indexer.index(index_docs_map)
 
     # delete by filter
-    es_indexer.delete(parameters={'filter': {'tags__price': {'$gte': 0}}})
+    result = es_indexer.delete(parameters={'filter': {'tags__price': {'$gte': 0}}})
+    task_id = result[0].tags['task_id']
+    for _ in range(30):
+        status = es_indexer.task_status(parameters={'task_id': task_id})
+        if status[0].tags['task_status']['completed']:
+            break
+        sleep(1)
+    assert status[0].tags['task_status']['completed']
 
     es = es_indexer.es
     res = es.search(index=index_name, size=100, query={'match_all': {}})
     assert len(res['hits']['hits']) == 0
 
 
+def test_search_during_delete_by_filter(
+    setup_service_running, es_inputs, random_index_name, monkeypatch
+):
+    """
+    This test tests that searches aren't cached while documents are deleted in the
+    background, and that the cache doesn't return deleted documents afterwards.
+    """
+    (
+        index_docs_map,
+        query_docs_map,
+        document_mappings,
+        default_semantic_scores,
+    ) = es_inputs
+    monkeypatch.setattr(elastic_indexer, 'TASK_POLL_INTERVAL', 0.1)
+    es_indexer = NOWElasticIndexer(
+        document_mappings=document_mappings,
+        hosts='http://localhost:9200',
+        index_name=random_index_name,
+    )
+    es_indexer.index(index_docs_map)
+    task_done = threading.Event()
+    get_task = es_indexer.es.tasks.get
+    monkeypatch.setattr(
+        es_indexer.es.tasks,
+        'get',
+        lambda task_id: get_task(task_id=task_id)
+        if task_done.is_set()
+        else {'completed': False},
+    )
+    parameters = {'semantic_scores': default_semantic_scores[:-1]}
+
+    es_indexer.delete(parameters={'filter': {'tags__price': {'$gte': 0}}})
+    for _ in range(2):
+        es_indexer.search(query_docs_map, parameters=parameters)
+    assert es_indexer.search_cache.stats()['entries'] == 0
+
+    task_done.set()
+    for _ in range(50):
+        if not es_indexer._pending_delete_tasks:
+            break
+        sleep(0.1)
+    assert not es_indexer._pending_delete_tasks
+    results = es_indexer.search(query_docs_map, parameters=parameters)
+    assert len(results[0].matches) == 0
+
+
+def test_search_cache_of_replicas(setup_service_running, es_inputs, random_index_name):
+    """
+    This test tests that a replica drops its cached matches after another replica
+    deleted documents, once it checked the generation of the search cache.
+    """
+    (
+        index_docs_map,
+        query_docs_map,
+        document_mappings,
+        default_semantic_scores,
+    ) = es_inputs
+    es_indexer = NOWElasticIndexer(
+        document_mappings=document_mappings,
+        hosts='http://localhost:9200',
+        index_name=random_index_name,
+    )
+    replica = NOWElasticIndexer(
+        document_mappings=document_mappings,
+        hosts='http://localhost:9200',
+        index_name=random_index_name,
+        search_cache_sync_interval=0,
+    )
+    es_indexer.index(index_docs_map)
+    parameters = {'semantic_scores': default_semantic_scores[:-1]}
+    results = replica.search(query_docs_map, parameters=parameters)
+    assert len(results[0].matches) > 0
+    assert replica.search_cache.stats()['entries'] > 0
+
+    es_indexer.delete(parameters={'ids': [doc.id for doc in index_docs_map['clip']]})
+    replica.sync_search_cache()
+    assert replica.search_cache.stats()['entries'] == 0
+    results = replica.search(query_docs_map, parameters=parameters)
+    assert len(results[0].matches) == 0
+
+
+def test_tags_of_overwritten_docs(setup_service_running, es_inputs, random_index_name):
+    """
+    This test tests that the tag values of overwritten documents are released, so that
+    only the values of the indexed documents are returned by `/tags`.
+    """
+    index_docs_map, _, document_mappings, _ = es_inputs
+    es_indexer = NOWElasticIndexer(
+        document_mappings=document_mappings,
+        hosts='http://localhost:9200',
+        index_name=random_index_name,
+        user_input_dict={'filter_fields': ['color']},
+    )
+    es_indexer.index(index_docs_map)
+    for doc in index_docs_map['clip']:
+        doc.tags['color'] = 'purple'
+    es_indexer.index(index_docs_map)
+    assert es_indexer.tags()[0].tags['tags'] == {'color': ['purple']}
+
+
+def test_tags_of_numbers_and_booleans(
+    setup_service_running, es_inputs, random_index_name
+):
+    """
+    This test tests that float and boolean tag values, which are tracked as in the
+    aggregation over the index, are released when documents are overwritten or deleted.
+    """
+    index_docs_map, _, document_mappings, _ = es_inputs
+    for doc in index_docs_map['clip']:
+        doc.tags.update(price=5.0, sale=True)
+    es_indexer = NOWElasticIndexer(
+        document_mappings=document_mappings,
+        hosts='http://localhost:9200',
+        index_name=random_index_name,
+        user_input_dict={'filter_fields': ['price', 'sale']},
+    )
+    es_indexer.index(index_docs_map)
+    es_indexer.update_tags()
+    assert es_indexer.tags()[0].tags['tags'] == {'price': ['5.0'], 'sale': ['true']}
+
+    first_doc, *other_docs = index_docs_map['clip']
+    first_doc.tags.update(price=6.0, sale=False)
+    es_indexer.index({'clip': DocumentArray([first_doc])})
+    es_indexer.delete(parameters={'ids': [doc.id for doc in other_docs]})
+    assert es_indexer.tags()[0].tags['tags'] == {'price': ['6.0'], 'sale': ['false']}
+
+
+def test_migrate_serialization(setup_service_running, es_inputs, random_index_name):
+    """
+    This test tests that documents of an index created by an older version, which maps
+    `serialized_doc` as text, are converted and reindexed into the current mapping.
+    """
+    index_docs_map, _, document_mappings, _ = es_inputs
+    es = Elasticsearch(hosts='http://localhost:9200')
+    es.indices.create(
+        index=random_index_name,
+        mappings={'properties': {'serialized_doc': {'type': 'text'}}},
+    )
+    es_indexer = NOWElasticIndexer(
+        document_mappings=document_mappings,
+        hosts='http://localhost:9200',
+        index_name=random_index_name,
+        serialization_format='pickle',
+    )
+    es_indexer.index(index_docs_map)
+    es_indexer.serialization_format = 'protobuf-zlib'
+
+    result = es_indexer.migrate_serialization(
+        parameters={'reindex': True, 'wait_for_completion': True}
+    )
+    assert result[0].tags['migrated'] == len(index_docs_map['clip'])
+    assert result[0].tags['reindex_required'] is True
+    assert 'task_id' in result[0].tags
+    es_mapping = es.indices.get_mapping(index=random_index_name)
+    assert list(es_mapping) == [f'{random_index_name}-v1']
+    assert (
+        es_mapping[f'{random_index_name}-v1']['mappings']['properties'][
+            'serialized_doc'
+        ]['type']
+        == 'binary'
+    )
+    assert len(es_indexer.list()) == len(index_docs_map['clip'])
+    result = es_indexer.migrate_serialization()
+    assert result[0].tags == {'migrated': 0, 'reindex_required': False}
+
+
+def test_reindex(setup_service_running, es_inputs, random_index_name):
+    """
+    This test tests that the reindex endpoint copies the documents into a new version
+    of the index, swaps the alias to it and deletes the old version.
+    """
+    (
+        index_docs_map,
+        query_docs_map,
+        document_mappings,
+        default_semantic_scores,
+    ) = es_inputs
+    es_indexer = NOWElasticIndexer(
+        document_mappings=document_mappings,
+        hosts='http://localhost:9200',
+        index_name=random_index_name,
+    )
+    es_indexer.index(index_docs_map)
+    es = es_indexer.es
+    assert list(es.indices.get_alias(name=random_index_name)) == [
+        f'{random_index_name}-v1'
+    ]
+
+    result = es_indexer.reindex(parameters={'wait_for_completion': True})
+    assert result[0].tags['index'] == f'{random_index_name}-v2'
+    assert list(es.indices.get_alias(name=random_index_name)) == [
+        f'{random_index_name}-v2'
+    ]
+    assert not es.indices.exists(index=f'{random_index_name}-v1')
+    assert not es.indices.exists_alias(name=es_indexer.build_alias)
+    settings = es.indices.get_settings(index=f'{random_index_name}-v2')
+    index_settings = settings[f'{random_index_name}-v2']['settings']['index']
+    assert index_settings['number_of_replicas'] == '1'
+    assert len(es_indexer.list()) == len(index_docs_map['clip'])
+    results = es_indexer.search(
+        query_docs_map,
+        parameters={'semantic_scores': default_semantic_scores[:-1]},
+    )
+    assert len(results[0].matches) == len(index_docs_map['clip'])
+
+
+def test_get_stored_routed_docs(setup_service_running, es_inputs, random_index_name):
+    """
+    This test tests that routed documents are found by their id before the index is
+    refreshed, also for more ids than are fetched with one mget request.
+    """
+    index_docs_map, _, document_mappings, _ = es_inputs
+    es_indexer = NOWElasticIndexer(
+        document_mappings=document_mappings,
+        hosts='http://localhost:9200',
+        index_name=random_index_name,
+        number_of_shards=3,
+        number_of_replicas=0,
+        routing_tag='color',
+        refresh_policy='interval',
+        refresh_interval='-1',
+        backfill_threshold=MAX_IDS_PER_MGET + 2,
+    )
+    docs = DocumentArray()
+    for i in range(MAX_IDS_PER_MGET + 1):
+        doc = Document(index_docs_map['clip'][i % 2], copy=True)
+        doc.id = str(i)
+        doc.tags['color'] = ['red', 'blue', 'green'][i % 3]
+        docs.append(doc)
+    es_indexer.index({'clip': docs})
+    assert es_indexer._get_stored_routings(docs[:, 'id']) == {
+        doc.id: doc.tags['color'] for doc in docs
+    }
+
+    es_indexer.delete(parameters={'ids': docs[:, 'id']})
+    es_indexer.es.indices.refresh(index=random_index_name)
+    assert es_indexer.es.count(index=random_index_name)['count'] == 0
+
+
+def test_index_new_docs_without_reads(
+    setup_service_running, es_inputs, random_index_name, monkeypatch
+):
+    """
+    This test tests that indexing documents which don't exist yet doesn't read them,
+    and that only the overwritten documents are read when they are indexed again.
+    """
+    index_docs_map, _, document_mappings, _ = es_inputs
+    es_indexer = NOWElasticIndexer(
+        document_mappings=document_mappings,
+        hosts='http://localhost:9200',
+        index_name=random_index_name,
+        user_input_dict={'filter_fields': ['color']},
+    )
+    mget_ids = []
+    mget = es_indexer.es.mget
+
+    def _mget(docs, **kwargs):
+        mget_ids.extend(doc['_id'] for doc in docs)
+        return mget(docs=docs, **kwargs)
+
+    monkeypatch.setattr(es_indexer.es, 'mget', _mget)
+    first_doc, *other_docs = index_docs_map['clip']
+    es_indexer.index({'clip': DocumentArray(other_docs)})
+    assert mget_ids == []
+
+    es_indexer.index(index_docs_map)
+    assert sorted(mget_ids) == sorted(doc.id for doc in other_docs)
+    assert es_indexer.es.count(index=random_index_name)['count'] == len(
+        index_docs_map['clip']
+    )
+
+
+def test_change_routing_tag(setup_service_running, es_inputs, random_index_name):
+    """
+    This test tests that a document indexed again with another value of the routing
+    tag moves to the shard of the new value without leaving a copy behind, and that
+    the value can't be changed with `/update`.
+    """
+    (
+        index_docs_map,
+        query_docs_map,
+        document_mappings,
+        default_semantic_scores,
+    ) = es_inputs
+    es_indexer = NOWElasticIndexer(
+        document_mappings=document_mappings,
+        hosts='http://localhost:9200',
+        index_name=random_index_name,
+        number_of_shards=3,
+        number_of_replicas=0,
+        routing_tag='color',
+        user_input_dict={'filter_fields': ['color']},
+    )
+    for doc, color in zip(index_docs_map['clip'], ['red', 'blue']):
+        doc.tags['color'] = color
+    es_indexer.index(index_docs_map)
+    for doc in index_docs_map['clip']:
+        doc.tags['color'] = 'purple'
+    es_indexer.index(index_docs_map)
+
+    num_docs = len(index_docs_map['clip'])
+    assert es_indexer.es.count(index=random_index_name)['count'] == num_docs
+    results = es_indexer.search(
+        query_docs_map,
+        parameters={
+            'semantic_scores': default_semantic_scores[:-1],
+            'filter': {'tags__color': {'$eq': 'purple'}},
+        },
+    )
+    assert len(results[0].matches) == num_docs
+    assert es_indexer.tags()[0].tags['tags'] == {'color': ['purple']}
+    with pytest.raises(ValueError):
+        es_indexer.update(docs=DocumentArray([Document(id='0', tags={'color': 'red'})]))
+
+
+def test_snapshot_and_restore(setup_service_running, es_inputs, random_index_name):
+    """
+    This test tests that a snapshot restores the documents and curated results into a
+    new version of the index, and that snapshots of other mappings aren't restored.
+    """
+    index_docs_map, _, document_mappings, _ = es_inputs
+    es_indexer = NOWElasticIndexer(
+        document_mappings=document_mappings,
+        hosts='http://localhost:9200',
+        index_name=random_index_name,
+        snapshot_path='/usr/share/elasticsearch/snapshots',
+    )
+    es = es_indexer.es
+    result = es_indexer.restore(parameters={'snapshot': 'dataset'})
+    assert result[0].tags == {'restored': False, 'snapshots_enabled': True}
+
+    es_indexer.index(index_docs_map)
+    es_indexer.curate(
+        parameters={'query_to_filter': {'cat': [{'id': {'$eq': '1'}}]}},
+    )
+    es_indexer.snapshot(parameters={'snapshot': 'dataset'})
+    es.delete_by_query(index=random_index_name, query={'match_all': {}}, refresh=True)
+    es_indexer.query_to_curated_ids = {}
+    assert len(es_indexer.list()) == 0
+    replica = NOWElasticIndexer(
+        document_mappings=document_mappings,
+        hosts='http://localhost:9200',
+        index_name=random_index_name,
+        curation_sync_interval=0,
+    )
+
+    result = es_indexer.restore(parameters={'snapshot': 'dataset'})
+    assert result[0].tags == {'restored': True, 'snapshots_enabled': True}
+    assert list(es.indices.get_alias(name=random_index_name)) == [
+        f'{random_index_name}-v2'
+    ]
+    assert not es.indices.exists(index=f'{random_index_name}-v1')
+    assert len(es_indexer.list()) == len(index_docs_map['clip'])
+    assert es_indexer.query_to_curated_ids == {'cat': ['1']}
+    cache_generation = replica.search_cache.generation
+    replica.sync_index_version()
+    replica.sync_curated_ids()
+    assert replica.search_cache.generation > cache_generation
+    assert replica.query_to_curated_ids == {'cat': ['1']}
+
+    other_indexer = NOWElasticIndexer(
+        document_mappings=[['clip', 16, ['title', 'gif']]],
+        hosts='http://localhost:9200',
+        index_name=random_index_name,
+        snapshot_path='/usr/share/elasticsearch/snapshots',
+    )
+    result = other_indexer.restore(parameters={'snapshot': 'dataset'})
+    assert result[0].tags['restored'] is False
+    with pytest.raises(ValueError):
+        es_indexer.snapshot(parameters={'snapshot': 'Not valid'})
+
+
+def test_shards_and_routing(setup_service_running, es_inputs, random_index_name):
+    """
+    This test tests that the index is created with the configured shards and replicas,
+    and that documents are routed by their color, so that searches and deletes
+    filtering by color only hit one shard.
+    """
+    (
+        index_docs_map,
+        query_docs_map,
+        document_mappings,
+        default_semantic_scores,
+    ) = es_inputs
+    es_indexer = NOWElasticIndexer(
+        document_mappings=document_mappings,
+        hosts='http://localhost:9200',
+        index_name=random_index_name,
+        number_of_shards=3,
+        number_of_replicas=0,
+        routing_tag='color',
+    )
+    es_indexer.index(index_docs_map)
+    es = es_indexer.es
+    settings = es.indices.get_settings(index=random_index_name)
+    index_settings = next(iter(settings.values()))['settings']['index']
+    assert index_settings['number_of_shards'] == '3'
+    assert index_settings['number_of_replicas'] == '0'
+    hits = es.search(index=random_index_name, query={'match_all': {}})['hits']['hits']
+    assert all(hit['_routing'] == hit['_source']['tags']['color'] for hit in hits)
+
+    doc = index_docs_map['clip'][0]
+    color = doc.tags['color']
+    results = es_indexer.search(
+        query_docs_map,
+        parameters={
+            'semantic_scores': default_semantic_scores[:-1],
+            'filter': {'tags__color': {'$eq': color}},
+        },
+    )
+    assert doc.id in results[0].matches[:, 'id']
+    assert all(match.tags['color'] == color for match in results[0].matches)
+
+    es_indexer.delete(parameters={'ids': [doc.id]})
+    assert doc.id not in es_indexer.list()[:, 'id']
+
+
+def test_default_number_of_shards():
+    """
+    This test tests that the default number of shards grows with the number of
+    documents and the size of their vectors.
+    """
+    document_mappings = [FieldEmbedding('clip', 4096, ['title', 'image'])]
+    assert get_default_number_of_shards(10_000, document_mappings) == 1
+    # 31 GiB of float or 8 GiB of byte vectors, with at most 10 GiB per shard
+    assert get_default_number_of_shards(1_000_000, document_mappings) == 4
+    assert get_default_number_of_shards(1_000_000, document_mappings, 'byte') == 1
+    assert get_default_number_of_shards(MAX_DOCS_PER_SHARD * 2, []) == 2
+
+
+def test_get_filter_routing():
+    assert get_filter_routing({'tags__tenant': {'$eq': 'a'}}, 'tenant') == 'a'
+    assert get_filter_routing({'tags__tenant': {'$in': ['a', 'b']}}, 'tenant') == 'a,b'
+    assert get_filter_routing({'tags__tenant': {'$ne': 'a'}}, 'tenant') is None
+    assert get_filter_routing({'tags__color': {'$eq': 'a'}}, 'tenant') is None
+    assert get_filter_routing({'tags__tenant': {'$eq': 'a'}}, None) is None
+
+
+def test_update(setup_service_running, es_inputs, random_index_name):
+    """
+    This test tests the update endpoint of the NOWElasticIndexer, by updating the tags
+    of one document and the title of another one.
+    """
+    (
+        index_docs_map,
+        query_docs_map,
+        document_mappings,
+        default_semantic_scores,
+    ) = es_inputs
+    es_indexer = NOWElasticIndexer(
+        document_mappings=document_mappings,
+        hosts='http://localhost:9200',
+        index_name=random_index_name,
+    )
+    updated_doc = Document(index_docs_map['clip'][1], copy=True)
+    updated_doc.id = index_docs_map['clip'][1].id
+    updated_doc.title.chunks[0].text = 'updated title'
+    es_indexer.index(index_docs_map)
+    es = es_indexer.es
+    embedding_before = es.get(index=random_index_name, id='1')['_source'][
+        'gif-clip.embedding'
+    ]
+
+    es_indexer.update(docs=DocumentArray([Document(id='0', tags={'price': 100})]))
+    es_indexer.update({'clip': DocumentArray([updated_doc])})
+
+    docs = {doc.id: doc for doc in es_indexer.list()}
+    assert docs['0'].tags['price'] == 100
+    assert docs['0'].tags['color'] == index_docs_map['clip'][0].tags['color']
+    assert docs['1'].title.text == 'updated title'
+    es_doc = es.get(index=random_index_name, id='1')['_source']
+    assert 'updated title' in es_doc['bm25_text']
+    assert es_doc['gif-clip.embedding'] == embedding_before
+
+
+def test_curated_ids_are_persisted(setup_service_running, es_inputs, random_index_name):
+    """
+    This test checks that curated results are resolved for all filters at once and
+    loaded by another indexer on the same index, e.g. a replica or after a restart.
+    """
+    index_docs_map, _, document_mappings, _ = es_inputs
+    es_indexer = NOWElasticIndexer(
+        document_mappings=document_mappings,
+        hosts='http://localhost:9200',
+        index_name=random_index_name,
+    )
+    es_indexer.index(index_docs_map)
+    es_indexer.curate(
+        parameters={
+            'query_to_filter': {
+                'cat': [{'id': {'$eq': '1'}}, {'tags__price': {'$gte': 0}}],
+                'dog': [{'id': {'$eq': '0'}}],
+            }
+        }
+    )
+    expected_curated_ids = {'cat': ['1', '0'], 'dog': ['0']}
+    assert es_indexer.query_to_curated_ids == expected_curated_ids
+
+    restarted_indexer = NOWElasticIndexer(
+        document_mappings=document_mappings,
+        hosts='http://localhost:9200',
+        index_name=random_index_name,
+    )
+    assert restarted_indexer.query_to_curated_ids == expected_curated_ids
+
+
 def test_custom_mapping_and_custom_bm25_search(
     setup_service_running, es_inputs, random_index_name
 ):
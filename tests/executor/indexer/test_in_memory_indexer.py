@@ -0,0 +1,252 @@
+import numpy as np
+import pytest
+from docarray import Document, DocumentArray
+
+from now.executor.indexer.in_memory import NOWInMemoryIndexer, in_memory_indexer
+from now.executor.indexer.in_memory.in_memory_indexer import top_k
+from now.executor.indexer.in_memory.vector_store import VectorStore
+
+
+def test_index_and_search(es_inputs):
+    """
+    This test checks that the matches and their score breakdowns are scored with the
+    semantic scores, like by the NOWElasticIndexer.
+    """
+    (
+        index_docs_map,
+        query_docs_map,
+        document_mappings,
+        default_semantic_scores,
+    ) = es_inputs
+    indexer = NOWInMemoryIndexer(document_mappings=document_mappings)
+    indexer.index(index_docs_map)
+    results = indexer.search(
+        query_docs_map,
+        parameters={
+            'get_score_breakdown': True,
+            'semantic_scores': default_semantic_scores,
+        },
+    )
+    matches = results[0].matches
+    assert len(matches) == len(index_docs_map['clip'])
+    assert matches[0].scores['total'].value >= matches[1].scores['total'].value
+    for match in matches:
+        vector_scores = [
+            match.scores[f'query_text-{field}-clip-1'].value
+            for field in ['title', 'gif']
+        ]
+        assert np.isclose(
+            match.scores['total'].value, 1 + sum(vector_scores), atol=1e-5
+        )
+        assert match.title.text
+
+
+def test_search_with_filter(es_inputs):
+    """
+    This test checks that matches are filtered by equality and range conditions.
+    """
+    (
+        index_docs_map,
+        query_docs_map,
+        document_mappings,
+        default_semantic_scores,
+    ) = es_inputs
+    indexer = NOWInMemoryIndexer(
+        document_mappings=document_mappings,
+        user_input_dict={'filter_fields': ['color', 'price']},
+    )
+    indexer.index(index_docs_map)
+    color = index_docs_map['clip'][0].tags['color']
+    res = indexer.search(
+        query_docs_map,
+        parameters={
+            'semantic_scores': default_semantic_scores,
+            'filter': {'tags__color': {'$eq': color}, 'tags__price': {'$lte': 1}},
+        },
+    )
+    assert len(res[0].matches) == 1
+    assert res[0].matches[0].id == '0'
+
+
+@pytest.mark.parametrize(
+    'filter, expected_ids',
+    [
+        ({'tags__color': {'$in': ['red', 'green']}}, ['0']),
+        ({'tags__color': {'$ne': 'red'}}, ['1']),
+        ({'tags__color': {'$nin': ['red', 'blue']}}, []),
+        ({'tags__discount': {'$exists': True}}, ['0']),
+        ({'tags__discount': {'$exists': False}}, ['1']),
+        ({'tags__discount': {'$ne': 0.1}}, ['1']),
+        ({'tags__color': {'$exists': True}, 'tags__price': {'$gt': 1}}, ['1']),
+    ],
+)
+def test_search_with_negated_and_exists_filter(es_inputs, filter, expected_ids):
+    """
+    This test checks that `$in`, `$ne`, `$nin` and `$exists` filter like in the
+    NOWElasticIndexer, where negated conditions match documents without the field.
+    """
+    (
+        index_docs_map,
+        query_docs_map,
+        document_mappings,
+        default_semantic_scores,
+    ) = es_inputs
+    indexer = NOWInMemoryIndexer(
+        document_mappings=document_mappings,
+        user_input_dict={'filter_fields': ['color', 'price']},
+    )
+    index_docs_map['clip'][0].tags.update({'color': 'red', 'discount': 0.1})
+    index_docs_map['clip'][1].tags['color'] = 'blue'
+    indexer.index(index_docs_map)
+    res = indexer.search(
+        query_docs_map,
+        parameters={'semantic_scores': default_semantic_scores, 'filter': filter},
+    )
+    assert sorted(match.id for match in res[0].matches) == expected_ids
+
+
+def test_search_with_invalid_filter_operator(es_inputs):
+    (
+        index_docs_map,
+        query_docs_map,
+        document_mappings,
+        default_semantic_scores,
+    ) = es_inputs
+    indexer = NOWInMemoryIndexer(document_mappings=document_mappings)
+    indexer.index(index_docs_map)
+    with pytest.raises(ValueError):
+        indexer.search(
+            query_docs_map,
+            parameters={
+                'semantic_scores': default_semantic_scores,
+                'filter': {'tags__color': {'$regex': 'r.*'}},
+            },
+        )
+
+
+def test_list_and_delete(es_inputs):
+    """
+    This test checks listing with a cursor and deleting by ids and filter.
+    """
+    index_docs_map, _, document_mappings, _ = es_inputs
+    indexer = NOWInMemoryIndexer(
+        document_mappings=document_mappings,
+        user_input_dict={'filter_fields': ['color', 'price']},
+    )
+    indexer.index(index_docs_map)
+    page = indexer.list(parameters={'limit': 1, 'cursor': ''})[0]
+    assert page.matches[:, 'id'] == ['0']
+    page = indexer.list(parameters={'limit': 1, 'cursor': page.tags['cursor']})[0]
+    assert page.matches[:, 'id'] == ['1']
+
+    indexer.delete(parameters={'ids': ['0']})
+    assert indexer.list()[:, 'id'] == ['1']
+    indexer.delete(parameters={'filter': {'tags__price': {'$gte': 1}}})
+    assert len(indexer.list()) == 0
+    assert indexer.tags()[0].tags['tags'] == {'color': [], 'price': []}
+
+
+def test_persistence(es_inputs, tmpdir):
+    """
+    This test checks that an indexer restores the documents and vectors from its
+    workspace.
+    """
+    (
+        index_docs_map,
+        query_docs_map,
+        document_mappings,
+        default_semantic_scores,
+    ) = es_inputs
+    indexer = NOWInMemoryIndexer(
+        document_mappings=document_mappings, metas={'workspace': str(tmpdir)}
+    )
+    indexer.index(index_docs_map)
+    indexer.delete(parameters={'ids': ['1']})
+    indexer.curate(parameters={'query_to_filter': {'cat': [{'id': {'$eq': '0'}}]}})
+    parameters = {'semantic_scores': default_semantic_scores}
+    matches = indexer.search(
+        {'clip': DocumentArray(Document(query_docs_map['clip'][0], copy=True))},
+        parameters=parameters,
+    )[0].matches
+
+    restored_indexer = NOWInMemoryIndexer(
+        document_mappings=document_mappings, metas={'workspace': str(tmpdir)}
+    )
+    restored_matches = restored_indexer.search(query_docs_map, parameters=parameters)[
+        0
+    ].matches
+    assert restored_matches[:, 'id'] == matches[:, 'id'] == ['0']
+    assert restored_matches[0].scores['cosine'] == matches[0].scores['cosine']
+    assert restored_indexer.query_to_curated_ids == {'cat': ['0']}
+
+
+def test_log_compaction(es_inputs, tmpdir, monkeypatch):
+    """
+    This test checks that the log in the workspace is rewritten with one record per
+    document once most of its records are outdated, and that it still restores the
+    documents.
+    """
+    index_docs_map, _, document_mappings, _ = es_inputs
+    monkeypatch.setattr(in_memory_indexer, 'MIN_COMPACTED_LOG_RECORDS', 3)
+    indexer = NOWInMemoryIndexer(
+        document_mappings=document_mappings, metas={'workspace': str(tmpdir)}
+    )
+    indexer.index(index_docs_map)
+    indexer.index(index_docs_map)
+    indexer.delete(parameters={'ids': ['1']})
+    with open(indexer.log_path) as f:
+        assert len(f.readlines()) == len(indexer.list())
+
+    restored_indexer = NOWInMemoryIndexer(
+        document_mappings=document_mappings, metas={'workspace': str(tmpdir)}
+    )
+    assert restored_indexer.list()[:, 'id'] == indexer.list()[:, 'id']
+
+
+@pytest.mark.parametrize('metric', ['cosine', 'l2_norm'])
+def test_vector_store_similarities(metric):
+    """
+    This test checks the similarities of the vector store against numpy, and that
+    rows without a vector have a similarity of 0.
+    """
+    np.random.seed(0)
+    vectors, queries = np.random.random((10, 8)), np.random.random((3, 8))
+    store = VectorStore(dim=8, metric=metric, capacity=4)
+    store.resize(16)
+    for row, vector in enumerate(vectors):
+        store.set(row, vector)
+    store.clear(9)
+    similarities = store.similarities(queries, num_rows=10)
+    if metric == 'cosine':
+        expected = (vectors @ queries.T) / np.outer(
+            np.linalg.norm(vectors, axis=1), np.linalg.norm(queries, axis=1)
+        )
+    else:
+        expected = np.linalg.norm(vectors[:, np.newaxis] - queries, axis=2)
+    expected[9] = 0
+    assert np.allclose(similarities, expected, atol=1e-5)
+
+
+def test_top_k():
+    """
+    This test checks that the top rows are selected among the masked rows only.
+    """
+    scores = np.array([0.5, 0.9, 0.1, 0.7, 0.8])
+    mask = np.array([True, False, True, True, True])
+    assert top_k(scores, mask, 2).tolist() == [4, 3]
+    assert top_k(scores, mask, 10).tolist() == [4, 3, 0, 2]
+    assert top_k(scores, mask, 0).tolist() == []
+
+
+@pytest.mark.parametrize('serialization_format', ['protobuf-lz4', 'msgpack'])
+def test_invalid_serialization_format(es_inputs, serialization_format):
+    """
+    This test checks that an unsupported serialization format fails at startup
+    instead of when the first document is serialized.
+    """
+    _, _, document_mappings, _ = es_inputs
+    with pytest.raises(ValueError):
+        NOWInMemoryIndexer(
+            document_mappings=document_mappings,
+            serialization_format=serialization_format,
+        )
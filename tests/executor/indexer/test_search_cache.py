@@ -0,0 +1,59 @@
+import numpy as np
+from docarray import Document, DocumentArray
+
+from now.executor.indexer.elastic.search_cache import (
+    SearchResultCache,
+    get_search_cache_key,
+)
+
+
+def test_search_cache_hit_and_invalidate():
+    """
+    This test checks that cached values are served until the cache is invalidated,
+    and that values computed before an invalidation are not cached.
+    """
+    cache = SearchResultCache(max_entries=10)
+    generation = cache.generation
+    assert cache.get('query') is None
+    cache.put('query', b'matches', generation)
+    assert cache.get('query') == b'matches'
+
+    cache.invalidate()
+    assert cache.get('query') is None
+    cache.put('query', b'stale matches', generation)
+    assert cache.get('query') is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 3
+
+
+def test_search_cache_eviction():
+    """
+    This test checks that the cache evicts the least recently used entries
+    once it exceeds its entry or byte bounds.
+    """
+    cache = SearchResultCache(max_entries=2, max_bytes=10)
+    cache.put('a', b'1234', cache.generation)
+    cache.put('b', b'1234', cache.generation)
+    cache.get('a')
+    cache.put('c', b'1234', cache.generation)
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1234'
+
+    cache.put('d', b'12345678', cache.generation)
+    assert cache.stats()['entries'] == 1
+    assert cache.stats()['size_bytes'] == 8
+
+
+def test_get_search_cache_key(mm_dataclass):
+    """
+    This test checks that the cache key depends on the query embeddings and on the
+    search parameters.
+    """
+    doc = Document(mm_dataclass(text_field='cat'))
+    doc.text_field.embedding = np.ones(8)
+    docs_map = {'clip': DocumentArray([doc])}
+    key = get_search_cache_key(docs_map, doc.id, {'limit': 10})
+    assert key == get_search_cache_key(docs_map, doc.id, {'limit': 10})
+    assert key != get_search_cache_key(docs_map, doc.id, {'limit': 20})
+    doc.text_field.embedding = np.zeros(8)
+    assert key != get_search_cache_key(docs_map, doc.id, {'limit': 10})
@@ -0,0 +1,60 @@
+from now.executor.indexer.elastic.tag_index import TagValueIndex
+
+
+def test_tag_index_reference_counts():
+    """
+    This test checks that a value is kept as long as a document with it exists,
+    and that tags which aren't filter fields are ignored.
+    """
+    tag_index = TagValueIndex(filter_fields=['color'])
+    tag_index.add({'color': 'red', 'price': 1})
+    tag_index.add({'color': 'red'})
+    tag_index.add({'color': 'blue'})
+    assert tag_index.to_dict() == {'color': ['red', 'blue']}
+
+    tag_index.remove({'color': 'red'})
+    tag_index.remove({'color': 'blue'})
+    assert tag_index.to_dict() == {'color': ['red']}
+
+    tag_index.remove_counts({'color': {'red': 1}})
+    assert tag_index.to_dict() == {'color': []}
+
+
+def test_tag_index_overflow():
+    """
+    This test checks that values exceeding the cap are not tracked and that the tag
+    is marked as overflowed, until the index is reset.
+    """
+    tag_index = TagValueIndex(filter_fields=['color'], max_values_per_tag=2)
+    for color in ['red', 'blue', 'green']:
+        tag_index.add({'color': color})
+    assert tag_index.to_dict() == {'color': ['red', 'blue']}
+    assert tag_index.overflowed == ['color']
+
+    tag_index.reset({'color': {'red': 3, 'blue': 1}})
+    assert tag_index.to_dict() == {'color': ['red', 'blue']}
+    assert tag_index.overflowed == []
+
+    tag_index.reset({'color': {'red': 3, 'blue': 2, 'green': 1}})
+    assert tag_index.to_dict() == {'color': ['red', 'blue']}
+    assert tag_index.overflowed == ['color']
+
+
+def test_tag_index_keyword_values():
+    """
+    This test checks that numbers and booleans of written documents are tracked as the
+    strings which an aggregation over the keyword fields returns for them, so that
+    overwriting and deleting documents releases the aggregated values.
+    """
+    tag_index = TagValueIndex(filter_fields=['price', 'sale'])
+    tag_index.reset({'price': {'5.0': 1, '7.5': 1}, 'sale': {'true': 2}})
+    # overwrite the first document
+    tag_index.remove({'price': 5.0, 'sale': True})
+    tag_index.add({'price': 6.0, 'sale': False})
+    # delete the second document
+    tag_index.remove({'price': 7.5, 'sale': True})
+    assert tag_index.to_dict() == {'price': ['6.0'], 'sale': ['false']}
+
+    tag_index.reset({'price': {6.0: 1}})
+    tag_index.remove_counts({'price': {'6.0': 1}})
+    assert tag_index.to_dict() == {'price': []}
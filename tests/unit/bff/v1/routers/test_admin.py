@@ -0,0 +1,25 @@
+from fastapi.testclient import TestClient
+from starlette import status
+
+from now.executor.gateway.bff.app.app import build_app
+
+
+def test_update_tags_calls_indexer(mocker):
+    jina_client_post = mocker.patch(
+        'now.executor.gateway.bff.app.v1.routers.admin.jina_client_post',
+        new_callable=mocker.AsyncMock,
+    )
+    response = TestClient(build_app()).post(
+        '/api/v1/admin/updateTags',
+        json={'data': [('0', {'price': 10}), ('1', {'color': 'red'})]},
+    )
+
+    assert response.status_code == status.HTTP_200_OK
+    kwargs = jina_client_post.call_args.kwargs
+    # tags don't need to be encoded, so only the indexer is called
+    assert kwargs['endpoint'] == '/update'
+    assert kwargs['target_executor'] == r'\Aindexer\Z'
+    assert [(doc.id, doc.tags) for doc in kwargs['docs']] == [
+        ('0', {'price': 10}),
+        ('1', {'color': 'red'}),
+    ]